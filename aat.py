@@ -22,26 +22,30 @@ def prioritize_targets(targets, rvir=300*u.kpc, scheme='jun2014'):
 
     pris = np.zeros(len(targets), dtype=int)
     if scheme == 'jul2014':
-        g = targets['g']
+        from selectexpr import ExpressionCache
+
+        # each color is only computed once, however many priorities use it
+        exprs = ExpressionCache(targets)
+        gr = exprs['g-r']
+        ri = exprs['r-i']
         r = targets['r']
-        i = targets['i']
         w1 = targets['w1'] if 'w1' in targets.colnames else None
         rkpc = targets['rhost_kpc']
 
 
-        pris[(g-r < 1.2) & (r-i < 0.7) & (r<21) & (rkpc < rvkpc)] = 1
-        pris[(g-r < 1.2) & (r-i < 0.7) & (r<20.5) & (rkpc < rvkpc)] = 2
+        pris[(gr < 1.2) & (ri < 0.7) & (r<21) & (rkpc < rvkpc)] = 1
+        pris[(gr < 1.2) & (ri < 0.7) & (r<20.5) & (rkpc < rvkpc)] = 2
 
-        pris[(g-r < 1.0) & (r-i < 0.5) & (r<20.5) & (rkpc > rvkpc)] = 3
+        pris[(gr < 1.0) & (ri < 0.5) & (r<20.5) & (rkpc > rvkpc)] = 3
 
         #add priority level 5 and 7 *only* if WISE data are present
-        pris[(g-r < 1.0) & (r-i < 0.5) & (r<21) & (rkpc < rvkpc)] = 4
+        pris[(gr < 1.0) & (ri < 0.5) & (r<21) & (rkpc < rvkpc)] = 4
         if w1 is not None:
-            pris[(r-w1<2.5) & (g-r < 1.0) & (r-i < 0.5) & (r<21) & (rkpc < rvkpc)] = 5
+            pris[(r-w1<2.5) & (gr < 1.0) & (ri < 0.5) & (r<21) & (rkpc < rvkpc)] = 5
 
-        pris[(g-r < 1.0) & (r-i < 0.5) & (r<20.5) & (rkpc < rvkpc)] = 6
+        pris[(gr < 1.0) & (ri < 0.5) & (r<20.5) & (rkpc < rvkpc)] = 6
         if w1 is not None:
-            pris[(r-w1<2.5) & (g-r < 1.0) & (r-i < 0.5) & (r<20.5) & (rkpc < rvkpc)] = 7
+            pris[(r-w1<2.5) & (gr < 1.0) & (ri < 0.5) & (r<20.5) & (rkpc < rvkpc)] = 7
     elif scheme == 'jun2015baseline':
         sborder = np.argsort(targets['sb_petro_r'])
         # now split into 2 based on SB-ile
@@ -22,8 +22,8 @@ def count_targets(hsts, verbose=True, remove_cached=True, rvir=300, targetingkwa
         Whether or not to print a message when each host is examined
     remove_cached : bool
         Whether or not to remove the cached sdss catalog for each host
-        after counting. This may be necessary to prevent running out of
-        memory, depending on the number of hosts involved.
+        after counting.  The catalog cache already keeps memory use within
+        `catalogcache.MEMORY_BUDGET`, but this frees it straight away.
     rvir : float
         "virial radius" in kpc for the arcmin transform
     targetingkwargs : dict or list of dicts
@@ -67,13 +67,15 @@ def count_targets(hsts, verbose=True, remove_cached=True, rvir=300, targetingkwa
         dists.append(h.distmpc)
         rvs.append(h.physical_to_projected(300))
 
-        for j, t in enumerate(targetingkwargs):
-            if verbose:
+        if verbose:
+            for t in targetingkwargs:
                 print 'Targeting parameters:', t
-                sys.stdout.flush()
+            sys.stdout.flush()
 
-            tcat = targeting.select_targets(h, **t)
-            cnts[j].append(len(tcat))
+        # the parts of the selection shared by all the kwargs are only done once
+        hcnts = targeting.sweep_select_targets(h, targetingkwargs, counts=True)
+        for j, n in enumerate(hcnts):
+            cnts[j].append(n)
 
         if remove_cached:
             h._cached_sdss = None
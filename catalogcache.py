@@ -0,0 +1,489 @@
+"""
+Binary on-disk caches for catalogs that are slow to parse from text.
+
+A cache lives in a "sidecar" directory next to the source file (e.g.
+``catalogs/Odyssey_sdss.dat.cache``) with one ``.npy`` file per column, so
+that loading is just memory-mapping those files.  Each cache records the
+source file's size, modification time and hash, along with a version number
+for the code that produced the table, and is ignored (and rebuilt) if any of
+those no longer match.
+
+This module also has the process-wide in-memory cache of loaded catalogs
+(`memory_cache`), which keeps the most recently used catalogs up to a total
+of `MEMORY_BUDGET` bytes.
+"""
+from __future__ import division, print_function
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+CACHE_SUFFIX = '.cache'
+CACHE_FORMAT_VERSION = 1  # the layout of the cache directories themselves
+_METAFN = 'meta.json'
+
+MEMORY_BUDGET = 2 * 2**30  # bytes of loaded catalogs to keep in memory
+
+
+def cache_dir_for(fn):
+    """
+    The sidecar cache directory for the file `fn`
+    """
+    return fn + CACHE_SUFFIX
+
+
+def file_hash(fn, blocksize=2**20):
+    """
+    The SHA1 hex digest of the file `fn`.
+    """
+    h = hashlib.sha1()
+    with open(fn, 'rb') as f:
+        buf = f.read(blocksize)
+        while buf:
+            h.update(buf)
+            buf = f.read(blocksize)
+    return h.hexdigest()
+
+
+def _source_info(fn, withhash=True):
+    st = os.stat(fn)
+    info = {'size': st.st_size, 'mtime': st.st_mtime}
+    if withhash:
+        info['sha1'] = file_hash(fn)
+    return info
+
+
+def _read_meta(cachedir):
+    metafn = os.path.join(cachedir, _METAFN)
+    if not os.path.isfile(metafn):
+        return None
+    with open(metafn) as f:
+        return json.load(f)
+
+
+def cache_is_valid(sourcefn, cachedir, version, extra=None):
+    """
+    Checks whether the cache in `cachedir` is up to date for `sourcefn`.
+
+    The cheap checks (size, version, `extra`) come first.  If the modification
+    time has changed but the size hasn't, the file is re-hashed, so that just
+    touching or copying a file doesn't invalidate its cache.
+
+    Parameters
+    ----------
+    sourcefn : str
+        The file the cache was built from
+    cachedir : str
+        The cache directory
+    version : int
+        The version of the code that produced the cached table
+    extra : json-able or None
+        Anything else the cached content depends on (e.g. host position)
+
+    Returns
+    -------
+    valid : bool
+    """
+    meta = _read_meta(cachedir)
+    if meta is None or meta.get('format') != CACHE_FORMAT_VERSION:
+        return False
+    if meta['version'] != version or meta['extra'] != _jsonify(extra):
+        return False
+
+    src = meta['source']
+    st = os.stat(sourcefn)
+    if st.st_size != src['size']:
+        return False
+    if st.st_mtime == src['mtime']:
+        return True
+
+    if file_hash(sourcefn) == src['sha1']:
+        # same content, so just record the new mtime for next time
+        src['mtime'] = st.st_mtime
+        _write_meta(cachedir, meta)
+        return True
+    return False
+
+
+def _jsonify(obj):
+    # round-trip through json so comparisons see exactly what gets stored
+    return json.loads(json.dumps(obj))
+
+
+def _write_meta(cachedir, meta):
+    tmpfn = os.path.join(cachedir, _METAFN + '.tmp')
+    with open(tmpfn, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmpfn, os.path.join(cachedir, _METAFN))
+
+
+def write_table_cache(tab, sourcefn, version, extra=None, cachedir=None):
+    """
+    Writes `tab` to a binary cache for `sourcefn`.
+
+    Only regular (possibly masked) columns are stored - mixin columns like
+    `SkyCoord` are skipped and need to be re-created by the caller.  Column
+    ``meta`` is kept as long as it can be stored as JSON.  Columns
+    that are just views of an earlier column (e.g. upper/lower case aliases)
+    are stored as references to that column, and come back as views again.
+    The cache is written to a temporary directory and then renamed into
+    place, so a half-written cache is never used.
+
+    Parameters
+    ----------
+    tab : astropy.table.Table
+        The table to cache
+    sourcefn : str
+        The file the table came from
+    version : int
+        The version of the code that produced `tab`
+    extra : json-able or None
+        Anything else the content of `tab` depends on
+    cachedir : str or None
+        The cache directory or None to use `cache_dir_for`
+
+    Returns
+    -------
+    cachedir : str
+        The directory the cache was written to
+    """
+    from astropy.table import Column, MaskedColumn
+
+    if cachedir is None:
+        cachedir = cache_dir_for(sourcefn)
+    tmpdir = cachedir + '.tmp{0}'.format(os.getpid())
+    if os.path.isdir(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+
+    try:
+        cols = []
+        for i, nm in enumerate(tab.colnames):
+            col = tab.columns[nm]
+            if not isinstance(col, Column):
+                continue  # mixin column
+
+            aliasof = _find_alias(col, tab, cols)
+            if aliasof is not None:
+                cols.append({'name': nm, 'aliasof': aliasof})
+                continue
+
+            colfn = 'col{0}'.format(i)  # column names aren't necessarily safe file names
+            np.save(os.path.join(tmpdir, colfn + '.npy'), np.asarray(col))
+            masked = isinstance(col, MaskedColumn)
+            if masked:
+                np.save(os.path.join(tmpdir, colfn + '.mask.npy'), np.ma.getmaskarray(col))
+            cols.append({'name': nm, 'file': colfn, 'masked': masked,
+                         'unit': None if col.unit is None else str(col.unit),
+                         'meta': _jsonify(dict(col.meta)) if col.meta else None})
+
+        meta = {'format': CACHE_FORMAT_VERSION, 'version': version,
+                'extra': _jsonify(extra), 'columns': cols, 'nrows': len(tab),
+                'source': _source_info(sourcefn)}
+        _write_meta(tmpdir, meta)
+
+        if os.path.isdir(cachedir):
+            shutil.rmtree(cachedir)
+        os.rename(tmpdir, cachedir)
+    finally:
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+
+    return cachedir
+
+
+def _find_alias(col, tab, cols):
+    # the name of an already-stored column that `col` is an exact view of
+    for colinfo in cols:
+        if 'aliasof' in colinfo:
+            continue
+        other = tab.columns[colinfo['name']]
+        if (type(col) is type(other) and col.unit == other.unit and
+                _same_memory(np.asarray(col), np.asarray(other)) and
+                (not hasattr(col, 'mask') or
+                 _same_memory(np.ma.getmaskarray(col), np.ma.getmaskarray(other)))):
+            return colinfo['name']
+    return None
+
+
+def _same_memory(arr1, arr2):
+    return arr1.__array_interface__ == arr2.__array_interface__
+
+
+def read_table_cache(cachedir, mmap=True):
+    """
+    Reads a table written by `write_table_cache`.
+
+    Parameters
+    ----------
+    cachedir : str
+        The cache directory
+    mmap : bool
+        If True, the columns are memory-mapped copy-on-write, so only the
+        parts that are used get read, and modifying the table never touches
+        the cache files.
+
+    Returns
+    -------
+    tab : astropy.table.Table
+    """
+    from astropy.table import Table, Column, MaskedColumn
+
+    meta = _read_meta(cachedir)
+    if meta is None:
+        raise IOError('No catalog cache in "{0}"'.format(cachedir))
+
+    mmap_mode = 'c' if mmap else None
+    cols = []
+    colsbyname = {}
+    for colinfo in meta['columns']:
+        if 'aliasof' in colinfo:
+            alias = colsbyname[colinfo['aliasof']].copy(copy_data=False)
+            alias.name = colinfo['name']
+            cols.append(alias)
+            continue
+
+        fnbase = os.path.join(cachedir, colinfo['file'])
+        data = np.load(fnbase + '.npy', mmap_mode=mmap_mode)
+        if colinfo['masked']:
+            mask = np.load(fnbase + '.mask.npy', mmap_mode=mmap_mode)
+            cols.append(MaskedColumn(data=data, mask=mask, name=colinfo['name'],
+                                     unit=colinfo['unit'], copy=False))
+        else:
+            cols.append(Column(data=data, name=colinfo['name'],
+                               unit=colinfo['unit'], copy=False))
+        if colinfo.get('meta'):
+            cols[-1].meta.update(colinfo['meta'])
+        colsbyname[colinfo['name']] = cols[-1]
+
+    return Table(cols, copy=False)
+
+
+def load_with_cache(sourcefn, loader, version, extra=None, usecache=True,
+                    postload=None):
+    """
+    Loads `sourcefn` from its binary cache if that is up to date, otherwise
+    uses `loader` and (re-)writes the cache.
+
+    Parameters
+    ----------
+    sourcefn : str
+        The file to load
+    loader : callable
+        ``loader(sourcefn)`` should return the (fully processed) table.
+    version : int
+        The version of `loader` - bump this whenever what it produces changes.
+    extra : json-able or None
+        Anything else the loaded table depends on.
+    usecache : bool
+        If False, always use `loader` and don't write a cache.
+    postload : callable or None
+        If not None, ``postload(tab)`` is called on the table after reading it
+        from the cache, to re-create anything that isn't cached (e.g. mixin
+        columns).  It should return the table.
+
+    Returns
+    -------
+    tab : astropy.table.Table
+    """
+    if not usecache:
+        return loader(sourcefn)
+
+    cachedir = cache_dir_for(sourcefn)
+    if cache_is_valid(sourcefn, cachedir, version, extra):
+        tab = read_table_cache(cachedir)
+        if postload is not None:
+            tab = postload(tab)
+        return tab
+
+    tab = loader(sourcefn)
+    try:
+        write_table_cache(tab, sourcefn, version, extra, cachedir)
+    except (IOError, OSError) as e:
+        # e.g. a read-only catalogs directory - the cache is just an optimization
+        print('Could not write catalog cache for "{0}": {1}'.format(sourcefn, e))
+    return tab
+
+
+class CatalogMemoryCache(object):
+    """
+    A least-recently-used cache of loaded catalogs, limited by the total
+    number of bytes they use rather than the number of catalogs.
+
+    Sizes are re-measured whenever a catalog is accessed, so columns added
+    after it went into the cache (e.g. lazy columns) are counted too.  Data
+    that is memory-mapped from a file isn't counted, as the OS can drop those
+    pages whenever it needs to.
+
+    Parameters
+    ----------
+    maxbytes : int
+        The memory budget in bytes
+
+    Attributes
+    ----------
+    hits, misses, evictions : int
+        Counters for cache hits, misses, and catalogs evicted to stay in
+        budget.
+    """
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self._entries = OrderedDict()  # key -> [catalog, nbytes]
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    @property
+    def nbytes(self):
+        """
+        The bytes currently held by the cached catalogs
+        """
+        with self._lock:
+            return sum([e[1] for e in self._entries.values()])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, loader=None):
+        """
+        Gets the catalog for `key`, calling ``loader()`` to load it (and then
+        caching the result) if it isn't already cached.  If `loader` is None,
+        returns None for catalogs that aren't cached.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._entries[key] = self._entries.pop(key)  # move to the end
+                entry[1] = table_nbytes(entry[0])
+                self._evict(keep=key)
+                return entry[0]
+            self.misses += 1
+
+        if loader is None:
+            return None
+        # load outside the lock so other threads can use the cache meanwhile
+        catalog = loader()
+        self.put(key, catalog)
+        return catalog
+
+    def peek(self, key):
+        """
+        The catalog for `key` or None, without counting it as a hit or miss
+        or changing its place in the LRU order.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[0]
+
+    def put(self, key, catalog):
+        """
+        Adds `catalog` to the cache under `key`, evicting the least recently
+        used catalogs if needed.  A catalog bigger than the whole budget
+        isn't kept.
+        """
+        nbytes = table_nbytes(catalog)
+        with self._lock:
+            self._entries.pop(key, None)
+            if nbytes > self.maxbytes:
+                return
+            self._entries[key] = [catalog, nbytes]
+            self._evict(keep=key)
+
+    def discard(self, key):
+        """
+        Removes `key` from the cache if it's present.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Removes all catalogs from the cache (the counters are kept).
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def _evict(self, keep=None):
+        total = self.nbytes
+        for key in list(self._entries):
+            if total <= self.maxbytes:
+                break
+            if key == keep:
+                continue
+            total -= self._entries.pop(key)[1]
+            self.evictions += 1
+
+    def stats(self):
+        """
+        A dictionary with the hits, misses, evictions, the number of cached
+        catalogs, and the bytes they hold (and the budget).
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'ncatalogs': len(self._entries),
+                    'nbytes': self.nbytes, 'maxbytes': self.maxbytes}
+
+    def __repr__(self):
+        st = self.stats()
+        return ('<CatalogMemoryCache: {ncatalogs} catalogs, {nbytes} of {maxbytes} '
+                'bytes, {hits} hits, {misses} misses, {evictions} '
+                'evictions>'.format(**st))
+
+
+_memorycache = []
+def memory_cache():
+    """
+    The process-wide `CatalogMemoryCache`.  Its budget follows
+    `MEMORY_BUDGET`, so changing that takes effect on the next access.
+    """
+    if not _memorycache:
+        _memorycache.append(CatalogMemoryCache(MEMORY_BUDGET))
+    cache = _memorycache[0]
+    if cache.maxbytes != MEMORY_BUDGET:
+        with cache._lock:
+            cache.maxbytes = MEMORY_BUDGET
+            cache._evict()
+    return cache
+
+
+def table_nbytes(tab):
+    """
+    The number of bytes of (non-memory-mapped) memory used by the columns of
+    `tab`.  Columns that share memory (e.g. aliases) are only counted once.
+    """
+    seen = set()
+    total = 0
+    for col in tab.columns.values():
+        for arr in _column_arrays(col):
+            base = arr
+            while getattr(base, 'base', None) is not None and isinstance(base.base, np.ndarray):
+                base = base.base
+            if isinstance(base, np.memmap) or not isinstance(base, np.ndarray):
+                continue  # file-backed (or not an array at all)
+            if id(base) not in seen:
+                seen.add(id(base))
+                total += base.nbytes
+    return total
+
+
+def _column_arrays(col):
+    if isinstance(col, np.ndarray):
+        arrs = [col.view(np.ndarray)]
+        mask = getattr(col, 'mask', None)
+        if isinstance(mask, np.ndarray):
+            arrs.append(mask)
+        return arrs
+    data = getattr(col, 'data', None)
+    if data is not None and hasattr(data, 'components'):
+        # a SkyCoord (or other coordinate-like) mixin
+        return [np.asarray(getattr(data, c)) for c in data.components]
+    return []
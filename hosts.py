@@ -5,6 +5,7 @@ from __future__ import division, print_function
 
 import os
 import sys
+import threading
 
 import numpy as np
 from matplotlib import pyplot as plt
@@ -17,17 +18,28 @@ urlopen = six.moves.urllib.request.urlopen
 
 from astropy import units as u
 from astropy.coordinates import SkyCoord
+from astropy.table import Table, Row
 
 
 NSA_VERSION = '0.1.2'  # used to find the download location/file name
 NSAFILENAME = 'nsa_v{0}.fits'.format(NSA_VERSION.replace('.', '_'))
+NSA_STORE_VERSION = 1  # bump this if the layout written by `convert_nsa_to_store` changes
+HOST_LIST_VERSION = 1  # bump this if the layout written by `write_host_list` changes
 
 SDSS_SQL_URL = 'http://skyserver.sdss3.org/dr10/en/tools/search/x_sql.aspx'
+SDSS_MAX_TILE_AREA = 1.5  # sq. deg. - environs queries bigger than this are split into tiles
+SDSS_MAX_ROWS = 500000  # the SkyServer silently truncates query results to this many rows
 
 USNOB_URL = 'http://www.nofs.navy.mil/cgi-bin/vo_cone.cgi'
 
 TELL_IF_USING_CACHED = False  # If True, show an informational message about where the NSA is coming from
 
+USE_CATALOG_CACHE = True  # If True, SDSS/USNO-B environs catalogs are cached in binary form next to the text files
+COMPACT_CATALOGS = False  # If True, SDSS catalogs are loaded in the compact form from `compact_sdss_catalog`
+USE_SKY_STORE = False  # If True, SDSS catalogs come from the `skystore` for any host it covers
+SDSS_REPROCESS_VERSION = 2  # bump this whenever `load_and_reprocess_sdss_catalog` output changes
+USNOB_PARSE_VERSION = 1  # bump this whenever `load_usnob_catalog` output changes
+
 
 class NSAHost(object):
     """
@@ -64,6 +76,10 @@ class NSAHost(object):
         RA in degrees of the host
     dec : float
         Declination in degrees of the host
+    l : float
+        Galactic longitude in degrees of the host (computed on first access)
+    b : float
+        Galactic latitude in degrees of the host (computed on first access)
     zdist : float
         'ZDIST' field from NSA
     zdisterr : float
@@ -78,14 +94,68 @@ class NSAHost(object):
 
     Notes
     -----
-    This assumes the NSA catalog is sorted by NSAID.  This is True as of
-    this writing but could in theory change.  In that case the catalog should
-    be pre-sorted or something
+    The host information comes from the memory-mapped `NSAStore` (see
+    `get_nsa_store`), so only the columns in `_nsa_columns_used` are read, and
+    only for this host's row.
     """
+    _nsa_columns_used = ('RA', 'DEC', 'ZDIST', 'ZDIST_ERR', 'Z', 'MASS', 'ABSMAG')
+
     def __init__(self, nsaid, name=None, environsradius=300*u.kpc,
                  fnsdss=None, fnusnob=None, shortname=None):
+        nsa = get_nsa_store()
+
+        # uses the store's prebuilt index, so only the needed rows are read
+        nsaindx = nsa.nsaid_to_index(nsaid)
+        obj = dict([(nm, nsa[nm][nsaindx]) for nm in self._nsa_columns_used])
+
+        self._populate(nsaid, nsaindx, obj, name, environsradius, fnsdss,
+                       fnusnob, shortname)
+
+    def __getstate__(self):
+        # anything starting with "_cached" can be re-computed, so isn't pickled
+        state = {}
+        for k, v in self.__dict__.items():
+            if not k.startswith('_cached'):
+                # numpy scalars from the NSA store pickle much bigger than plain numbers
+                state[k] = v.item() if isinstance(v, np.generic) else v
+        state['_nsaversion'] = NSA_VERSION
+        return state
+
+    def __setstate__(self, state):
+        state = dict(state)
+        nsaversion = state.pop('_nsaversion', None)
+        self.__dict__.update(state)
+        if nsaversion != NSA_VERSION:
+            # pickled with a different NSA - the NSA quantities may have changed
+            self._update_from_nsa()
+
+    def _update_from_nsa(self):
+        """
+        Re-reads the NSA quantities (position, redshift, magnitudes, ...) for
+        this host from the current `NSAStore`, keeping everything else.
+        """
+        nsa = get_nsa_store()
+
+        self.nsaindx = nsa.nsaid_to_index(self.nsaid)
+        obj = dict([(nm, nsa[nm][self.nsaindx]) for nm in self._nsa_columns_used])
+        self.ra = obj['RA']
+        self.dec = obj['DEC']
+        self.zdist = obj['ZDIST']
+        self.zdisterr = obj['ZDIST_ERR']
+        self.zspec = obj['Z']
+        self.mstar = obj['MASS']
+        for i, band in enumerate('FNugriz'):
+            setattr(self, band, obj['ABSMAG'][i])
+        self._cached_galactic = None
+
+    def _populate(self, nsaid, nsaindx, obj, name, environsradius, fnsdss,
+                  fnusnob, shortname):
+        """
+        Sets up the host given its row of the NSA (`obj`, a dict-like with
+        the `_nsa_columns_used` columns).  Separate from ``__init__`` so that
+        `HostCatalog` can create hosts without going back to the NSA.
+        """
         from os import path
-        from astropy.coordinates import ICRS, Galactic
 
         self.nsaid = nsaid  # The NSA ID #
 
@@ -102,15 +172,7 @@ class NSAHost(object):
             if nsaname not in self.altnames:
                 self.altnames.append(nsaname)
 
-        nsa = get_nsa()
-
-        # find the object that's in the right order for the requested ID
-        self.nsaindx = np.searchsorted(nsa['NSAID'], nsaid)
-        obj = nsa[self.nsaindx]
-
-        # make sure its actually the right object
-        if obj['NSAID'] != nsaid:
-            raise ValueError('NSAID #{0} not present in the catalog'.format(nsaid))
+        self.nsaindx = nsaindx
 
         #now populate various things
         self.ra = obj['RA']
@@ -120,10 +182,6 @@ class NSAHost(object):
         self.zspec = obj['Z']
         self.mstar = obj['MASS']
 
-        galcoord = ICRS(self.ra*u.deg, self.dec*u.deg).transform_to(Galactic)
-        self.l = galcoord.l.degree
-        self.b = galcoord.b.degree
-
         for i, band in enumerate('FNugriz'):
             setattr(self, band, obj['ABSMAG'][i])
 
@@ -165,36 +223,36 @@ class NSAHost(object):
         """
         Distance to host (given WMAP7 cosmology/H0)
         """
-        from astropy.cosmology import WMAP7
-
-        return WMAP7.luminosity_distance(self.zdist)
+        return self.distmpc * u.Mpc
 
     @property
     def disterr(self):
         """
         Distance error (given WMAP7 cosmology/H0)
         """
-        from astropy.cosmology import WMAP7
-
-        dist = WMAP7.luminosity_distance(self.zdist)
-        dp = abs(dist - WMAP7.luminosity_distance(self.zdist + self.zdisterr))
-        dm = abs(dist - WMAP7.luminosity_distance(self.zdist - self.zdisterr))
-
-        return (dp + dm) / 2
+        return self.disterrmpc * u.Mpc
 
     @property
     def distmpc(self):
         """
-        `dist` in Mpc (for backwards-compatibility)
+        `dist` in Mpc.  Uses the shared interpolation table from
+        `utils.luminosity_distance_mpc`, so this is cheap to call repeatedly.
         """
-        return self.dist.to(u.Mpc).value
+        from utils import luminosity_distance_mpc
+
+        return luminosity_distance_mpc(self.zdist, 'WMAP7')
 
     @property
     def disterrmpc(self):
         """
-        `disterr` in Mpc (for backwards-compatibility)
+        `disterr` in Mpc
         """
-        return self.disterr.to(u.Mpc).value
+        from utils import luminosity_distance_mpc
+
+        dist, distp, distm = luminosity_distance_mpc([self.zdist,
+                                                      self.zdist + self.zdisterr,
+                                                      self.zdist - self.zdisterr], 'WMAP7')
+        return (abs(dist - distp) + abs(dist - distm)) / 2
 
     @property
     def distmod(self):
@@ -234,6 +292,28 @@ class NSAHost(object):
         """
         return SkyCoord(self.ra*u.deg, self.dec*u.deg, frame='icrs')
 
+    @property
+    def l(self):
+        """
+        Galactic longitude in degrees of the host
+        """
+        return self._galactic_coords[0]
+
+    @property
+    def b(self):
+        """
+        Galactic latitude in degrees of the host
+        """
+        return self._galactic_coords[1]
+
+    @property
+    def _galactic_coords(self):
+        # the frame transform is slow enough that it is only done on demand
+        if getattr(self, '_cached_galactic', None) is None:
+            galcoord = self.coords.galactic
+            self._cached_galactic = (galcoord.l.degree, galcoord.b.degree)
+        return self._cached_galactic
+
     @property
     def shortname(self):
         if self._shortname is None:
@@ -275,8 +355,9 @@ class NSAHost(object):
         return np.radians(angle) * 1000 * self.distmpc * u.kpc
 
     def sdss_environs_query(self, dl=False, usecas=False, magcut=None,
-                            inclphotzs=True, applyphotflags=False,
-                            xmatchwise=False, usepost=False):
+                            inclphotzs=None, applyphotflags=False,
+                            xmatchwise=False, usepost=False, stream=False,
+                            tiles=None, maxconnections=4, columns='full'):
         """
         Constructs an SDSS query to get the SDSS objects around this
         host and possibly downloads the catalog.
@@ -297,8 +378,9 @@ class NSAHost(object):
         magcut : float or None
             `magcut` as accepted by `construct_sdss_query` or
             None to use `self.sdssquerymagcut`
-        inclphotzs : bool
-            If True, includes a further join to add phot-zs where present
+        inclphotzs : bool or None
+            If True, includes a further join to add phot-zs where present.
+            If None, this is done only if `columns` is 'full'.
         applyphotflags : bool
             If True, adds photometry flags to the query (See
             `construct_sdss_query` for exact flags)
@@ -307,12 +389,29 @@ class NSAHost(object):
             mags.
         usepost : bool
             If False, uses GET, otherwise POST
+        stream : bool
+            If True (and `dl` is True), the catalog is parsed as it downloads
+            (see `stream_sdss_query`) and reprocessed straight away, rather
+            than being re-read from `fnsdss` later.  The binary cache is
+            written too, if `USE_CATALOG_CACHE` is True.
+        tiles : int or None
+            The (approximate) number of tiles to split the download into (see
+            `download_tiled_sdss_query`).  If None, this is decided from the
+            environs area and `SDSS_MAX_TILE_AREA`, so only big environs get
+            split up.  1 means never split.
+        maxconnections : int
+            The maximum number of tiles to download at once
+        columns : str or list of str
+            The columns to get (see `construct_sdss_query`) - e.g.
+            'positions' for a much smaller catalog with just positions and
+            g/r magnitudes.
 
         Returns
         -------
-        query : str
-            The SQL query if `dl` is False.  Otherwise, `None` is
-            returned.
+        query : str or astropy.table.Table
+            The SQL query if `dl` is False.  If `dl` and `stream` are True,
+            the reprocessed catalog (the same thing `get_sdss_catalog` will
+            now return).  Otherwise, `None` is returned.
 
         Raises
         ------
@@ -330,7 +429,7 @@ class NSAHost(object):
         query = construct_sdss_query(self.ra, self.dec, raddeg,
             into=('{0}_environs'.format(intoname)) if usecas else None,
             magcut=magcut, inclphotzs=inclphotzs, applyphotflags=applyphotflags,
-            xmatchwise=xmatchwise)
+            xmatchwise=xmatchwise, columns=columns)
 
         if dl:
             altfns = [self.fnsdss]
@@ -344,12 +443,37 @@ class NSAHost(object):
                         break
             else:
                 msg = 'Downloading NSA ID{0} to {1}'.format(self.nsaid, self.fnsdss)
-                download_sdss_query(query, fn=self.fnsdss, dlmsg=msg, usepost=usepost,
-                    inclheader='Environs of NSA Object {0}'.format(self.nsaid))
+                inclheader = 'Environs of NSA Object {0}'.format(self.nsaid)
+                if tiles is None:
+                    tiles = sdss_tiles_needed(raddeg)
+                if tiles > 1:
+                    print(msg, 'in', tiles, 'tiles')
+                    tab = download_tiled_sdss_query(self.ra, self.dec, raddeg,
+                        tiles, fn=self.fnsdss, maxconnections=maxconnections,
+                        usepost=usepost, inclheader=inclheader, magcut=magcut,
+                        inclphotzs=inclphotzs, applyphotflags=applyphotflags,
+                        xmatchwise=xmatchwise, columns=columns)
+                    if stream:
+                        tab = self._reprocess_sdss_table(tab)
+                        if USE_CATALOG_CACHE:
+                            self._write_sdss_cache(tab, self.fnsdss)
+                        self._cached_sdss = tab
+                        return tab
+                elif stream:
+                    tab = stream_sdss_query(query, fn=self.fnsdss, dlmsg=msg,
+                                            usepost=usepost, inclheader=inclheader)
+                    tab = self._reprocess_sdss_table(tab)
+                    if USE_CATALOG_CACHE:
+                        self._write_sdss_cache(tab, self.fnsdss)
+                    self._cached_sdss = tab
+                    return tab
+                else:
+                    download_sdss_query(query, fn=self.fnsdss, dlmsg=msg,
+                                        usepost=usepost, inclheader=inclheader)
         else:
             return query
 
-    def usnob_environs_query(self, dl=False):
+    def usnob_environs_query(self, dl=False, votable=False):
         """
         Constructs a query to get USNO-B objects around this host, and
         possibly downloads the catalog.
@@ -362,13 +486,17 @@ class NSAHost(object):
         ----------
         dl : bool
             If True, download the catalog
+        votable : bool
+            If True, get the VOTable version of the catalog instead of the ASCII
+            one.  `get_usnob_catalog` can read either.
 
         """
         from os.path import exists
 
         raddeg = self.environsarcmin / 60.
 
-        usnourl = construct_usnob_query(self.ra, self.dec, raddeg, verbosity=1)
+        usnourl = construct_usnob_query(self.ra, self.dec, raddeg, verbosity=1,
+                                        votable=votable)
 
         if dl:
             altfns = [self.fnusnob]
@@ -393,14 +521,19 @@ class NSAHost(object):
         Loads and retrieves the data for the USNO-B catalog associated with this
         host.
 
+        Loaded catalogs are kept in the process-wide catalog cache (see
+        `catalogcache.memory_cache`), which drops the least recently used
+        catalogs once they take up more than `catalogcache.MEMORY_BUDGET`.
+
         Returns
         -------
         cat : astropy.table.Table
             The USNO-B catalog
         """
-        if getattr(self, '_cached_usnob', None) is None:
+        from catalogcache import memory_cache
+
+        def loader():
             from os.path import exists
-            from astropy.io import ascii
 
             if exists(self.fnusnob):
                 fn = self.fnusnob
@@ -413,21 +546,9 @@ class NSAHost(object):
                     #didn't find one
                     raise IOError('Could not find file {0} nor any of {1}'.format(self.altfnusnob, self.altfnusnob))
 
-            with open(fn) as f:
-                for l in f:
-                    if l.startswith('#1') and 'id' in l:
-                        colnames = [nm.strip() for nm in l.replace('#1', '').split('|') if nm.strip() != '']
-                        #now if there's a group of "S/G" columns, add the appropriate mag suffix
-                        for i in range(len(colnames)):
-                            if colnames[i] == 'S/G':
-                                colnames[i] = colnames[i] + '_' + colnames[i - 1]
-                        break
-                else:
-                    raise ValueError('USNO-B catalog does not have header - wrong format?')
-
-            self._cached_usnob = ascii.read(fn, names=colnames, guess=False, Reader=ascii.NoHeader)
+            return load_usnob_catalog(fn)
 
-        return self._cached_usnob
+        return memory_cache().get(self._catalog_cache_key('usnob'), loader)
 
     def get_sdss_catalog(self):
         """
@@ -437,14 +558,33 @@ class NSAHost(object):
         Note that this automatically converts all-upper tables to "mixed-case"
         for backwards-compatibility.
 
+        If `USE_SKY_STORE` is True and the sky store (see `skystore`)
+        completely covers this host's environs, the catalog comes from the
+        store instead of `fnsdss`, so hosts without their own download (or
+        with a bigger `environsarcmin` than when they were downloaded) don't
+        need a new one.
+
+        Loaded catalogs are kept in the process-wide catalog cache (see
+        `catalogcache.memory_cache`), which drops the least recently used
+        catalogs once they take up more than `catalogcache.MEMORY_BUDGET`.
+
         Returns
         -------
         cat : astropy.table.Table
             The SDSS catalog
         """
-        from os.path import exists
+        from catalogcache import memory_cache
+
+        def loader():
+            from os.path import exists
+
+            if USE_SKY_STORE:
+                from skystore import get_sky_store
 
-        if getattr(self, '_cached_sdss', None) is None:
+                store = get_sky_store()
+                raddeg = self.environsarcmin / 60.
+                if store.covers(self.ra, self.dec, raddeg, self.sdssquerymagcut):
+                    return self._reprocess_sdss_table(store.cone(self.ra, self.dec, raddeg))
 
             if exists(self.fnsdss):
                 fn = self.fnsdss
@@ -456,8 +596,45 @@ class NSAHost(object):
                 else:
                     #didn't find one
                     raise IOError('Could not find file {0} nor any of {1}'.format(self.fnsdss, self.altfnsdss))
-            self._cached_sdss = self.load_and_reprocess_sdss_catalog(fn)
-        return self._cached_sdss
+            return self.load_and_reprocess_sdss_catalog(fn)
+
+        return memory_cache().get(self._catalog_cache_key('sdss'), loader)
+
+    def _catalog_cache_key(self, kind):
+        if kind == 'sdss':
+            # the compact and full forms are different catalogs
+            return (kind, self.nsaid, self.fnsdss, bool(COMPACT_CATALOGS))
+        return (kind, self.nsaid, self.fnusnob)
+
+    # These used to be plain attributes, so setting them to None (to free the
+    # memory) or to a catalog still works, but goes through the catalog cache.
+    @property
+    def _cached_sdss(self):
+        from catalogcache import memory_cache
+        return memory_cache().peek(self._catalog_cache_key('sdss'))
+
+    @_cached_sdss.setter
+    def _cached_sdss(self, value):
+        from catalogcache import memory_cache
+
+        if value is None:
+            memory_cache().discard(self._catalog_cache_key('sdss'))
+        else:
+            memory_cache().put(self._catalog_cache_key('sdss'), value)
+
+    @property
+    def _cached_usnob(self):
+        from catalogcache import memory_cache
+        return memory_cache().peek(self._catalog_cache_key('usnob'))
+
+    @_cached_usnob.setter
+    def _cached_usnob(self, value):
+        from catalogcache import memory_cache
+
+        if value is None:
+            memory_cache().discard(self._catalog_cache_key('usnob'))
+        else:
+            memory_cache().put(self._catalog_cache_key('usnob'), value)
 
 
     catalog_cases_to_convert = ['ra', 'dec', 'rhost', 'type', 'phot_sg', 'rhost_kpc', 'objID']
@@ -473,43 +650,87 @@ class NSAHost(object):
     del band, catalog_cases_to_convert # clean up the namespace
 
 
-    def load_and_reprocess_sdss_catalog(self, fn):
-        from astropy.io import ascii, fits
-        from astropy.table import Table, Column, MaskedColumn
-        from astropy.coordinates import SkyCoord
+    def load_and_reprocess_sdss_catalog(self, fn, usecache=None, compact=None):
+        """
+        Loads the SDSS catalog in `fn` and adds the derived columns (UBVRI,
+        `rhost`, etc.).
 
-        if '.fits' in fn:
-            tab = Table(fits.getdata(fn))
-        else:
-            tab = ascii.read(fn, delimiter=',')
+        The reprocessed table is kept in a binary cache next to `fn` (see
+        `catalogcache`), so later loads just memory-map it.  The cache is
+        rebuilt if `fn` changes, if `SDSS_REPROCESS_VERSION` changes, or if
+        the host position/distance (which `rhost` depends on) changes.
+
+        Parameters
+        ----------
+        fn : str
+            The file to load
+        usecache : bool or None
+            Whether to use the binary cache, or None to use the module-level
+            `USE_CATALOG_CACHE`
+        compact : bool or None
+            Whether to convert the catalog to the compact form (see
+            `compact_sdss_catalog`), or None to use the module-level
+            `COMPACT_CATALOGS`
+
+        Returns
+        -------
+        cat : astropy.table.Table
+            The SDSS catalog
+        """
+        from catalogcache import load_with_cache
+
+        if usecache is None:
+            usecache = USE_CATALOG_CACHE
+        if compact is None:
+            compact = COMPACT_CATALOGS
+
+        def loader(fn):
+            return self._reprocess_sdss_catalog(fn, compact)
+
+        return load_with_cache(fn, loader, SDSS_REPROCESS_VERSION,
+                               self._sdss_cache_extra(compact), usecache,
+                               postload=self._make_sdss_catalog)
+
+    def _sdss_cache_extra(self, compact=None):
+        # the reprocessed catalog depends on these through `rhost`
+        extra = {'ra': float(self.ra), 'dec': float(self.dec),
+                 'distmpc': float(self.distmpc)}
+        if COMPACT_CATALOGS if compact is None else compact:
+            extra['compact'] = True
+        return extra
+
+    def _write_sdss_cache(self, tab, fn, compact=None):
+        from catalogcache import write_table_cache
+
+        try:
+            write_table_cache(tab, fn, SDSS_REPROCESS_VERSION,
+                              self._sdss_cache_extra(compact))
+        except (IOError, OSError) as e:
+            print('Could not write catalog cache for "{0}": {1}'.format(fn, e))
+
+    def _reprocess_sdss_catalog(self, fn, compact=None):
+        return self._reprocess_sdss_table(read_sdss_file(fn), compact)
+
+    def _reprocess_sdss_table(self, tab, compact=None):
+        """
+        Does the parts of the reprocessing that have to happen up front, and
+        returns an `SDSSCatalog` with the derived columns set up to be
+        computed when they are needed.  If `compact` is True (or None and
+        `COMPACT_CATALOGS` is True), the result is also passed through
+        `compact_sdss_catalog`.
+        """
+        from astropy.table import Column, MaskedColumn
+
+        tab = SDSSCatalog(tab, copy=False)
 
         # if any of the upper-case versions are present, create mixed-case aliases
         for real, alias in self.catalog_aliases.items():
             if real in tab.colnames and alias not in tab.colnames:
-                tab[alias] = tab[real]
-
-        # add UBVRI converted from SDSS mags
-        U, B, V, R, I = sdss_to_UBVRI(*[tab[b] for b in 'ugriz'])
-        for b in 'UBVRI':
-            dat = locals()[b]
-            colcls = MaskedColumn if hasattr(dat, 'mask') else Column
-            tab.add_column(colcls(name=b, data=dat))
-
-        if 'psf_u' in tab.colnames:
-            pU, pB, pV, pR, pI = sdss_to_UBVRI(*[tab['psf_' + b] for b in 'ugriz'])
-            for b in 'UBVRI':
-                dat = locals()['p' + b]
-                colcls = MaskedColumn if hasattr(dat, 'mask') else Column
-                tab.add_column(colcls(name='psf_' + b, data=dat))
-
-        if 'rhost' not in tab.colnames:
-            tabsc = SkyCoord(u.Quantity(tab['ra'], u.deg), u.Quantity(tab['dec'], u.deg))
-            rhost = self.coords.separation(tabsc).degree
-            colcls = MaskedColumn if hasattr(rhost, 'mask') else Column
-            tab.add_column(colcls(name='rhost', data=rhost))
-            tab.add_column(colcls(name='rhost_kpc', data=np.radians(rhost)*self.distmpc*1000))
+                tab.add_alias(alias, real)
 
-        if 'type' not in tab.colnames or 'phot_sg' not in tab.colnames:
+        if 'type' not in tab.colnames and 'phot_sg' not in tab.colnames:
+            pass  # a reduced-column catalog (see `construct_sdss_query`)
+        elif 'type' not in tab.colnames or 'phot_sg' not in tab.colnames:
             # some catalogs had 'phot_sg' as an *integer* 3/6
             if 'phot_sg' in tab.colnames and tab['phot_sg'].dtype.kind == 'i':
                 typeint = tab['phot_sg']
@@ -523,13 +744,54 @@ class NSAHost(object):
             sgstr = np.zeros(len(tab), dtype='S6')
             sgstr[typeint == 3] = 'GALAXY'
             sgstr[typeint == 6] = 'STAR'
+            colcls = MaskedColumn if hasattr(typeint, 'mask') else Column
             tab.add_column(colcls(name='type', data=typeint))
             tab.add_column(colcls(name='phot_sg', data=sgstr))
 
-        tab['coord'] = SkyCoord(tab['ra']*u.deg, tab['dec']*u.deg)
+        if COMPACT_CATALOGS if compact is None else compact:
+            tab = compact_sdss_catalog(tab)
+
+        return self._make_sdss_catalog(tab)
+
+    def _make_sdss_catalog(self, tab):
+        """
+        Registers the derived (lazy) columns on `tab`.  This is also what
+        re-creates them for catalogs loaded from the binary cache, which only
+        has the columns that were actually in the file.
+        """
+        if not isinstance(tab, SDSSCatalog):
+            tab = SDSSCatalog(tab, copy=False)
+
+        # UBVRI converted from SDSS mags - reduced-column catalogs (see
+        # `construct_sdss_query`) may not have all the bands
+        if all([b in tab.colnames for b in 'ugriz']):
+            for i, b in enumerate('UBVRI'):
+                tab.add_lazy_column(b, _SDSSUBVRIColumn('', i))
+        if all([('psf_' + b) in tab.colnames for b in 'ugriz']):
+            for i, b in enumerate('UBVRI'):
+                tab.add_lazy_column('psf_' + b, _SDSSUBVRIColumn('psf_', i))
+
+        if 'rhost' not in tab.colnames:
+            tab.add_lazy_column('rhost', self._sdss_rhost)
+            tab.add_lazy_column('rhost_kpc', self._sdss_rhost_kpc)
+
+        # string views of the categorical columns of compact catalogs
+        for nm in tab.colnames:
+            if nm.endswith('_code') and 'categories' in tab[nm].meta:
+                tab.add_lazy_column(nm[:-5], _SDSSCategoricalColumn(nm))
 
+        tab.add_lazy_column('coord', _sdss_coord_column)
         return tab
 
+    def _sdss_rhost(self, tab):
+        from utils import angular_separation_deg
+
+        return angular_separation_deg(self.ra, self.dec, np.asarray(tab['ra']),
+                                      np.asarray(tab['dec']))
+
+    def _sdss_rhost_kpc(self, tab):
+        return np.radians(tab['rhost'])*self.distmpc*1000
+
 
     def open_on_nsasite(self):
         """
@@ -624,15 +886,326 @@ class NSAHost(object):
             return res.content
 
     def within_environs(self, scorcat):
+        """
+        Finds which of the given positions are inside this host's environs.
+
+        Parameters
+        ----------
+        scorcat : SkyCoord or table
+            The positions - either a `SkyCoord`, or a table with 'ra'/'dec'
+            (or 'RA'/'DEC') columns in degrees, or anything else
+            `SkyCoord.guess_from_table` understands.
+
+        Returns
+        -------
+        msk : bool array
+            True for the positions within `environsarcmin` of the host
+        """
+        from utils import angular_separation_deg
+
         if isinstance(scorcat, SkyCoord):
-            sc = scorcat
+            icrs = scorcat.icrs
+            ra, dec = icrs.ra.degree, icrs.dec.degree
         else:
-            try:
-                sc = SkyCoord.guess_from_table(scorcat)
-            except u.UnitsError:
-                sc = SkyCoord.guess_from_table(scorcat, unit=u.deg)
+            colnames = getattr(scorcat, 'colnames', ())
+            for rastr, decstr in (('ra', 'dec'), ('RA', 'DEC')):
+                if rastr in colnames and decstr in colnames:
+                    ra, dec = np.asarray(scorcat[rastr]), np.asarray(scorcat[decstr])
+                    break
+            else:
+                try:
+                    sc = SkyCoord.guess_from_table(scorcat)
+                except u.UnitsError:
+                    sc = SkyCoord.guess_from_table(scorcat, unit=u.deg)
+                ra, dec = sc.icrs.ra.degree, sc.icrs.dec.degree
+
+        return angular_separation_deg(self.ra, self.dec, ra, dec) < self.environsarcmin / 60.
+
+
+class HostCatalog(object):
+    """
+    A columnar catalog of many NSA hosts, with the NSA quantities and
+    derived distances stored as arrays so they can be computed for every
+    host at once.
+
+    Individual hosts are available as `NSAHost` objects by indexing with an
+    integer or any of the host's names (``cat['Odyssey']``, ``cat['NSA147100']``,
+    ...).  These are created on first access (without going back to the NSA)
+    and then reused.  Indexing with a slice or a boolean/integer array gives a
+    new `HostCatalog` with just those hosts.
+
+    Parameters
+    ----------
+    nsaids : array of ints
+        The NSA ID#s of the hosts
+    names : sequence or None
+        A name (or list of names, as accepted by `NSAHost`) for each host, or
+        None to use "NSA###" for all of them.
+    environsradius : Quantity or array Quantity
+        The environs radius for all hosts, or one per host.  Can be given as an
+        angle or as a physical distance.
+    nsastore : NSAStore or None
+        The NSA store to get the host data from, or None to use
+        `get_nsa_store`.
+
+    Attributes
+    ----------
+    nsaid, nsaindx, ra, dec, zdist, zdisterr, zspec, mstar : arrays
+        The same as the `NSAHost` attributes of the same names, one element per
+        host.
+    absmag : array
+        The NSA 'ABSMAG' for each host, shape ``(n, 7)`` in 'FNugriz' order.
+    environsarcmin : array
+        The environs radius of each host in arcmin
+    """
+    def __init__(self, nsaids, names=None, environsradius=300*u.kpc,
+                 nsastore=None):
+        if nsastore is None:
+            nsastore = get_nsa_store()
+
+        self.nsaid = np.array(nsaids, dtype=int).ravel()
+        self.nsaindx = np.atleast_1d(nsastore.nsaid_to_index(self.nsaid))
+
+        # sorting the rows makes the reads from the memory-mapped store sequential
+        order = np.argsort(self.nsaindx)
+        rows = self.nsaindx[order]
+        cols = {}
+        for nm in NSAHost._nsa_columns_used:
+            col = np.empty((len(rows),) + nsastore[nm].shape[1:], dtype=nsastore[nm].dtype)
+            col[order] = nsastore[nm][rows]
+            cols[nm] = col
+
+        self.ra = cols['RA']
+        self.dec = cols['DEC']
+        self.zdist = cols['ZDIST']
+        self.zdisterr = cols['ZDIST_ERR']
+        self.zspec = cols['Z']
+        self.mstar = cols['MASS']
+        self.absmag = cols['ABSMAG']
+
+        if names is None:
+            names = [None] * len(self.nsaid)
+        elif len(names) != len(self.nsaid):
+            raise ValueError('names must match the length of nsaids')
+        self._names = []
+        self.altnames = []
+        for nsaid, nm in zip(self.nsaid, names):
+            nsaname = 'NSA{0}'.format(nsaid)
+            if nm is None:
+                self._names.append(nsaname)
+                self.altnames.append([])
+            elif isinstance(nm, six.string_types):
+                self._names.append(nm)
+                self.altnames.append([nsaname])
+            else:
+                self._names.append(nm[0])
+                alts = list(nm[1:])
+                if nsaname not in alts:
+                    alts.append(nsaname)
+                self.altnames.append(alts)
+
+        self._derived = {}
+        self.environsarcmin = self._environs_to_arcmin(environsradius)
+
+        self._hosts = {}
+        self._hostattrs = {}  # extra attributes to set on the `NSAHost` objects
+        self._build_name_index()
+
+    @classmethod
+    def from_hosts(cls, hosts, nsastore=None):
+        """
+        Creates a `HostCatalog` from a sequence of `NSAHost` objects, keeping
+        their names and environs radii.
+        """
+        hosts = list(hosts)
+        names = [[h.name] + list(h.altnames) for h in hosts]
+        environs = np.array([h.environsarcmin for h in hosts]) * u.arcmin
+        cat = cls([h.nsaid for h in hosts], names, environs, nsastore)
+        for i, h in enumerate(hosts):
+            cat._hosts[i] = h
+        return cat
+
+    def _environs_to_arcmin(self, environsradius):
+        if hasattr(environsradius, 'unit') and environsradius.unit.is_equivalent(u.kpc):
+            environskpc = environsradius.to(u.kpc).value
+            arcmin = np.degrees(environskpc / (1000 * self.distmpc)) * 60.
+        elif hasattr(environsradius, 'unit') and environsradius.unit.is_equivalent(u.arcmin):
+            arcmin = environsradius.to(u.arcmin).value
+        else:  # pre-Quantity behavior: positive is kpc, negative is arcmin
+            environsradius = np.asarray(environsradius, dtype=float)
+            arcmin = np.where(environsradius > 0,
+                              np.degrees(environsradius / (1000 * self.distmpc)) * 60.,
+                              -environsradius)
+        return np.array(np.broadcast_to(arcmin, self.nsaid.shape), dtype=float)
+
+    def _build_name_index(self):
+        self._nameidx = {}
+        for i, (nm, alts) in enumerate(zip(self._names, self.altnames)):
+            for alias in [nm] + alts:
+                # the first host with a given name wins, like `load_all_hosts`
+                self._nameidx.setdefault(alias, i)
+
+    def __len__(self):
+        return len(self.nsaid)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.host(i)
+
+    def __contains__(self, name):
+        return name in self._nameidx
+
+    def __getitem__(self, key):
+        if isinstance(key, six.string_types):
+            return self.host(self.index_of(key))
+        elif isinstance(key, six.integer_types + (np.integer,)):
+            return self.host(key)
+        else:
+            return self._subset(key)
 
-        return sc.separation(self.coords) < self.environsarcmin * u.arcmin
+    def index_of(self, name):
+        """
+        Returns the index of the host with the given name or alternate name.
+
+        Raises
+        ------
+        KeyError
+            If no host has that name
+        """
+        if name not in self._nameidx:
+            raise KeyError('No host named "{0}" in this catalog'.format(name))
+        return self._nameidx[name]
+
+    @property
+    def names(self):
+        """
+        The (primary) name of each host
+        """
+        return list(self._names)
+
+    def host(self, i):
+        """
+        Returns the `NSAHost` for the ``i``th host.  Repeated calls return the
+        same object.
+        """
+        if i < 0:
+            i += len(self)
+        if i not in self._hosts:
+            h = NSAHost.__new__(NSAHost)
+            obj = {'RA': self.ra[i], 'DEC': self.dec[i], 'ZDIST': self.zdist[i],
+                   'ZDIST_ERR': self.zdisterr[i], 'Z': self.zspec[i],
+                   'MASS': self.mstar[i], 'ABSMAG': self.absmag[i]}
+            # no alternate names means the name is just the default "NSA###"
+            names = [self._names[i]] + list(self.altnames[i]) if self.altnames[i] else None
+            h._populate(self.nsaid[i], self.nsaindx[i], obj, names,
+                        self.environsarcmin[i] * u.arcmin, None, None, None)
+            for attr, val in self._hostattrs.get(i, {}).items():
+                setattr(h, attr, val)
+            self._hosts[i] = h
+        return self._hosts[i]
+
+    def _subset(self, key):
+        idx = np.arange(len(self))[key]
+        new = HostCatalog.__new__(HostCatalog)
+        for attr in ('nsaid', 'nsaindx', 'ra', 'dec', 'zdist', 'zdisterr',
+                     'zspec', 'mstar', 'absmag', 'environsarcmin'):
+            setattr(new, attr, getattr(self, attr)[idx])
+        new._names = [self._names[i] for i in idx]
+        new.altnames = [self.altnames[i] for i in idx]
+        new._derived = dict([(k, v[idx]) for k, v in self._derived.items()])
+        new._hosts = dict([(j, self._hosts[i]) for j, i in enumerate(idx) if i in self._hosts])
+        new._hostattrs = dict([(j, self._hostattrs[i]) for j, i in enumerate(idx) if i in self._hostattrs])
+        new._build_name_index()
+        return new
+
+    @property
+    def distmpc(self):
+        """
+        Distance to each host in Mpc (given WMAP7 cosmology/H0)
+        """
+        if 'distmpc' not in self._derived:
+            from utils import luminosity_distance_mpc
+
+            self._derived['distmpc'] = luminosity_distance_mpc(self.zdist, 'WMAP7')
+        return self._derived['distmpc']
+
+    @property
+    def dist(self):
+        """
+        Distance to each host (given WMAP7 cosmology/H0)
+        """
+        return self.distmpc * u.Mpc
+
+    @property
+    def distmod(self):
+        """
+        Distance modulus (mags) of each host
+        """
+        return 5 * np.log10(self.distmpc * 100000)
+
+    @property
+    def environskpc(self):
+        """
+        The environs radius of each host in kpc
+        """
+        return np.radians(self.environsarcmin / 60.) * self.distmpc * 1000
+
+    @property
+    def coords(self):
+        """
+        The hosts' coordinates as an ICRS `SkyCoord` object.
+        """
+        return SkyCoord(self.ra*u.deg, self.dec*u.deg, frame='icrs')
+
+    @property
+    def l(self):
+        """
+        Galactic longitude in degrees of each host
+        """
+        if 'l' not in self._derived:
+            galcoords = self.coords.galactic
+            self._derived['l'] = galcoords.l.degree
+            self._derived['b'] = galcoords.b.degree
+        return self._derived['l']
+
+    @property
+    def b(self):
+        """
+        Galactic latitude in degrees of each host
+        """
+        self.l  # computes both
+        return self._derived['b']
+
+    def physical_to_projected(self, dist):
+        """
+        Returns the angular distance (in arcmin) for every host given a
+        projected physical distance (either one for all hosts or one per
+        host). `dist` must be a Quantity.
+        E.g., ``physical_to_projected(300*u.kpc)``
+        """
+        if u.kpc.is_equivalent(dist):
+            dist = dist.to(u.Mpc).value
+        else:
+            raise ValueError('need to give physical_to_projected a Quantity.')
+
+        return np.degrees(dist / self.distmpc) * 60 * u.arcmin
+
+    def projected_to_physical(self, angle):
+        """
+        Returns the projected physical distance (in kpc) for every host given
+        an angular distance (either one for all hosts or one per host).
+        `angle` must be a Quantity.
+        E.g., ``projected_to_physical(30*u.arcmin)``
+        """
+        if u.degree.is_equivalent(angle):
+            angle = angle.to(u.degree).value
+        else:
+            raise ValueError('need to give projected_to_physical a Quantity.')
+
+        return np.radians(angle) * 1000 * self.distmpc * u.kpc
+
+    def __repr__(self):
+        return '<HostCatalog with {0} hosts>'.format(len(self))
 
 
 def download_with_progress_updates(u, fw, nreports=100, msg=None, outstream=sys.stdout):
@@ -690,99 +1263,1085 @@ def download_with_progress_updates(u, fw, nreports=100, msg=None, outstream=sys.
         fw.write(end)
 
 
-def load_all_hosts(hostsfile='hosts.dat', existinghosts='globals', usedlgname=False, keyonname=False):
-    """
-    Loads all the hosts in the specified host file and resturns them
-    as a dictionary.
-
-    If `existinghosts` is 'globals', it will be taken from from the global
-    variable named 'hosts' if it exists.  Otherwise it is a list with all
-    the existing NSA hosts
+def download_large_file(url, fn, nconnections=4, chunksize=2**23,
+                        checksum=None, nretries=3, backoff=2., timeout=120,
+                        msg=None, outstream=sys.stdout):
     """
-    d = {}
-
-    if existinghosts == 'globals':
-        existinghosts = globals().get('hosts', None)
-
-    ids = []
-    if existinghosts is not None:
-        for h in existinghosts:
-            if isinstance(h, NSAHost):
-                ids.append(h.nsaid)
-
-    i = 1
-    with open(hostsfile) as f:
-        f.readline()  # header
-        for l in f:
-            while i in ids:
-                i += 1
-            nsanum, ra, dec, z = l.split()
-            nsanum = int(nsanum)
-            hnm = 'h' + str(i)
-            d[hnm] = NSAHost(nsanum, 'DLG' + str(i) if usedlgname else None)
-            if keyonname:
-                h = d[hnm]
-                d[h.name] = h
-                del d[hnm]
-            i += 1
-
-    return d
-
+    Downloads a (large) file in parallel chunks using HTTP Range requests.
 
-_cachednsa={}
-def get_nsa(fn=None):
-    """
-    Download the NASA Sloan Atlas if it hasn't been already, open it, and
-    return the data.
+    The content goes into ``fn + '.part'``, with the chunks completed so far
+    recorded in ``fn + '.part.json'``, so an interrupted download picks up
+    where it left off when this is called again.  Only when every chunk is
+    present and the size (and `checksum`, if given) is right is the file
+    renamed to `fn`, so a truncated download can never be mistaken for the
+    real file.  If the server doesn't support Range requests, this falls back
+    to a single sequential (but still atomic) download.
 
     Parameters
     ----------
-    fn : str or None
-        The name of the file to load (or to save as if its not present).  If
-        None, the convention from the NSA web site will be used.
+    url : str
+        The URL to download
+    fn : str
+        The file name to save to
+    nconnections : int
+        The maximum number of chunks to download at once
+    chunksize : int
+        The size of each chunk in bytes
+    checksum : 2-tuple or None
+        ``(algorithm, hexdigest)`` where `algorithm` is any name `hashlib`
+        understands (e.g. ``('md5', '...')``).  If None, only the size is
+        checked.
+    nretries : int
+        How many times to retry each chunk
+    backoff : float
+        The wait before the first retry in seconds.  It doubles for each
+        subsequent retry.
+    timeout : float
+        The timeout in seconds for each request
+    msg : str or None
+        A message to print when the download starts or None for no message
+    outstream : file-like
+        The stream to write the updates to
 
     Returns
     -------
-    nsadata
-        The data as an `astropy.io.fits` record array.
+    fn : str
+        The file name that was downloaded to
     """
-    import os
+    import json
+    import time
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
 
-    from astropy.io import fits
-    from hosts import download_with_progress_updates
+    partfn = fn + '.part'
+    progfn = fn + '.part.json'
 
-    if fn is None:
-        fn = NSAFILENAME
+    size, rangeok = _probe_download_size(url, timeout)
 
-    if fn in _cachednsa:
-        if TELL_IF_USING_CACHED:
-            print('Using cached NSA for file', fn)
-        return _cachednsa[fn]
+    if msg is not None:
+        outstream.write(msg)
+        if size is None:
+            outstream.write('\nUnknown Size\n')
+        else:
+            outstream.write('\nSize: {0} kB\n'.format(size / 1024.))
+        outstream.flush()
 
-    if os.path.exists(fn):
-        if TELL_IF_USING_CACHED:
-            print('Loading NSA from local file', fn)
+    if size is None or not rangeok:
+        # no way to do it in pieces, so just stream the whole thing
+        u = urlopen(url, timeout=timeout)
+        try:
+            with open(partfn, 'wb') as fw:
+                download_with_progress_updates(u, fw, outstream=outstream)
+        finally:
+            u.close()
+    else:
+        nchunks = max(1, (size + chunksize - 1) // chunksize)
+
+        done = set()
+        if os.path.exists(partfn) and os.path.exists(progfn):
+            with open(progfn) as f:
+                prog = json.load(f)
+            if (prog['url'] == url and prog['size'] == size and
+                    prog['chunksize'] == chunksize and
+                    os.path.getsize(partfn) == size):
+                done = set(prog['done'])
+        if not done:
+            with open(partfn, 'wb') as fw:
+                fw.truncate(size)
+
+        lock = threading.Lock()
+
+        def save_progress():
+            with open(progfn + '.tmp', 'w') as f:
+                json.dump({'url': url, 'size': size, 'chunksize': chunksize,
+                           'done': sorted(done)}, f)
+            os.rename(progfn + '.tmp', progfn)
+
+        def get_chunk(i):
+            start = i * chunksize
+            end = min(start + chunksize, size) - 1
+            for attempt in range(nretries + 1):
+                try:
+                    data = _download_range(url, start, end, timeout)
+                    break
+                except Exception:
+                    if attempt == nretries:
+                        raise
+                    time.sleep(backoff * 2**attempt)
+            with lock:
+                with open(partfn, 'r+b') as fw:
+                    fw.seek(start)
+                    fw.write(data)
+                done.add(i)
+                save_progress()
+                outstream.write('\r{0:.0f}%'.format(len(done) * 100 / nchunks))
+                outstream.flush()
+
+        todo = [i for i in range(nchunks) if i not in done]
+        executor = ThreadPoolExecutor(max_workers=nconnections)
+        try:
+            # list() so the first exception gets raised here
+            list(executor.map(get_chunk, todo))
+        finally:
+            executor.shutdown()
+        outstream.write('\n')
+        outstream.flush()
+
+    if size is not None and os.path.getsize(partfn) != size:
+        raise IOError('Downloaded {0} is {1} bytes instead of the expected '
+                      '{2}'.format(url, os.path.getsize(partfn), size))
+    if checksum is not None:
+        try:
+            _check_file_checksum(partfn, *checksum)
+        except IOError:
+            # resuming won't fix bad content, so start over next time
+            for badfn in (partfn, progfn):
+                if os.path.exists(badfn):
+                    os.remove(badfn)
+            raise
+
+    if os.path.exists(fn):
+        os.remove(fn)  # for windows, where rename won't overwrite
+    os.rename(partfn, fn)
+    if os.path.exists(progfn):
+        os.remove(progfn)
+
+    return fn
+
+
+def _probe_download_size(url, timeout):
+    """
+    Asks for the first byte of `url` to find out its size and whether the
+    server supports Range requests.  Returns ``(size, rangeok)``, where
+    `size` is None if it is unknown.
+    """
+    Request = six.moves.urllib.request.Request
+
+    u = urlopen(Request(url, headers={'Range': 'bytes=0-0'}), timeout=timeout)
+    try:
+        if u.getcode() == 206:
+            contentrange = u.headers.get('content-range', '')
+            # looks like "bytes 0-0/12345"
+            if '/' in contentrange and not contentrange.endswith('*'):
+                return int(contentrange.split('/')[-1]), True
+        if 'content-length' in u.headers:
+            return int(u.headers['content-length']), False
+        return None, False
+    finally:
+        u.close()
+
+
+def _download_range(url, start, end, timeout):
+    """
+    Gets bytes `start` through `end` (inclusive) of `url`.
+    """
+    Request = six.moves.urllib.request.Request
+
+    req = Request(url, headers={'Range': 'bytes={0}-{1}'.format(start, end)})
+    u = urlopen(req, timeout=timeout)
+    try:
+        if u.getcode() != 206:
+            raise IOError('Server did not honor the Range request for ' + url)
+        data = u.read()
+    finally:
+        u.close()
+
+    if len(data) != end - start + 1:
+        raise IOError('Got {0} bytes instead of {1} for bytes {2}-{3} of '
+                      '{4}'.format(len(data), end - start + 1, start, end, url))
+    return data
+
+
+def _check_file_checksum(fn, algorithm, hexdigest, blocksize=2**20):
+    import hashlib
+
+    h = hashlib.new(algorithm)
+    with open(fn, 'rb') as f:
+        buf = f.read(blocksize)
+        while buf:
+            h.update(buf)
+            buf = f.read(blocksize)
+    if h.hexdigest().lower() != hexdigest.lower():
+        raise IOError('{0} checksum of {1} is {2} instead of the expected '
+                      '{3}'.format(algorithm, fn, h.hexdigest(), hexdigest))
+
+
+class SDSSCatalogRow(Row):
+    def __getitem__(self, item):
+        if isinstance(item, six.string_types) and item not in self._table.columns:
+            self._table[item]  # computes it if it's a lazy column
+        return super(SDSSCatalogRow, self).__getitem__(item)
+
+
+class SDSSCatalog(Table):
+    """
+    A `Table` for SDSS environs catalogs, where derived columns are only
+    computed when they are first accessed.
+
+    Lazy columns are registered with `add_lazy_column` as a function that
+    takes the table and returns the column data (a function that computes
+    several columns at once can also add the others to the table itself).  They don't appear in
+    `colnames` until they have been computed (use `lazycolnames` to see
+    them), but ``cat[name]`` (or ``row[name]``) computes the column, adds it
+    to the table, and returns it.  Slices and copies of the table keep the
+    lazy columns that haven't been computed yet.
+    """
+    Row = SDSSCatalogRow
+
+    def __init__(self, *args, **kwargs):
+        lazycolumns = kwargs.pop('lazycolumns', None)
+        super(SDSSCatalog, self).__init__(*args, **kwargs)
+        if lazycolumns is None and args and isinstance(args[0], SDSSCatalog):
+            lazycolumns = args[0]._lazycolumns
+        self._lazycolumns = dict(lazycolumns or {})
+
+    def add_lazy_column(self, name, func):
+        """
+        Registers a column called `name` that is computed as ``func(self)``
+        the first time it is accessed.
+        """
+        self._lazycolumns[name] = func
+
+    def add_alias(self, name, realname):
+        """
+        Adds a column `name` that is a view of the column `realname` (so no
+        data is copied).
+        """
+        self.add_column(self[realname], name=name, copy=False)
+
+    @property
+    def lazycolnames(self):
+        """
+        The names of all columns including the lazy ones not yet computed.
+        """
+        lazy = getattr(self, '_lazycolumns', {})
+        return self.colnames + [nm for nm in lazy if nm not in self.columns]
+
+    def materialize(self, names=None):
+        """
+        Computes the lazy columns in `names` (or all of them if None).
+        """
+        for nm in (self.lazycolnames if names is None else names):
+            self[nm]
+        return self
+
+    def __getitem__(self, item):
+        if (isinstance(item, six.string_types) and item not in self.columns and
+                item in getattr(self, '_lazycolumns', {})):
+            col = self._lazycolumns[item](self)
+            # (the function may have added it already, along with others
+            # computed at the same time)
+            if item not in self.columns:
+                self.add_column(col, name=item, copy=False)
+        return super(SDSSCatalog, self).__getitem__(item)
+
+    def _new_from_slice(self, slice_):
+        table = super(SDSSCatalog, self)._new_from_slice(slice_)
+        table._lazycolumns = dict(getattr(self, '_lazycolumns', {}))
+        return table
+
+    def __getstate__(self):
+        return super(SDSSCatalog, self).__getstate__() + (self._lazycolumns,)
+
+    def __setstate__(self, state):
+        columns, meta, lazycolumns = state
+        self.__init__(columns, meta=meta, lazycolumns=lazycolumns)
+
+
+class _SDSSUBVRIColumn(object):
+    # a lazy column for `SDSSCatalog` - these are classes rather than lambdas
+    # so catalogs with lazy columns can still be pickled
+    def __init__(self, prefix, idx):
+        self.prefix = prefix
+        self.idx = idx
+
+    def __call__(self, tab):
+        # the conversion gives all five bands at once, so add them all now
+        # rather than converting again when the others are used
+        ubvri = sdss_to_UBVRI(*[tab[self.prefix + b] for b in 'ugriz'])
+        for b, col in zip('UBVRI', ubvri):
+            if self.prefix + b not in tab.columns:
+                tab.add_column(col, name=self.prefix + b, copy=False)
+        return ubvri[self.idx]
+
+
+def _sdss_coord_column(tab):
+    return SkyCoord(tab['ra']*u.deg, tab['dec']*u.deg)
+
+
+class _SDSSCategoricalColumn(object):
+    # the string view of a categorical column from `compact_sdss_catalog`
+    def __init__(self, codename):
+        self.codename = codename
+
+    def __call__(self, tab):
+        from astropy.table import Column, MaskedColumn
+
+        codecol = tab[self.codename]
+        categories = list(codecol.meta['categories'])
+        dtype = codecol.meta['dtype']
+        # the trailing '' is what the -1 (missing) codes pick out
+        values = np.array(categories + [''], dtype=dtype)[np.asarray(codecol)]
+        missing = np.asarray(codecol) < 0
+        if np.any(missing):
+            return MaskedColumn(values, mask=missing)
+        return Column(values)
+
+
+# columns `compact_sdss_catalog` leaves alone because float32 isn't enough
+SDSS_FULL_PRECISION_COLUMNS = ['ra', 'dec', 'rhost', 'rhost_kpc', 'spec_z',
+                               'spec_z_err', 'photz', 'photz_err']
+# string columns `compact_sdss_catalog` stores as categorical codes
+SDSS_CATEGORICAL_COLUMNS = ['phot_sg', 'spec_class', 'spec_subclass']
+
+
+def compact_sdss_catalog(tab):
+    """
+    Converts an SDSS catalog to a more compact in-memory form, which takes
+    about half the memory and is faster to select from:
+
+    * Floating-point columns (magnitudes, errors, extinctions, ...) are
+      converted to float32, except for positions and redshifts (the columns
+      in `SDSS_FULL_PRECISION_COLUMNS`).
+    * The string columns in `SDSS_CATEGORICAL_COLUMNS` are replaced by
+      integer codes in a column with "_code" appended to the name, with the
+      categories in the column's ``meta['categories']``.  Code -1 means the
+      value is missing (masked).  The string column is still available as a
+      lazy column of the `SDSSCatalog`, but is only re-created if used.
+    * The 'type' column is stored as int8, and 'flags' as uint64 (so all the
+      bits can be tested directly).
+
+    Parameters
+    ----------
+    tab : SDSSCatalog
+        The catalog to convert - it's modified in place.
+
+    Returns
+    -------
+    tab : SDSSCatalog
+        The same catalog
+    """
+    from astropy.table import Column, MaskedColumn
+
+    if not isinstance(tab, SDSSCatalog):
+        tab = SDSSCatalog(tab, copy=False)
+
+    # columns that are aliases of each other get converted once and stay aliases
+    converted = {}
+
+    def convert(nm, dtype, view=False):
+        col = tab[nm]
+        key = (col.__array_interface__['data'][0], col.dtype.str)
+        if key not in converted:
+            data = np.asarray(col)
+            data = data.view(dtype) if view else data.astype(dtype)
+            if isinstance(col, MaskedColumn):
+                newcol = MaskedColumn(data, mask=np.ma.getmaskarray(col),
+                                      unit=col.unit, copy=False)
+            else:
+                newcol = Column(data, unit=col.unit, copy=False)
+            converted[key] = newcol
+        tab.replace_column(nm, converted[key], copy=False)
+
+    for nm in tab.colnames:
+        col = tab[nm]
+        if not hasattr(col, 'dtype'):
+            continue  # mixin column
+        lnm = nm.lower()
+        if lnm in SDSS_CATEGORICAL_COLUMNS and col.dtype.kind in 'SU':
+            codecol = _categorical_codes(col)
+            tab.remove_column(nm)
+            tab.add_column(codecol, name=nm + '_code', copy=False)
+        elif col.dtype.kind == 'f' and col.dtype.itemsize > 4:
+            if lnm not in SDSS_FULL_PRECISION_COLUMNS:
+                convert(nm, np.float32)
+        elif lnm == 'type' and col.dtype.kind in 'iu':
+            convert(nm, np.int8)
+        elif lnm == 'flags' and col.dtype.kind == 'i' and col.dtype.itemsize == 8:
+            convert(nm, np.uint64, view=True)
+
+    return tab
+
+
+def _categorical_codes(col):
+    """
+    Converts the string column `col` to a column of integer codes, with
+    the categories (and the original string dtype) in the column ``meta``.
+    """
+    from astropy.table import Column
+
+    missing = np.ma.getmaskarray(col)
+    values = np.asarray(col)
+    categories, codes = np.unique(values[~missing], return_inverse=True)
+
+    allcodes = np.empty(len(values), dtype=np.int8 if len(categories) < 128 else np.int16)
+    allcodes.fill(-1)
+    allcodes[~missing] = codes
+
+    if values.dtype.kind == 'S':
+        categories = [c.decode('latin-1') for c in categories]
+    else:
+        categories = [six.text_type(c) for c in categories]
+    codecol = Column(allcodes, copy=False)
+    codecol.meta['categories'] = categories
+    codecol.meta['dtype'] = values.dtype.str
+    return codecol
+
+
+def read_sdss_file(fn):
+    """
+    Reads an SDSS catalog file as-is - FITS if `fn` has ".fits" in it,
+    otherwise the CSV written by `download_sdss_query`.
+
+    Returns
+    -------
+    tab : astropy.table.Table
+        The catalog, without any of the reprocessing from
+        `NSAHost.load_and_reprocess_sdss_catalog`.
+    """
+    from astropy.io import ascii, fits
+
+    if '.fits' in fn:
+        return Table(fits.getdata(fn))
+    else:
+        return ascii.read(fn, delimiter=',')
+
+
+def load_all_hosts(hostsfile='hosts.dat', existinghosts='globals', usedlgname=False, keyonname=False):
+    """
+    Loads all the hosts in the specified host file and resturns them
+    as a dictionary.
+
+    If `existinghosts` is 'globals', it will be taken from from the global
+    variable named 'hosts' if it exists.  Otherwise it is a list with all
+    the existing NSA hosts
+
+    The hosts are all looked up in the NSA at once via a `HostCatalog`, so
+    this is fast even for thousands of hosts.
+    """
+    d = {}
+
+    if existinghosts == 'globals':
+        existinghosts = globals().get('hosts', None)
+
+    ids = set()
+    if existinghosts is not None:
+        for h in existinghosts:
+            if isinstance(h, NSAHost):
+                ids.add(h.nsaid)
+
+    nsanums = []
+    with open(hostsfile) as f:
+        f.readline()  # header
+        for l in f:
+            nsanum, ra, dec, z = l.split()
+            nsanums.append(int(nsanum))
+
+    # the "h#" numbers skip over any number that is an existing host's NSAID
+    hnums = []
+    i = 1
+    for nsanum in nsanums:
+        while i in ids:
+            i += 1
+        hnums.append(i)
+        i += 1
+
+    names = ['DLG' + str(i) for i in hnums] if usedlgname else None
+    cat = HostCatalog(nsanums, names)
+
+    for j, i in enumerate(hnums):
+        h = cat.host(j)
+        if keyonname:
+            d[h.name] = h
+        else:
+            d['h' + str(i)] = h
+
+    return d
+
+
+_cachednsa={}
+_nsalock = threading.RLock()  # for both `_cachednsa` and `_cachednsastore`
+def get_nsa(fn=None):
+    """
+    Download the NASA Sloan Atlas if it hasn't been already, open it, and
+    return the data.
+
+    This is safe to call from several threads at once.
+
+    Parameters
+    ----------
+    fn : str or None
+        The name of the file to load (or to save as if its not present).  If
+        None, the convention from the NSA web site will be used.
+
+    Returns
+    -------
+    nsadata
+        The data as an `astropy.io.fits` record array.
+    """
+    from astropy.io import fits
+
+    if fn is None:
+        fn = NSAFILENAME
+
+    res = _cachednsa.get(fn)
+    if res is not None:
+        if TELL_IF_USING_CACHED:
+            print('Using cached NSA for file', fn)
+        return res
+
+    with _nsalock:
+        if fn not in _cachednsa:
+            _download_nsa_if_missing(fn)
+
+            # use pyfits from astropy to load the data
+            _cachednsa[fn] = fits.getdata(fn, 1)
+        return _cachednsa[fn]
+
+
+def _download_nsa_if_missing(fn):
+    """
+    Downloads the NSA to `fn` unless that file is already present.
+    """
+    import os
+
+    if os.path.exists(fn):
+        if TELL_IF_USING_CACHED:
+            print('Loading NSA from local file', fn)
     else:
         # download the file if it hasn't been already
         NSAurl = 'http://sdss.physics.nyu.edu/mblanton/v0/' + NSAFILENAME
 
-        with open(fn, 'w') as fw:
-            msg = 'Downloading NSA from ' + NSAurl + ' to ' + fn
-            u = urlopen(NSAurl)
-            try:
-                download_with_progress_updates(u, fw, msg=msg)
-            finally:
-                u.close()
+        msg = 'Downloading NSA from ' + NSAurl + ' to ' + fn
+        download_large_file(NSAurl, fn, msg=msg)
+
+
+class NSAStore(object):
+    """
+    A converted, on-disk version of the NSA with one memory-mapped ``.npy``
+    file per column and a prebuilt NSAID->row index.
+
+    Columns are only read from disk when they are accessed, and then only the
+    pages that are actually touched, so looking up a handful of hosts costs a
+    few kB instead of the whole catalog.  Use `convert_nsa_to_store` to
+    create a store from the NSA FITS file (or just use `get_nsa_store`, which
+    does that automatically).
+
+    Parameters
+    ----------
+    storedir : str
+        The directory the store was written to.
+
+    Attributes
+    ----------
+    storedir : str
+        The directory of the store
+    colnames : list of str
+        The names of the columns in the store
+    sourcefn : str
+        The NSA FITS file this store was converted from
+    """
+    _metafn = 'meta.json'
+    _indexidsfn = 'NSAID.sortedids.npy'
+    _indexorderfn = 'NSAID.order.npy'
+
+    def __init__(self, storedir):
+        import json
+
+        metafn = os.path.join(storedir, self._metafn)
+        if not os.path.isfile(metafn):
+            raise IOError('Directory "{0}" does not contain an NSA store'.format(storedir))
+        with open(metafn) as f:
+            meta = json.load(f)
+        if meta['version'] != NSA_STORE_VERSION:
+            raise ValueError('NSA store in "{0}" is version {1}, but this code '
+                             'needs version {2}.  Re-run '
+                             'convert_nsa_to_store.'.format(storedir, meta['version'], NSA_STORE_VERSION))
+
+        self.storedir = storedir
+        self.colnames = list(meta['colnames'])
+        self.sourcefn = meta['sourcefn']
+        self._nrows = meta['nrows']
+
+        self._columns = {}
+        self._sortedids = self._sortorder = None
+
+    def __len__(self):
+        return self._nrows
+
+    def __contains__(self, colname):
+        return colname in self.colnames
+
+    def __getitem__(self, colname):
+        """
+        Returns the requested column as a read-only memory-mapped array.
+        """
+        if colname not in self._columns:
+            if colname not in self.colnames:
+                raise KeyError('Column {0} is not in the NSA store'.format(colname))
+            colfn = os.path.join(self.storedir, colname + '.npy')
+            self._columns[colname] = np.load(colfn, mmap_mode='r')
+        return self._columns[colname]
+
+    def nsaid_to_index(self, nsaid):
+        """
+        Finds the row(s) in the store for the given NSAID(s).
+
+        Parameters
+        ----------
+        nsaid : int or array of ints
+            The NSA ID#(s) to look up
+
+        Returns
+        -------
+        idx : int or array of ints
+            The row index for each of `nsaid` (same shape as `nsaid`)
+
+        Raises
+        ------
+        ValueError
+            If any of the requested ids are not in the catalog
+        """
+        if self._sortorder is None:
+            # _sortorder is set last, so other threads never see half an index
+            sortedids = np.load(os.path.join(self.storedir, self._indexidsfn), mmap_mode='r')
+            sortorder = np.load(os.path.join(self.storedir, self._indexorderfn), mmap_mode='r')
+            self._sortedids = sortedids
+            self._sortorder = sortorder
+
+        nsaids = np.asarray(nsaid)
+        sortidx = np.searchsorted(self._sortedids, nsaids)
+        # clip so that ids past the end of the catalog don't raise IndexError
+        sortidx = np.clip(sortidx, 0, len(self._sortedids) - 1)
+        missing = self._sortedids[sortidx] != nsaids
+        if np.any(missing):
+            raise ValueError('NSAID #{0} not present in the catalog'.format(nsaids[missing].ravel()[0]))
+
+        idx = np.asarray(self._sortorder[sortidx])
+        if idx.ndim == 0:
+            return int(idx)
+        return idx
+
+    def to_table(self, colnames=None):
+        """
+        Builds an `astropy.table.Table` from (a subset of) the columns.
+
+        Parameters
+        ----------
+        colnames : list of str or None
+            The columns to include or None to include all of them.
+
+        Returns
+        -------
+        tab : astropy.table.Table
+            The table.  The columns are *not* copied, so they remain backed by
+            the memory-mapped files.
+        """
+        from astropy.table import Table
+
+        if colnames is None:
+            colnames = self.colnames
+        return Table([self[nm] for nm in colnames], names=colnames, copy=False)
+
+    def __repr__(self):
+        return "<NSAStore of {0} rows in '{1}'>".format(len(self), self.storedir)
+
+
+def convert_nsa_to_store(fn=None, storedir=None, overwrite=False):
+    """
+    Converts the NSA FITS file into an `NSAStore` directory.
+
+    The FITS file is opened memory-mapped and written out one column at a time,
+    so this never needs the whole catalog in memory at once.  The store is
+    built in a temporary directory next to `storedir` and only renamed to
+    `storedir` when it is complete, so a failed download or conversion never
+    leaves something there that looks like a store.
+
+    Parameters
+    ----------
+    fn : str or None
+        The NSA FITS file to convert, or None to use (and, if needed,
+        download) the default `NSAFILENAME`.
+    storedir : str or None
+        The directory to write the store to, or None to use the file name
+        with ``_store`` in place of ``.fits``.
+    overwrite : bool
+        If True, re-convert even if `storedir` already has a store in it.
+
+    Returns
+    -------
+    store : NSAStore
+        The newly-created store
+    """
+    import json
+    import shutil
+
+    from astropy.io import fits
+
+    if fn is None:
+        fn = NSAFILENAME
+    if storedir is None:
+        storedir = _default_nsa_storedir(fn)
+
+    if os.path.isfile(os.path.join(storedir, NSAStore._metafn)):
+        if not overwrite:
+            raise IOError('NSA store "{0}" already exists'.format(storedir))
+    elif os.path.isdir(storedir) and os.listdir(storedir):
+        raise IOError('"{0}" is not an NSA store, but is also not empty, so '
+                      'not writing a store there'.format(storedir))
+
+    _download_nsa_if_missing(fn)
+
+    tmpdir = '{0}.tmp{1}'.format(storedir.rstrip(os.sep), os.getpid())
+    if os.path.isdir(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    try:
+        with fits.open(fn, memmap=True) as f:
+            data = f[1].data
+            colnames = list(data.columns.names)
+            for nm in colnames:
+                np.save(os.path.join(tmpdir, nm + '.npy'), np.asarray(data[nm]))
+            nrows = len(data)
+
+            ids = np.asarray(data['NSAID'])
+            order = np.argsort(ids, kind='mergesort')
+            np.save(os.path.join(tmpdir, NSAStore._indexidsfn), ids[order])
+            np.save(os.path.join(tmpdir, NSAStore._indexorderfn), order)
+
+        with open(os.path.join(tmpdir, NSAStore._metafn), 'w') as f:
+            json.dump({'version': NSA_STORE_VERSION, 'sourcefn': fn,
+                       'nrows': nrows, 'colnames': colnames}, f)
+
+        if os.path.isdir(storedir):
+            # either an old store being overwritten or an empty directory
+            shutil.rmtree(storedir)
+        os.rename(tmpdir, storedir)
+    except:
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+        raise
+
+    return NSAStore(storedir)
+
+
+def _default_nsa_storedir(fn):
+    if fn.endswith('.fits'):
+        return fn[:-5] + '_store'
+    else:
+        return fn + '_store'
+
+
+_cachednsastore = {}
+def get_nsa_store(fn=None, storedir=None):
+    """
+    Open the `NSAStore` for the NASA Sloan Atlas, converting (and downloading)
+    it first if necessary.
+
+    This is safe to call from several threads at once.  The store is
+    memory-mapped, so processes that open the same store share one copy of
+    the data (see `share_catalogs`).
+
+    Parameters
+    ----------
+    fn : str or None
+        The name of the NSA FITS file the store is derived from.  If None, the
+        convention from the NSA web site will be used.
+    storedir : str or None
+        The store directory, or None to derive it from `fn`.
+
+    Returns
+    -------
+    store : NSAStore
+        The memory-mapped store.
+    """
+    if fn is None:
+        fn = NSAFILENAME
+    if storedir is None:
+        storedir = _default_nsa_storedir(fn)
+
+    store = _cachednsastore.get(storedir)
+    if store is not None:
+        if TELL_IF_USING_CACHED:
+            print('Using cached NSA store', storedir)
+        return store
+
+    with _nsalock:
+        if storedir not in _cachednsastore:
+            if os.path.isfile(os.path.join(storedir, NSAStore._metafn)):
+                store = NSAStore(storedir)
+            else:
+                print('Converting NSA file', fn, 'to memory-mappable store', storedir)
+                store = convert_nsa_to_store(fn, storedir)
+            _cachednsastore[storedir] = store
+        return _cachednsastore[storedir]
+
+
+def share_catalogs(nsa=True, gama=None, nsafn=None):
+    """
+    Gets the NSA (and optionally GAMA) ready to be shared by a pool of worker
+    processes.
+
+    This makes sure the catalogs are on disk in memory-mappable form (the
+    `NSAStore` and the GAMA binary cache), and loads them in this process.
+    Workers then map the same files instead of each loading its own copy -
+    either because they were forked from this process, or through the
+    returned initializer, which attaches to the catalogs in a fresh process.
 
-    # use pyfits from astropy to load the data
-    res = fits.getdata(fn, 1)
-    _cachednsa[fn] = res
+    Parameters
+    ----------
+    nsa : bool
+        Whether to share the NSA store
+    gama : str or None
+        The GAMA catalog to share (a ``url`` for `targeting.get_gama`, e.g.
+        'DR1'), or None to not share GAMA.
+    nsafn : str or None
+        The NSA FITS file (see `get_nsa_store`)
+
+    Returns
+    -------
+    initializer : function
+        The function to use as the pool's ``initializer``
+    initargs : tuple
+        The pool's ``initargs``
+
+    Examples
+    --------
+    >>> initializer, initargs = share_catalogs(gama='DR1')  # doctest: +SKIP
+    >>> pool = multiprocessing.Pool(8, initializer, initargs)  # doctest: +SKIP
+    """
+    spec = {}
+    if nsa:
+        store = get_nsa_store(nsafn)
+        spec['nsastoredir'] = store.storedir
+    if gama is not None:
+        from targeting import get_gama
+
+        get_gama(url=gama)
+        spec['gamaurl'] = gama
+
+    return attach_shared_catalogs, (spec,)
+
+
+def attach_shared_catalogs(spec):
+    """
+    Attaches this (worker) process to the catalogs shared by `share_catalogs`.
+    `spec` is what `share_catalogs` gives as the ``initargs``.
+    """
+    if 'nsastoredir' in spec:
+        get_nsa_store(storedir=spec['nsastoredir'])
+    if 'gamaurl' in spec:
+        from targeting import get_gama
 
-    return res
+        get_gama(url=spec['gamaurl'])
+
+
+def map_hosts(func, hostlst, nprocesses=None, nsa=True, gama=None):
+    """
+    Calls ``func(host)`` for each host in `hostlst` in a pool of worker
+    processes that share the NSA and GAMA catalogs (see `share_catalogs`).
+
+    Parameters
+    ----------
+    func : function
+        The function to call - it has to be picklable (i.e., defined at the
+        top level of a module).
+    hostlst : list of NSAHost
+        The hosts
+    nprocesses : int or None
+        The number of worker processes, or None for one per CPU.
+    nsa : bool
+        Whether the workers should share the NSA
+    gama : str or None
+        The GAMA catalog the workers should share, or None for none.
+
+    Returns
+    -------
+    results : list
+        ``func(host)`` for each host, in the same order as `hostlst`
+    """
+    import multiprocessing
+
+    initializer, initargs = share_catalogs(nsa=nsa, gama=gama)
+    pool = multiprocessing.Pool(nprocesses, initializer, initargs)
+    try:
+        return pool.map(func, hostlst)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_usnob_catalog(fn, usecache=None):
+    """
+    Loads a USNO-B catalog downloaded by `NSAHost.usnob_environs_query`, in
+    either the ASCII or VOTable format.
+
+    The parsed table is kept in a binary cache next to `fn` (see
+    `catalogcache`), so later loads just memory-map it.
+
+    Parameters
+    ----------
+    fn : str
+        The file to load
+    usecache : bool or None
+        Whether to use the binary cache, or None to use the module-level
+        `USE_CATALOG_CACHE`
+
+    Returns
+    -------
+    cat : astropy.table.Table
+        The USNO-B catalog
+    """
+    from catalogcache import load_with_cache
+
+    if usecache is None:
+        usecache = USE_CATALOG_CACHE
+
+    return load_with_cache(fn, _parse_usnob_file, USNOB_PARSE_VERSION,
+                           usecache=usecache)
+
+
+def _parse_usnob_file(fn):
+    with open(fn, 'rb') as f:
+        start = f.read(512).lstrip()
+    if start.startswith(b'<?xml') or start.startswith(b'<VOTABLE'):
+        return parse_usnob_votable(fn)
+    else:
+        return parse_usnob_ascii(fn)
+
+
+def parse_usnob_ascii(fn):
+    """
+    Parses the ASCII format USNO-B output of the USNO cone search.
+
+    The column names come from the ``#1`` header line (separated by ``|``),
+    with any "S/G" columns renamed to "S/G_<band>" for the magnitude before
+    them.  Only the header is scanned in Python - the data are then handed
+    straight to the C tokenizer in `astropy.io.ascii` with the names and
+    delimiter already known, so there is no format guessing.
+
+    Parameters
+    ----------
+    fn : str
+        The file to parse
+
+    Returns
+    -------
+    cat : astropy.table.Table
+        The USNO-B catalog
+    """
+    from astropy.io import ascii
+
+    colnames = None
+    firstdataline = None
+    with open(fn) as f:
+        for l in f:
+            if l.startswith('#'):
+                if colnames is None and l.startswith('#1') and 'id' in l:
+                    colnames = [nm.strip() for nm in l.replace('#1', '').split('|') if nm.strip() != '']
+                    #now if there's a group of "S/G" columns, add the appropriate mag suffix
+                    for i in range(len(colnames)):
+                        if colnames[i] == 'S/G':
+                            colnames[i] = colnames[i] + '_' + colnames[i - 1]
+            elif l.strip() != '':
+                firstdataline = l.strip()
+                break
+    if colnames is None:
+        raise ValueError('USNO-B catalog does not have header - wrong format?')
+
+    names = list(colnames)
+    if firstdataline is not None and '|' in firstdataline:
+        delimiter = '|'
+        # pipes at the start or end of the lines give extra empty columns
+        if firstdataline.startswith('|'):
+            names.insert(0, '_leadingpipe')
+        if firstdataline.endswith('|'):
+            names.append('_trailingpipe')
+    else:
+        delimiter = ' '
+
+    tab = ascii.read(fn, names=names, format='no_header', delimiter=delimiter,
+                     comment='#', guess=False, fast_reader=True)
+
+    for nm in ('_leadingpipe', '_trailingpipe'):
+        if nm in tab.colnames:
+            tab.remove_column(nm)
+    return tab
+
+
+def parse_usnob_votable(fn):
+    """
+    Parses the VOTable format USNO-B output of the USNO cone search (from
+    ``construct_usnob_query(votable=True)``).
+
+    The RA/Dec columns are renamed to "RA"/"DEC" (based on their UCDs) so that
+    the result can be used in the same places as the output of
+    `parse_usnob_ascii`.
+
+    Parameters
+    ----------
+    fn : str
+        The file to parse
+
+    Returns
+    -------
+    cat : astropy.table.Table
+        The USNO-B catalog
+    """
+    from astropy.io.votable import parse_single_table
+
+    vot = parse_single_table(fn)
+    tab = vot.to_table(use_names_over_ids=True)
+
+    ucdnames = {'pos_eq_ra_main': 'RA', 'pos.eq.ra;meta.main': 'RA',
+                'pos_eq_dec_main': 'DEC', 'pos.eq.dec;meta.main': 'DEC'}
+    for field in vot.fields:
+        newname = ucdnames.get((field.ucd or '').lower())
+        if newname and field.name in tab.colnames and newname not in tab.colnames:
+            tab.rename_column(field.name, newname)
+
+    return tab
+
+
+# (name, SQL expression) of the columns `construct_sdss_query` can select,
+# in the order they appear in the query
+SDSS_QUERY_COLUMNS = [('objID', 'p.objId'), ('ra', 'p.ra'), ('dec', 'p.dec'),
+                      ('type', 'p.type'), ('flags', 'p.flags'),
+                      ('specObjID', 'p.specObjID'),
+                      ('phot_sg', 'dbo.fPhotoTypeN(p.type)')]
+SDSS_QUERY_COLUMNS.extend([(b, 'p.modelMag_' + b) for b in 'ugriz'])
+SDSS_QUERY_COLUMNS.extend([(b + '_err', 'p.modelMagErr_' + b) for b in 'ugriz'])
+SDSS_QUERY_COLUMNS.extend([('psf_' + b, 'p.psfMag_' + b) for b in 'ugriz'])
+SDSS_QUERY_COLUMNS.extend([
+    ('fibermag_r', 'p.fibermag_r'), ('fiber2mag_r', 'p.fiber2mag_r'),
+    ('sb_petro_r', 'p.petroMag_r + 2.5*log10(2*PI()*p.petroR50_r*p.petroR50_r)'),
+    ('expMag_r', 'p.expMag_r'),
+    ('sb_exp_r', 'p.expMag_r + 2.5*log10(2*PI()*p.expRad_r*p.expRad_r + 1e-20)'),
+    ('deVMag_r', 'p.deVMag_r'),
+    ('sb_deV_r', 'p.deVMag_r + 2.5*log10(2*PI()*p.deVRad_r*p.deVRad_r + 1e-20)'),
+    ('lnLExp_r', 'p.lnLExp_r'), ('lnLDeV_r', 'p.lnLDeV_r'), ('lnLStar_r', 'p.lnLStar_r')])
+SDSS_QUERY_COLUMNS.extend([('A' + b, 'p.extinction_' + b) for b in 'ugriz'])
+SDSS_QUERY_COLUMNS.extend([
+    ('spec_z', 'ISNULL(s.z, -1)'), ('spec_z_err', 'ISNULL(s.zErr, -1)'),
+    ('spec_z_warn', 'ISNULL(s.zWarning, -1)'), ('spec_class', 's.class'),
+    ('spec_subclass', 's.subclass')])
+
+# named sets of `SDSS_QUERY_COLUMNS` for `construct_sdss_query`
+SDSS_QUERY_PROFILES = {
+    # just enough to know where things are and how bright
+    'positions': ['objID', 'ra', 'dec', 'type', 'g', 'r'],
+    # everything `targeting.select_targets` and the color cuts use
+    'targeting': (['objID', 'ra', 'dec', 'type', 'flags', 'phot_sg'] +
+                  list('ugriz') + [b + '_err' for b in 'ugriz'] +
+                  ['psf_' + b for b in 'ugriz'] + ['fibermag_r', 'fiber2mag_r'] +
+                  ['A' + b for b in 'ugriz'] +
+                  ['spec_z', 'spec_z_err', 'spec_z_warn', 'spec_class']),
+    'full': [nm for nm, expr in SDSS_QUERY_COLUMNS]}
 
 
 def construct_sdss_query(ra, dec, radius=1*u.deg, into=None, magcut=None,
-                         inclphotzs=True, applyphotflags=False, xmatchwise=False):
+                         inclphotzs=None, applyphotflags=False, xmatchwise=False,
+                         decrange=None, rarange=None, columns='full'):
     """
     Generates the query to send to the SDSS to get the full SDSS catalog around
     a target.
@@ -803,14 +2362,28 @@ def construct_sdss_query(ra, dec, radius=1*u.deg, into=None, magcut=None,
     magcut : 2-tuple or None
         if not None, adds a magnitude cutoff.  Should be a 2-tuple
         ('magname', faintlimit). Ignored if None.
-    inclphotzs : bool
-        If True, includes a further join to add phot-zs where present
+    inclphotzs : bool or None
+        If True, includes a further join to add phot-zs where present.  If
+        None, this is done only if `columns` is 'full'.
     applyphotflags: bool
         If True, the query will some basic photometric flags (see the code for
         the exact flags)
     xmatchwise : bool
         If True, the query will also cross-match against WISE and include w1
         mags.
+    decrange : 2-tuple or None
+        If not None, only objects with ``decrange[0] <= dec < decrange[1]``
+        (in degrees) are returned.  Used to split up big queries (see
+        `download_tiled_sdss_query`).
+    rarange : 2-tuple or None
+        If not None, only objects with ``rarange[0] <= ra < rarange[1]`` (in
+        degrees) are returned.  If ``rarange[0] > rarange[1]``, the range
+        wraps through 360.
+    columns : str or list of str
+        The columns to get - either the name of one of the
+        `SDSS_QUERY_PROFILES` ('positions', 'targeting', or 'full'), or a list
+        of names from `SDSS_QUERY_COLUMNS`.  'objID', 'ra', and 'dec' are
+        always included.
 
     Returns
     -------
@@ -819,31 +2392,19 @@ def construct_sdss_query(ra, dec, radius=1*u.deg, into=None, magcut=None,
 
 
     """
+    import re
     from textwrap import dedent
 
 
 
     query_template = dedent("""
-    SELECT  p.objId  as objID,
-    p.ra, p.dec, p.type, p.flags, p.specObjID, dbo.fPhotoTypeN(p.type) as phot_sg,
-    p.modelMag_u as u, p.modelMag_g as g, p.modelMag_r as r,p.modelMag_i as i,p.modelMag_z as z,
-    p.modelMagErr_u as u_err, p.modelMagErr_g as g_err, p.modelMagErr_r as r_err,p.modelMagErr_i as i_err,p.modelMagErr_z as z_err,
-    p.psfMag_u as psf_u, p.psfMag_g as psf_g, p.psfMag_r as psf_r, p.psfMag_i as psf_i, p.psfMag_z as psf_z,
-    p.fibermag_r, p.fiber2mag_r,
-    p.petroMag_r + 2.5*log10(2*PI()*p.petroR50_r*p.petroR50_r) as sb_petro_r,
-    p.expMag_r, p.expMag_r + 2.5*log10(2*PI()*p.expRad_r*p.expRad_r + 1e-20) as sb_exp_r,
-    p.deVMag_r, p.deVMag_r + 2.5*log10(2*PI()*p.deVRad_r*p.deVRad_r + 1e-20) as sb_deV_r,
-    p.lnLExp_r, p.lnLDeV_r, p.lnLStar_r,
-    p.extinction_u as Au, p.extinction_g as Ag, p.extinction_r as Ar, p.extinction_i as Ai, p.extinction_z as Az,
-    ISNULL(s.z, -1) as spec_z, ISNULL(s.zErr, -1) as spec_z_err, ISNULL(s.zWarning, -1) as spec_z_warn, s.class as spec_class,
-    s.subclass as spec_subclass{photzdata}{wisedata}
+    SELECT  {columnstr}{photzdata}{wisedata}
 
 
     {intostr}
     FROM {funcprefix}fGetNearbyObjEq({ra}, {dec}, {radarcmin}) n, PhotoPrimary p
     {wisejoins}
-    LEFT JOIN SpecObj s ON p.specObjID = s.specObjID
-    {photzjoins}WHERE n.objID = p.objID{magcutwhere}
+    {specjoins}{photzjoins}WHERE n.objID = p.objID{magcutwhere}{skycutwhere}
     {photflags}
     """)
     #if using casjobs, functions need 'dbo' in front of them for some reason
@@ -856,11 +2417,35 @@ def construct_sdss_query(ra, dec, radius=1*u.deg, into=None, magcut=None,
 
     intostr = '' if into is None else ('INTO MyDB.' + into)
 
+    colnames = sdss_query_column_names(columns)
+    colexprs = dict(SDSS_QUERY_COLUMNS)
+    colstrs = []
+    for nm in colnames:
+        expr = colexprs[nm]
+        colstrs.append(expr if expr == 'p.' + nm else (expr + ' as ' + nm))
+    columnstr = ', '.join(colstrs)
+
+    if any([re.search(r'\bs\.', colexprs[nm]) for nm in colnames]):
+        specjoins = 'LEFT JOIN SpecObj s ON p.specObjID = s.specObjID\n'
+    else:
+        specjoins = ''
+
+    if inclphotzs is None:
+        inclphotzs = columns == 'full'
+
     if magcut is None:
         magcutwhere = ''
     else:
         magcutwhere = ' and p.{0} < {1}'.format(*magcut)
 
+    skycutwhere = ''
+    if decrange is not None:
+        skycutwhere += ' and p.dec >= {0!r} and p.dec < {1!r}'.format(*[float(d) for d in decrange])
+    if rarange is not None:
+        ralo, rahi = [float(r) for r in rarange]
+        joiner = 'and' if ralo < rahi else 'or'
+        skycutwhere += ' and (p.ra >= {0!r} {1} p.ra < {2!r})'.format(ralo, joiner, rahi)
+
     if inclphotzs:
         photzdata = ', ISNULL(pz.z,-1) as photz,ISNULL(pz.zerr,-1) as photz_err'
         photzjoins = 'LEFT JOIN PhotoZ pz ON p.ObjID = pz.ObjID\n'
@@ -878,37 +2463,365 @@ def construct_sdss_query(ra, dec, radius=1*u.deg, into=None, magcut=None,
         ISNULL(w.w3mpro,9999) as w3, ISNULL(w.w3sigmpro,9999) as w3err,
         ISNULL(w.w4mpro,9999) as w4, ISNULL(w.w4sigmpro,9999) as w4err""")
 
-        wisejoins = ('LEFT JOIN WISE_xmatch X ON p.objid = X.sdss_objid\n'
-                     'LEFT JOIN wise_allsky W ON x.wise_cntr = W.cntr')
-    else:
-        wisejoins = wisedata = ''
+        wisejoins = ('LEFT JOIN WISE_xmatch X ON p.objid = X.sdss_objid\n'
+                     'LEFT JOIN wise_allsky W ON x.wise_cntr = W.cntr')
+    else:
+        wisejoins = wisedata = ''
+
+    if applyphotflags:
+        photflags = dedent("""
+        AND (flags & dbo.fPhotoFlags('BINNED1')) != 0
+        AND (flags & dbo.fPhotoFlags('SATURATED')) = 0
+        AND (flags & dbo.fPhotoFlags('BAD_COUNTS_ERROR')) = 0 -- "interpolation affected many pixels; PSF flux error is inaccurate and likely underestimated."
+        """[1:-1])
+        # these were considered, but found to sometimes remove *maybe* galaxies
+        #AND (flags & 0x8100000c00a0) == 0  -- not NOPROFILE, PEAKCENTER, NOTCHECKED, PSF_FLUX_INTERP, SATURATED, or BAD_COUNTS_ERROR
+        #AND ((flags & 0x400000000000) == 0)  | (psfmagerr_g <= 0.2)  --  DEBLEND_NOPEAK on faint ones
+    else:
+        photflags = ''
+
+    if isinstance(ra, float):
+        ra = ra*u.deg
+    ra = ra.to(u.deg).value
+
+    if isinstance(dec, float):
+        dec = dec*u.deg
+    dec = dec.to(u.deg).value
+
+    if isinstance(radius, float):
+        radius = radius*u.deg
+    radarcmin = radius.to(u.arcmin).value
+
+    # ``**locals()`` means "use the local variable names to fill the template"
+    return query_template.format(**locals())
+
+
+def sdss_query_column_names(columns='full'):
+    """
+    The names of the columns `construct_sdss_query` will select for
+    `columns` (a profile name or list of column names), not counting the
+    optional phot-z and WISE columns.
+
+    Raises
+    ------
+    ValueError
+        If `columns` is not a known profile, or has unknown column names
+    """
+    if isinstance(columns, six.string_types):
+        if columns not in SDSS_QUERY_PROFILES:
+            raise ValueError('Unknown SDSS column profile "{0}" - must be one of '
+                             '{1}'.format(columns, sorted(SDSS_QUERY_PROFILES)))
+        columns = SDSS_QUERY_PROFILES[columns]
+
+    known = [nm for nm, expr in SDSS_QUERY_COLUMNS]
+    unknown = [nm for nm in columns if nm not in known]
+    if unknown:
+        raise ValueError('Unknown SDSS query columns: {0}'.format(unknown))
+
+    # always keep these so the catalogs can be tiled, merged and located
+    requested = set(columns).union(['objID', 'ra', 'dec'])
+    return [nm for nm in known if nm in requested]
+
+
+def sdss_tiles_needed(radius, maxarea=None):
+    """
+    The number of tiles a cone search of the given `radius` (in degrees if a
+    float) should be split into to keep each under `maxarea` square degrees
+    (default `SDSS_MAX_TILE_AREA`).
+    """
+    if maxarea is None:
+        maxarea = SDSS_MAX_TILE_AREA
+    radius = u.Quantity(radius, u.deg).value
+
+    # exact spherical cap area
+    area = 2 * np.pi * (1 - np.cos(np.radians(radius))) * (180 / np.pi)**2
+    return max(1, int(np.ceil(area / maxarea)))
+
+
+def sdss_sky_tiles(ra, dec, radius, ntiles):
+    """
+    Splits the cone at `ra`, `dec` with `radius` (all in degrees) into about
+    `ntiles` roughly square cells in declination and RA, and finds the small
+    cone that covers each cell.
+
+    Returns
+    -------
+    tiles : list of ``(ra, dec, radius, (decmin, decmax), (ramin, ramax))``
+        All in degrees.  The cells are half-open (``decmin <= dec < decmax``
+        and the same in RA), with the RA range wrapping through 360 if
+        ``ramin > ramax``.  Cells that don't overlap the cone are left out.
+    """
+    decmin = max(dec - radius, -90.)
+    decmax = min(dec + radius, 90.)
+    # pad the outer edges so nothing right at the edge of the cone is lost
+    pad = 1e-6
+
+    # size the cells to split the cone's bounding box into `ntiles`
+    capsize = 2 * np.pi * (1 - np.cos(np.radians(radius))) * (180 / np.pi)**2
+    cellsize = np.sqrt(capsize * 4 / np.pi / ntiles)
+    ndec = max(1, int(np.ceil((decmax - decmin) / cellsize - 0.25)))
+    decedges = np.linspace(decmin, decmax, ndec + 1)
+    decedges[0] -= pad
+    decedges[-1] += pad
+
+    tiles = []
+    for lo, hi in zip(decedges[:-1], decedges[1:]):
+        halfwidth = _cone_ra_halfwidth(ra, dec, radius, lo, hi)
+        if halfwidth >= 180:
+            ralo, rawidth = 0., 360.
+        else:
+            ralo, rawidth = ra - halfwidth - pad, 2 * (halfwidth + pad)
+        coswidth = np.cos(np.radians(min(abs(lo), abs(hi)) if lo * hi > 0 else 0))
+        # (a little slack so the sampling padding doesn't add a sliver of a cell)
+        nra = max(1, int(np.ceil(rawidth * coswidth / cellsize - 0.25)))
+        raedges = ralo + rawidth * np.arange(nra + 1) / nra
+        for rlo, rhi in zip(raedges[:-1], raedges[1:]):
+            tile = _sdss_cell_tile(ra, dec, radius, (lo, hi), (rlo % 360, rhi % 360))
+            if tile is not None:
+                tiles.append(tile)
+    return tiles
+
+
+def _cone_ra_halfwidth(ra, dec, radius, declo, dechi, nsamples=64):
+    """
+    The largest RA offset (in degrees) from `ra` of any part of the cone
+    between `declo` and `dechi`.  180 means the cone wraps all the way
+    around (i.e. it contains a pole).
+    """
+    d = np.linspace(max(declo, dec - radius), min(dechi, dec + radius), nsamples)
+    d = np.clip(d, -89.999999, 89.999999)
+    cosdra = ((np.cos(np.radians(radius)) - np.sin(np.radians(dec)) * np.sin(np.radians(d))) /
+              (np.cos(np.radians(dec)) * np.cos(np.radians(d))))
+    if np.any(cosdra < -1):
+        return 180.
+    halfwidth = np.degrees(np.arccos(np.clip(cosdra, -1, 1)))
+    # pad a bit for the sampling
+    return min(180., np.max(halfwidth) * (1 + 2. / nsamples))
+
+
+def _sdss_cell_tile(ra, dec, radius, decrange, rarange, nsamples=16):
+    """
+    The tile (see `sdss_sky_tiles`) for one cell, or None if the cell doesn't
+    overlap the cone.
+    """
+    from utils import angular_separation_deg
+
+    declo, dechi = decrange
+    ralo, rahi = rarange
+    rawidth = (rahi - ralo) % 360 or 360.
+
+    # points around the edge of the cell
+    t = np.linspace(0, 1, nsamples)
+    edgera = np.concatenate([ralo + rawidth * t, ralo + rawidth * t,
+                             np.full(nsamples, ralo), np.full(nsamples, ralo + rawidth)])
+    edgedec = np.concatenate([np.full(nsamples, declo), np.full(nsamples, dechi),
+                              declo + (dechi - declo) * t, declo + (dechi - declo) * t])
+    edgedec = np.clip(edgedec, -90, 90)
+
+    dra = (ra - ralo) % 360
+    centerincell = declo <= dec < dechi and dra < rawidth
+    if not centerincell and np.all(angular_separation_deg(ra, dec, edgera, edgedec) > radius):
+        return None
+
+    cra = (ralo + rawidth / 2) % 360
+    cdec = (max(declo, -90) + min(dechi, 90)) / 2
+    # pad a bit for the sampling
+    subradius = np.max(angular_separation_deg(cra, cdec, edgera, edgedec)) * (1 + 2. / nsamples)
+    return (cra, cdec, subradius, decrange, rarange)
+
+
+def _split_sdss_tile(ra, dec, radius, tile):
+    """
+    Splits a tile from `sdss_sky_tiles` in half along its longer side.
+    """
+    tra, tdec, tradius, (declo, dechi), (ralo, rahi) = tile
+    rawidth = (rahi - ralo) % 360 or 360.
+    if rawidth * np.cos(np.radians(tdec)) > dechi - declo:
+        ramid = (ralo + rawidth / 2) % 360
+        cells = [((declo, dechi), (ralo, ramid)), ((declo, dechi), (ramid, rahi))]
+    else:
+        decmid = (declo + dechi) / 2
+        cells = [((declo, decmid), (ralo, rahi)), ((decmid, dechi), (ralo, rahi))]
+    subtiles = [_sdss_cell_tile(ra, dec, radius, *cell) for cell in cells]
+    return [t for t in subtiles if t is not None]
+
+
+def download_tiled_sdss_query(ra, dec, radius, ntiles, fn=None,
+                              maxconnections=4, maxsplits=2,
+                              sdssurl=SDSS_SQL_URL, usepost=False,
+                              inclheader=True, maxrows=None, timeout=None,
+                              **querykwargs):
+    """
+    Gets the SDSS catalog for a big cone by splitting it into tiles, querying
+    them concurrently, and merging the results.
+
+    Each tile is a cell in declination and RA (see `sdss_sky_tiles`), queried
+    as the small cone around it with cuts to the cell, so no tile hits the
+    SkyServer's row or time limits where the full cone would.  If a tile
+    still fails with an SQL error, or returns `maxrows` rows (the SkyServer
+    doesn't say when it truncates a result, so a tile that hits the limit
+    exactly is assumed to be truncated), it is split in half and retried (up
+    to `maxsplits` times).  The merged catalog has any duplicate ``objID``
+    rows at the seams removed and is cut back to the original cone.
+
+    Parameters
+    ----------
+    ra : `Quantity` or float
+        The center RA (in degrees if float)
+    dec : `Quantity` or float
+        The center Dec (in degrees if float)
+    radius : `Quantity` or float
+        The radius of the cone (in degrees if float)
+    ntiles : int
+        The (approximate) number of tiles to split into
+    fn : str or None
+        A file to write the merged catalog to, or None to not save it.  This
+        has the rows of the merged catalog exactly as the SkyServer sent them
+        (each tile is saved as it downloads, in ``fn + '.tile*'`` files that
+        are removed afterwards), under one header.
+    maxconnections : int
+        The maximum number of tiles to query at once
+    maxsplits : int
+        How many times a failing tile can be split in two
+    sdssurl : str
+        The URL to send the queries to
+    usepost : bool
+        If False, uses GET, otherwise POST
+    inclheader : bool or str
+        Whether or not to include a header with information about the query
+        in `fn`.  If a string, that will be at the end of the header.
+    maxrows : int or None
+        The SkyServer's row limit, or None to use `SDSS_MAX_ROWS`
+    timeout : float or None
+        The timeout in seconds for each tile's request, or None for no timeout
+    querykwargs
+        Passed into `construct_sdss_query` (e.g. `magcut`)
+
+    Returns
+    -------
+    tab : astropy.table.Table
+        The merged catalog
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from astropy.table import vstack
+    from utils import angular_separation_deg
 
-    if applyphotflags:
-        photflags = dedent("""
-        AND (flags & dbo.fPhotoFlags('BINNED1')) != 0
-        AND (flags & dbo.fPhotoFlags('SATURATED')) = 0
-        AND (flags & dbo.fPhotoFlags('BAD_COUNTS_ERROR')) = 0 -- "interpolation affected many pixels; PSF flux error is inaccurate and likely underestimated."
-        """[1:-1])
-        # these were considered, but found to sometimes remove *maybe* galaxies
-        #AND (flags & 0x8100000c00a0) == 0  -- not NOPROFILE, PEAKCENTER, NOTCHECKED, PSF_FLUX_INTERP, SATURATED, or BAD_COUNTS_ERROR
-        #AND ((flags & 0x400000000000) == 0)  | (psfmagerr_g <= 0.2)  --  DEBLEND_NOPEAK on faint ones
-    else:
-        photflags = ''
+    ra = u.Quantity(ra, u.deg).value
+    dec = u.Quantity(dec, u.deg).value
+    radius = u.Quantity(radius, u.deg).value
+    maxrows = SDSS_MAX_ROWS if maxrows is None else maxrows
 
-    if isinstance(ra, float):
-        ra = ra*u.deg
-    ra = ra.to(u.deg).value
+    if fn is not None:
+        fndir = os.path.split(fn)[0]
+        if fndir and not os.path.isdir(fndir):
+            os.makedirs(fndir)
+    tilefns = []
+
+    def get_tile(tile, nsplitsleft, tilename):
+        tra, tdec, tradius, decrange, rarange = tile
+        query = construct_sdss_query(tra, tdec, tradius, decrange=decrange,
+                                     rarange=rarange, **querykwargs)
+        tilefn = None if fn is None else fn + '.' + tilename
+        if tilefn is not None:
+            tilefns.append(tilefn)
+        try:
+            tab = stream_sdss_query(query, fn=tilefn, sdssurl=sdssurl,
+                                    usepost=usepost, inclheader=False,
+                                    timeout=timeout)
+        except ValueError as e:
+            if 'No objects' in str(e):
+                return []
+            if nsplitsleft < 1:
+                raise
+        else:
+            if len(tab) < maxrows:
+                return [(tab, tilefn)]
+            if nsplitsleft < 1:
+                raise ValueError('A tile of the SDSS query returned {0} rows, '
+                                 'so it was probably truncated at the row '
+                                 'limit'.format(len(tab)))
+            del tab
+            if tilefn is not None:
+                os.remove(tilefn)
+
+        # probably hit a limit - try again in two halves
+        tabs = []
+        for half, subtile in zip('ab', _split_sdss_tile(ra, dec, radius, tile)):
+            tabs.extend(get_tile(subtile, nsplitsleft - 1, tilename + half))
+        return tabs
+
+    tiles = sdss_sky_tiles(ra, dec, radius, ntiles)
+    executor = ThreadPoolExecutor(max_workers=maxconnections)
+    try:
+        results = [t for res in executor.map(lambda it: get_tile(it[1], maxsplits, 'tile{0}'.format(it[0])),
+                                             enumerate(tiles))
+                   for t in res]
+        if not results:
+            raise ValueError('No objects were returned from the request!')
+        tab = vstack([t for t, tfn in results], join_type='exact',
+                     metadata_conflicts='silent')
+
+        # the tiles shouldn't overlap, but make sure nothing is doubled at the seams
+        objids, firstidx = np.unique(np.asarray(tab['objID']), return_index=True)
+        keep = np.zeros(len(tab), dtype=bool)
+        keep[firstidx] = True
+        keep &= angular_separation_deg(ra, dec, np.asarray(tab['ra']),
+                                        np.asarray(tab['dec'])) <= radius
+
+        if fn is not None:
+            fullquery = construct_sdss_query(ra, dec, radius, **querykwargs) if inclheader else None
+            _merge_sdss_tile_files(fn, [tfn for t, tfn in results],
+                                   [len(t) for t, tfn in results], keep,
+                                   fullquery, sdssurl, inclheader, len(tiles))
+    finally:
+        executor.shutdown()
+        for tilefn in tilefns:
+            for f in (tilefn, tilefn + '.part'):
+                if os.path.exists(f):
+                    os.remove(f)
 
-    if isinstance(dec, float):
-        dec = dec*u.deg
-    dec = dec.to(u.deg).value
+    return tab[np.flatnonzero(keep)]
 
-    if isinstance(radius, float):
-        radius = radius*u.deg
-    radarcmin = radius.to(u.arcmin).value
 
-    # ``**locals()`` means "use the local variable names to fill the template"
-    return query_template.format(**locals())
+def _merge_sdss_tile_files(fn, tilefns, tilelens, keep, query, sdssurl,
+                           inclheader, ntiles):
+    """
+    Writes the rows of the raw tile responses in `tilefns` that are in `keep`
+    (which covers all the tiles' rows in order) to `fn`, with the column
+    names from the first tile and the header for `query`.
+    """
+    with open(fn + '.part', 'wb') as fw:
+        if inclheader:
+            fw.write(_sdss_result_header(query, sdssurl, inclheader).encode('utf-8'))
+            fw.write('#Downloaded in {0} tiles\n'.format(ntiles).encode('utf-8'))
+
+        start = 0
+        for i, (tilefn, tilelen) in enumerate(zip(tilefns, tilelens)):
+            tilekeep = keep[start:start + tilelen]
+            start += tilelen
+            with open(tilefn, 'rb') as fr:
+                # any "#Table1" lines, then the column names
+                line = fr.readline()
+                while line.startswith(b'#'):
+                    if i == 0:
+                        fw.write(line)
+                    line = fr.readline()
+                if i == 0:
+                    fw.write(line)
+
+                nrows = 0
+                for line in fr:
+                    if not line.strip():
+                        continue
+                    if nrows < tilelen and tilekeep[nrows]:
+                        fw.write(line)
+                    nrows += 1
+            if nrows != tilelen:
+                raise ValueError('The SDSS tile file "{0}" has {1} rows, but '
+                                 '{2} were parsed from it'.format(tilefn, nrows, tilelen))
+    if os.path.exists(fn):
+        os.remove(fn)
+    os.rename(fn + '.part', fn)
 
 
 def construct_usnob_query(ra, dec, radius=1*u.deg, verbosity=1, votable=False, baseurl=USNOB_URL):
@@ -933,7 +2846,7 @@ def construct_usnob_query(ra, dec, radius=1*u.deg, verbosity=1, votable=False, b
     url : str
         The url to query to get the catalog.
     """
-    from urllib import urlencode
+    urlencode = six.moves.urllib.parse.urlencode
 
     if isinstance(ra, float):
         ra = ra*u.deg
@@ -1000,14 +2913,10 @@ def download_sdss_query(query, fn=None, sdssurl=SDSS_SQL_URL, format='csv',
 
     """
     import os
-    import datetime
-    from urllib import urlencode
     StringIO = six.moves.StringIO
 
     from hosts import download_with_progress_updates
 
-    parameterstr = urlencode([('cmd', query.strip()), ('format', format)])
-
     #either open the requested file or a buffer to later return the values
     if fn is None:
         fw = StringIO()
@@ -1019,29 +2928,14 @@ def download_sdss_query(query, fn=None, sdssurl=SDSS_SQL_URL, format='csv',
         fw = open(fn, 'w')
 
     try:
-        if usepost:
-            import requests
-            q = requests.post(sdssurl, data=parameterstr, stream=True).raw
-        else:
-            q = urlopen(sdssurl + '?' + parameterstr)
-        try:
+        with _open_sdss_query(query, sdssurl, format, usepost) as q:
             #first read the initial two lines to check for errors
             firstline = q.readline()
             secondline = q.readline()
-            if 'error' in firstline.lower() or 'error' in secondline.lower():
-                rest = q.read()
-                raise ValueError('SQL query returned an error:\n' + firstline +
-                                 secondline + rest)
-
-            if 'No objects have been found' == firstline:
-                raise ValueError('No objects were returned from the request!')
+            _check_sdss_response_start(firstline, secondline, q.read)
 
             if inclheader:
-                dtstr = str(datetime.datetime.today())
-                fw.write('#Retrieved on {0} from {1}\n'.format(dtstr, sdssurl))
-                fw.write('#Query:\n#{0}\n'.format(query.strip().replace('\n', '\n#')))
-                if isinstance(inclheader, six.string_types):
-                    fw.write('#{0}\n'.format(inclheader.replace('\n', '\n#')))
+                fw.write(_sdss_result_header(query, sdssurl, inclheader))
 
             fw.write(firstline)
             fw.write(secondline)
@@ -1050,15 +2944,499 @@ def download_sdss_query(query, fn=None, sdssurl=SDSS_SQL_URL, format='csv',
             else:
                 download_with_progress_updates(q, fw, msg=dlmsg)
 
-        finally:
-            q.close()
-
         if fn is None:
             # f should be a StringIO object, so we return its value
             return fw.getvalue()
     finally:
         fw.close()
 
+def stream_sdss_query(query, fn=None, sdssurl=SDSS_SQL_URL, inclheader=True,
+                      usepost=False, blocksize=2**20, dlmsg=None,
+                      outstream=sys.stdout, timeout=None):
+    """
+    Runs the provided query on the given SDSS `url` and parses the (CSV)
+    result into a table as it downloads.
+
+    Each block of complete lines is parsed into typed columns as soon as it
+    arrives and copied onto the end of the result columns, so neither the
+    text of the whole response nor the parsed blocks are ever all held in
+    memory, and nothing is re-read from disk.  If `fn` is given, the raw response is also written
+    there (with the same header `download_sdss_query` would write) so that
+    the catalog on disk is exactly what it would have been otherwise.
+
+    Parameters
+    ----------
+    query : str
+        The SQL query string.
+    fn : str or None
+        The filename to save the raw result to, or None to not save it.  The
+        file is written to ``fn + '.part'`` and renamed when complete.
+    sdssurl : str
+        The URL to send the query to
+    inclheader : bool or str
+        Whether or not to include a header with information about the query
+        in `fn`.  If a string, that will be at the end of the header.
+    usepost : bool
+        If False, uses GET, otherwise POST
+    blocksize : int
+        The number of bytes to read (and parse) at a time
+    dlmsg : str or None
+        A string to print when the download begins, or None for no message
+        or progress updates.
+    outstream : file-like
+        The stream to write `dlmsg` and the updates to
+    timeout : float or None
+        The timeout in seconds for the request, or None for no timeout
+
+    Returns
+    -------
+    tab : astropy.table.Table
+        The query result
+
+    Raises
+    ------
+    ValueError
+        If the SQL query results in an error or returns no rows
+    """
+    import os
+    from astropy.table import Table
+
+    fw = None
+    if fn is not None:
+        fndir = os.path.split(fn)[0]
+        if fndir and not os.path.isdir(fndir):
+            os.makedirs(fndir)
+        fw = open(fn + '.part', 'wb')
+
+    try:
+        with _open_sdss_query(query, sdssurl, 'csv', usepost, timeout) as q:
+            firstline = q.readline()
+            secondline = q.readline()
+            _check_sdss_response_start(firstline, secondline, q.read)
+
+            if fw is not None:
+                if inclheader:
+                    fw.write(_sdss_result_header(query, sdssurl, inclheader).encode('utf-8'))
+                fw.write(firstline)
+                fw.write(secondline)
+
+            if dlmsg is not None:
+                outstream.write(dlmsg + '\n')
+                outstream.flush()
+
+            # newer SkyServers put a "#Table1" line before the column names
+            pending = firstline + secondline
+            while pending.startswith(b'#'):
+                pending = pending[pending.index(b'\n') + 1:]
+            colnames = None
+            builders = None
+            nbytes = len(firstline) + len(secondline)
+
+            buf = True
+            while buf:
+                buf = q.read(blocksize)
+                if fw is not None:
+                    fw.write(buf)
+                nbytes += len(buf)
+                pending += buf
+
+                if buf:
+                    lastnl = pending.rfind(b'\n')
+                    if lastnl < 0:
+                        continue
+                    lines, pending = pending[:lastnl + 1], pending[lastnl + 1:]
+                else:
+                    lines, pending = pending, b''
+
+                if colnames is None:
+                    headerend = lines.find(b'\n')
+                    if headerend < 0:
+                        headerend = len(lines)
+                    colnames = lines[:headerend].decode('utf-8').strip().split(',')
+                    builders = [_ColumnBuilder(nm) for nm in colnames]
+                    lines = lines[headerend + 1:]
+
+                if lines.strip():
+                    block = _parse_csv_block(lines, colnames)
+                    del lines
+                    for builder, nm in zip(builders, colnames):
+                        builder.append(block[nm])
+                    del block
+
+                if dlmsg is not None:
+                    outstream.write('\r{0:.0f} kB downloaded'.format(nbytes / 1024.))
+                    outstream.flush()
+
+        if fw is not None:
+            fw.close()
+            os.rename(fn + '.part', fn)
+    except:
+        if fw is not None:
+            fw.close()
+            if os.path.exists(fn + '.part'):
+                os.remove(fn + '.part')
+        raise
+
+    if dlmsg is not None:
+        outstream.write('\n')
+        outstream.flush()
+
+    if colnames is None or builders[0].n == 0:
+        raise ValueError('No objects were returned from the request!')
+
+    return Table([builder.finish() for builder in builders], copy=False)
+
+
+def _parse_csv_block(lines, colnames):
+    """
+    Parses a block of complete CSV lines (bytes) into a table with the
+    given column names, using the fast C reader.
+    """
+    from astropy.io import ascii
+
+    return ascii.read(lines.decode('utf-8'), format='no_header', names=colnames,
+                      delimiter=',', guess=False, fast_reader=True)
+
+
+# how much `_ColumnBuilder` grows its arrays by - anything above 1 keeps the
+# copying linear in the number of rows, and smaller values waste less memory
+_COLUMN_GROWTH_FACTOR = 1.25
+
+
+class _ColumnBuilder(object):
+    """
+    Joins the pieces of one column parsed from separate blocks, by copying
+    each into a single array that grows (by `_COLUMN_GROWTH_FACTOR`) as needed
+    and is trimmed to length at the end, so the blocks can be freed as soon as they
+    are added.  The blocks are typed independently, so the array is promoted
+    to a common type as needed (e.g. a block of all-integer values in a float
+    column).
+    """
+    def __init__(self, name):
+        self.name = name
+        self.data = None
+        self.mask = None
+        self.masked = False
+        self.n = 0
+
+    def append(self, col):
+        arr = np.asarray(col)
+        end = self.n + len(arr)
+
+        if self.data is None:
+            self.data = arr.copy()
+        else:
+            kinds = set([self.data.dtype.kind, arr.dtype.kind])
+            if len(kinds) > 1 and kinds & set('US'):
+                arr = arr.astype(str)
+                if self.data.dtype.kind not in 'US':
+                    self.data = self.data[:self.n].astype(str)
+            dtype = np.result_type(self.data, arr)
+            if dtype != self.data.dtype:
+                self.data = self.data[:self.n].astype(dtype)
+            if end > len(self.data):
+                newlen = max(end, int(len(self.data) * _COLUMN_GROWTH_FACTOR))
+                self.data.resize((newlen,), refcheck=False)
+            self.data[self.n:end] = arr
+
+        if hasattr(col, 'mask'):
+            self.masked = True
+            colmask = np.ma.getmaskarray(col)
+            if self.mask is None and colmask.any():
+                self.mask = np.zeros(len(self.data), dtype=bool)
+            if self.mask is not None:
+                if len(self.mask) < len(self.data):
+                    # resize fills the new part with zeros (i.e. not masked)
+                    self.mask.resize((len(self.data),), refcheck=False)
+                self.mask[self.n:end] = colmask
+        self.n = end
+
+    def finish(self):
+        """
+        Returns the whole column (and releases it from this builder).
+        """
+        from astropy.table import Column, MaskedColumn
+
+        data, mask = self.data, self.mask
+        self.data = self.mask = None
+        data.resize((self.n,), refcheck=False)
+        if self.masked:
+            if mask is None:
+                mask = np.zeros(self.n, dtype=bool)
+            else:
+                mask.resize((self.n,), refcheck=False)
+            return MaskedColumn(data=data, mask=mask, name=self.name, copy=False)
+        else:
+            return Column(data=data, name=self.name, copy=False)
+
+
+def _open_sdss_query(query, sdssurl=SDSS_SQL_URL, format='csv', usepost=False,
+                     timeout=None):
+    """
+    Opens the response to an SDSS SQL query, going through the local query
+    cache (see `querycache`).  This is a context manager, and the response is
+    only cached if it is read to the end without raising an exception.
+    """
+    import querycache
+
+    parameterstr = _sdss_query_parameters(query, format)
+
+    def opener():
+        if usepost:
+            import requests
+            return requests.post(sdssurl, data=parameterstr, stream=True,
+                                 timeout=timeout).raw
+        elif timeout is None:
+            return urlopen(sdssurl + '?' + parameterstr)
+        else:
+            return urlopen(sdssurl + '?' + parameterstr, timeout=timeout)
+
+    key = querycache.query_key(sdssurl, format, query)
+    return querycache.cached_response(key, opener)
+
+
+def _sdss_query_parameters(query, format='csv'):
+    urlencode = six.moves.urllib.parse.urlencode
+    return urlencode([('cmd', query.strip()), ('format', format)])
+
+
+def _check_sdss_response_start(firstline, secondline, readrest):
+    """
+    Raises a ValueError if the first two lines of an SDSS SQL response show
+    an error or an empty result.  `readrest` is called to get the rest of the
+    response for the error message.
+    """
+    if isinstance(firstline, bytes):
+        firstline = firstline.decode('utf-8', 'replace')
+        secondline = secondline.decode('utf-8', 'replace')
+
+    if 'error' in firstline.lower() or 'error' in secondline.lower():
+        rest = readrest()
+        if isinstance(rest, bytes):
+            rest = rest.decode('utf-8', 'replace')
+        raise ValueError('SQL query returned an error:\n' + firstline +
+                         secondline + rest)
+
+    if 'No objects have been found' == firstline.strip():
+        raise ValueError('No objects were returned from the request!')
+
+
+def _sdss_result_header(query, sdssurl, inclheader):
+    """
+    The comment lines that go at the top of a downloaded SDSS query result.
+    """
+    import datetime
+
+    dtstr = str(datetime.datetime.today())
+    lines = ['#Retrieved on {0} from {1}\n'.format(dtstr, sdssurl),
+             '#Query:\n#{0}\n'.format(query.strip().replace('\n', '\n#'))]
+    if isinstance(inclheader, six.string_types):
+        lines.append('#{0}\n'.format(inclheader.replace('\n', '\n#')))
+    return ''.join(lines)
+
+
+def bulk_environs_download(hostlst, sdss=True, usnob=True, maxconnections=4,
+                           nretries=3, backoff=2., timeout=300,
+                           sdssurl=SDSS_SQL_URL, usnoburl=USNOB_URL,
+                           usnobvotable=False, verbose=True, **sdsskwargs):
+    """
+    Downloads the SDSS and/or USNO-B environs catalogs for many hosts at once.
+
+    Downloads run concurrently, but with at most `maxconnections` open at a
+    time.  Failed requests are retried with exponential backoff.  Hosts that
+    already have a catalog (in `fnsdss`/`fnusnob` or any of the `altfn*`
+    files) are skipped.  Each catalog is downloaded to a temporary file and
+    only renamed to its final name when complete, so an interrupted download
+    never leaves a truncated catalog behind.
+
+    SDSS environs too big for one query (see `sdss_tiles_needed`, or the
+    `tiles` keyword) are downloaded with `download_tiled_sdss_query`, one tile
+    at a time so they still count as one connection.  Tiles that finished
+    before a failure come from the query cache when the host is retried.
+
+    Parameters
+    ----------
+    hostlst : list of NSAHost
+        The hosts to download environs for
+    sdss : bool
+        Whether to get the SDSS catalogs
+    usnob : bool
+        Whether to get the USNO-B catalogs
+    maxconnections : int
+        The maximum number of simultaneous downloads
+    nretries : int
+        How many times to retry a failed download.  SQL errors from the SDSS
+        and queries missing from the query cache in 'replay' mode (see
+        `querycache`) are not retried, as they will just fail again.
+    backoff : float
+        The wait before the first retry in seconds.  It doubles for each
+        subsequent retry.
+    timeout : float
+        The timeout in seconds for each request
+    sdssurl : str
+        The URL of the SDSS SQL service
+    usnoburl : str
+        The URL of the USNO-B cone search
+    usnobvotable : bool
+        If True, get the VOTable version of the USNO-B catalog
+    verbose : bool
+        If True, print a line as each catalog finishes
+    sdsskwargs
+        Passed into `NSAHost.sdss_environs_query` to build the SDSS query
+        (e.g., `magcut`, `xmatchwise`, or `tiles`)
+
+    Returns
+    -------
+    report : astropy.table.Table
+        One row per host, giving for each catalog the status ('downloaded',
+        'skipped', or 'failed'), the number of bytes, the time taken, the
+        number of attempts, and the error message for failures.
+    """
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from astropy.table import Table
+    from querycache import CacheMissError
+
+    tiles = sdsskwargs.get('tiles', None)
+    # what `NSAHost.sdss_environs_query` passes into `construct_sdss_query`
+    querykwargs = dict([(k, sdsskwargs[k]) for k in ('inclphotzs', 'applyphotflags',
+                                                     'xmatchwise', 'columns')
+                        if k in sdsskwargs])
+
+    jobs = []
+    for i, h in enumerate(hostlst):
+        if sdss:
+            inclheader = 'Environs of NSA Object {0}'.format(h.nsaid)
+            raddeg = h.environsarcmin / 60.
+            ntiles = sdss_tiles_needed(raddeg) if tiles is None else tiles
+            if ntiles > 1:
+                magcut = sdsskwargs.get('magcut', None)
+                tilekwargs = dict(querykwargs, magcut=h.sdssquerymagcut if magcut is None else magcut)
+                job = (h.ra, h.dec, raddeg, ntiles, inclheader, tilekwargs)
+                jobs.append((i, 'sdsstiled', job, h.fnsdss, [h.fnsdss] + list(h.altfnsdss), None))
+            else:
+                query = h.sdss_environs_query(dl=False, **sdsskwargs)
+                header = _sdss_result_header(query, sdssurl, inclheader)
+                jobs.append((i, 'sdss', query, h.fnsdss, [h.fnsdss] + list(h.altfnsdss), header))
+        if usnob:
+            url = construct_usnob_query(h.ra, h.dec, h.environsarcmin / 60.,
+                                        verbosity=1, votable=usnobvotable,
+                                        baseurl=usnoburl)
+            jobs.append((i, 'usnob', url, h.fnusnob, [h.fnusnob] + list(h.altfnusnob), None))
+
+    def run_job(job):
+        i, kind, urlorquery, fn, allfns, header = job
+        res = {'status': 'skipped', 'bytes': 0, 'time': 0., 'attempts': 0, 'error': ''}
+        for existingfn in allfns:
+            if os.path.exists(existingfn):
+                return res
+
+        st = time.time()
+        for attempt in range(nretries + 1):
+            res['attempts'] = attempt + 1
+            try:
+                if kind == 'sdsstiled':
+                    ra, dec, raddeg, ntiles, inclheader, tilekwargs = urlorquery
+                    download_tiled_sdss_query(ra, dec, raddeg, ntiles, fn=fn,
+                                              maxconnections=1, sdssurl=sdssurl,
+                                              inclheader=inclheader,
+                                              timeout=timeout, **tilekwargs)
+                    res['bytes'] = os.path.getsize(fn)
+                elif kind == 'sdss':
+                    res['bytes'] = _download_environs_file(urlorquery, fn, header,
+                                                           timeout, sdssurl)
+                else:
+                    res['bytes'] = _download_environs_file(urlorquery, fn,
+                                                           timeout=timeout)
+                res['status'] = 'downloaded'
+                res['error'] = ''
+                break
+            except (ValueError, CacheMissError) as e:
+                # an SQL error, empty result, or a query not in the replay
+                # cache - retrying won't help
+                res['status'] = 'failed'
+                res['error'] = str(e)
+                break
+            except Exception as e:
+                res['status'] = 'failed'
+                res['error'] = '{0}: {1}'.format(e.__class__.__name__, e)
+                if attempt < nretries:
+                    time.sleep(backoff * 2**attempt)
+        res['time'] = time.time() - st
+
+        if verbose:
+            print('{0} {1} for {2}: {3} ({4} bytes in {5:.1f} sec)'.format(
+                kind, res['status'], hostlst[i].name, fn, res['bytes'], res['time']))
+        return res
+
+    executor = ThreadPoolExecutor(max_workers=maxconnections)
+    try:
+        results = list(executor.map(run_job, jobs))
+    finally:
+        executor.shutdown()
+
+    rows = [dict([('host', h.name), ('nsaid', h.nsaid)]) for h in hostlst]
+    for (i, kind, urlorquery, fn, allfns, header), res in zip(jobs, results):
+        for k, v in res.items():
+            rows[i][kind.replace('tiled', '') + '_' + k] = v
+
+    colnames = ['host', 'nsaid']
+    for kind in (['sdss'] if sdss else []) + (['usnob'] if usnob else []):
+        colnames.extend([kind + '_' + k for k in ('status', 'bytes', 'time', 'attempts', 'error')])
+    return Table(rows=[[row[nm] for nm in colnames] for row in rows] or None,
+                 names=colnames)
+
+
+def _download_environs_file(urlorquery, fn, header=None, timeout=300,
+                            sdssurl=None):
+    """
+    Downloads to a temporary file next to `fn` and renames it to `fn` once
+    complete.  If `sdssurl` is given, `urlorquery` is an SDSS SQL query to
+    run there (through the query cache), the response is checked for errors,
+    and `header` is written before it.  Otherwise `urlorquery` is just a URL.
+
+    Returns the number of bytes downloaded.
+    """
+    import contextlib
+
+    fndir = os.path.split(fn)[0]
+    if fndir and not os.path.isdir(fndir):
+        os.makedirs(fndir)
+
+    if sdssurl is None:
+        response = contextlib.closing(urlopen(urlorquery, timeout=timeout))
+    else:
+        response = _open_sdss_query(urlorquery, sdssurl, timeout=timeout)
+
+    tmpfn = fn + '.part'
+    nbytes = 0
+    try:
+        with response as q:
+            with open(tmpfn, 'wb') as fw:
+                if sdssurl is not None:
+                    firstline = q.readline()
+                    secondline = q.readline()
+                    _check_sdss_response_start(firstline, secondline, q.read)
+                    if header is not None:
+                        fw.write(header.encode('utf-8'))
+                    fw.write(firstline)
+                    fw.write(secondline)
+                    nbytes += len(firstline) + len(secondline)
+
+                buf = q.read(2**16)
+                while buf:
+                    fw.write(buf)
+                    nbytes += len(buf)
+                    buf = q.read(2**16)
+    except:
+        if os.path.exists(tmpfn):
+            os.remove(tmpfn)
+        raise
+
+    os.rename(tmpfn, fn)
+    return nbytes
+
+
 def sdss_to_UBVRI(u, g, r, i, z):
     """
     Converts SDSS ugriz to UBVRI - uses Jordi+ from
@@ -1097,6 +3475,24 @@ def get_old_hosts():
     return hostsd
 
 
+#note that the first name here is for the *host*, not the system, system is the second
+_SAGA_HOST_SPECS = {
+    'odyssey': (147100, ['Odyssey', 'Odysseus', 'NGC6181'], {}),  #30.3 Mpc
+    'iliad': (150238, ['Iliad', 'Achilles', 'NGC7393'], {}),
+    'lotr': (155005, ['LordoftheRings', 'FrodoBaggins',  'NGC895'], {}),
+    'starwars': (53145, ['StarWars', 'LukeSkywalker', 'NGC5485'], {'shortname': 'SW'}),
+    'aiw': (140594, ['AliceInWonderland', 'Alice', 'NGC4030'], {'shortname': 'AIW'}),
+    'beowulf': (135667, ['Beowulf', 'Beowulf', 'NGC2750'], {'shortname': 'beo'}),
+    'gilgamesh': (166313, ['Gilgamesh', 'Gilgamesh', 'NGC5962'], {'shortname': 'gil'}),
+    'hamlet': (166035, ['Hamlet', 'Hamlet', 'NGC5899'], {'shortname': 'ham'}),
+    }
+
+
+def _make_saga_host(key):
+    nsaid, names, kwargs = _SAGA_HOST_SPECS[key]
+    return NSAHost(nsaid, list(names), **kwargs)
+
+
 _HIDE_GET_SAGA_HOSTS_WARN = False
 def get_saga_hosts():
     """
@@ -1106,25 +3502,14 @@ def get_saga_hosts():
 
     if not _HIDE_GET_SAGA_HOSTS_WARN:
         warn('This is out-of-date.  get_saga_hosts_from_google is a better choice')
-    hostsd = {}
 
-
-    #note that the first name here is for the *host*, not the system, system is the second
-    hostsd['odyssey'] = NSAHost(147100, ['Odyssey', 'Odysseus', 'NGC6181']) #30.3 Mpc
-    hostsd['iliad'] = NSAHost(150238, ['Iliad', 'Achilles', 'NGC7393'])
-    hostsd['lotr'] = NSAHost(155005, ['LordoftheRings', 'FrodoBaggins',  'NGC895'])
-    hostsd['starwars'] = NSAHost(53145, ['StarWars', 'LukeSkywalker', 'NGC5485'], shortname='SW')
-    hostsd['aiw'] = NSAHost(140594, ['AliceInWonderland', 'Alice', 'NGC4030'], shortname='AIW')
-    hostsd['beowulf'] = NSAHost(135667, ['Beowulf', 'Beowulf', 'NGC2750'], shortname='beo')
-    hostsd['gilgamesh'] = NSAHost(166313, ['Gilgamesh', 'Gilgamesh', 'NGC5962'], shortname='gil')
-    hostsd['hamlet'] = NSAHost(166035, ['Hamlet', 'Hamlet', 'NGC5899'], shortname='ham')
-
-    return hostsd
+    return dict([(key, _make_saga_host(key)) for key in _SAGA_HOST_SPECS])
 
 
 def get_saga_hosts_from_google(googleusername=None, googlepasswd=None,
-                               useobservingsummary=False, cachefile='hosts_dl.pkl',
-                               clientsecretjsonorfn='client_secrets.json'):
+                               useobservingsummary=False, cachefile='hosts_dl.json',
+                               clientsecretjsonorfn='client_secrets.json',
+                               refresh='auto', sheetclient=None):
     """
     Returns a lost of hosts obtained from querying the google spreadsheet
     "SAGA_Hosts+Satellites".  Currently only works for NSA hosts
@@ -1136,6 +3521,9 @@ def get_saga_hosts_from_google(googleusername=None, googlepasswd=None,
     "download JSON" button, and then point the `clientsecretjsonorfn` argument
     to the location of the downloaded file.
 
+    The whole worksheet is read in one request and parsed in memory (see
+    `parse_saga_host_rows`).
+
     Parameters
     ----------
     googleusername : str
@@ -1145,30 +3533,90 @@ def get_saga_hosts_from_google(googleusername=None, googlepasswd=None,
     useobservingsummary : bool
         If True, use the "SAGA Observing Summary" spreadsheet, instead.
     cachefile : str or bool
-        If a string, specifies a filename to load the host list from, or if it
-        is absent, the file the loaded data will get saved to.  To clear the
-        cache, just delete the relevant file.  Note that if it ends in "pkl", a
-        2 or 3 will be added for the python version.
+        If a string, specifies a filename to cache the host list in (written
+        by `write_host_list`), along with the revision (last update time) of
+        the spreadsheet it came from.  If False, nothing is cached.  If it
+        ends in "pkl", the hosts are pickled instead (and a 2 or 3 will be
+        added for the python version) - those caches are never refreshed, so
+        to clear them, just delete the relevant file.
+    refresh : 'auto', bool
+        When to re-read the spreadsheet if `cachefile` exists.  'auto' checks
+        the spreadsheet's revision and only re-reads it if it changed (or if
+        the revision can't be found).  False always uses the cache without
+        going to google at all, and True always re-reads the spreadsheet.
+    sheetclient : object or None
+        The client to open the spreadsheet with, or None to log into google
+        with `gspread`.  This can be any object with an ``open(name)`` method
+        that returns something that works like a `gspread` spreadsheet
+        (``get_worksheet(0).get_all_values()``, and ideally
+        ``lastUpdateTime``), e.g. a local stand-in for testing.
     """
     import sys
-    import getpass
-    import gspread
-    from utils import get_google_oauth2_credentials
     pickle = six.moves.cPickle
 
-    if cachefile.endswith('.pkl'):
-        cachefile = cachefile + str(sys.version_info[0])
-
-    if os.path.isfile(cachefile):
-        print('Using cached version of google hosts list from file "{0}"'.format(cachefile))
-        with open(cachefile, 'rb') as f:
-            return pickle.load(f)
-
     if useobservingsummary:
         ssname = 'SAGA Observing Summary'
     else:
         ssname = 'SAGA_Hosts+Satellites'
 
+    usepickle = bool(cachefile) and cachefile.endswith('.pkl')
+    if usepickle:
+        cachefile = cachefile + str(sys.version_info[0])
+        if os.path.isfile(cachefile):
+            print('Using cached version of google hosts list from file "{0}"'.format(cachefile))
+            with open(cachefile, 'rb') as f:
+                return pickle.load(f)
+
+    cached = None
+    if cachefile and not usepickle and refresh is not True and os.path.isfile(cachefile):
+        try:
+            cached, cachemeta = read_host_list(cachefile, withmeta=True)
+        except ValueError as e:
+            print('Not using cached google hosts list: {0}'.format(e))
+        else:
+            if cachemeta.get('sheet') != ssname:
+                cached = None
+            elif refresh is False:
+                print('Using cached version of google hosts list from file "{0}"'.format(cachefile))
+                return list(cached)
+
+    try:
+        if sheetclient is None:
+            sheetclient = _google_sheet_client(googleusername, googlepasswd,
+                                               clientsecretjsonorfn)
+        ss = sheetclient.open(ssname)
+        revision = _google_sheet_revision(ss)
+    except Exception as e:
+        if cached is None:
+            raise
+        print('Could not check google hosts list ({0}), so using cached '
+              'version from file "{1}"'.format(e, cachefile))
+        return list(cached)
+
+    if cached is not None and revision is not None and cachemeta.get('revision') == revision:
+        print('Using cached version of google hosts list from file "{0}" (the '
+              'spreadsheet has not changed since {1})'.format(cachefile, revision))
+        return list(cached)
+
+    rows = ss.get_worksheet(0).get_all_values()  # first worksheet
+    nsaids, names = parse_saga_host_rows(rows, useobservingsummary)
+    hosts = list(HostCatalog(nsaids, names)) if nsaids else []
+
+    if cachefile:
+        if usepickle:
+            with open(cachefile, 'wb') as f:
+                pickle.dump(hosts, f)
+        else:
+            write_host_list(hosts, cachefile, {'sheet': ssname, 'revision': revision})
+
+    return hosts
+
+
+def _google_sheet_client(googleusername, googlepasswd, clientsecretjsonorfn):
+    import getpass
+    import gspread
+    from utils import get_google_oauth2_credentials
+
     if clientsecretjsonorfn:
         credentials = get_google_oauth2_credentials(clientsecretjsonorfn)
         try:
@@ -1184,20 +3632,56 @@ def get_saga_hosts_from_google(googleusername=None, googlepasswd=None,
             googlepasswd = getpass.getpass('Password for "{0}":'.format(googleusername))
         c = gspread.Client(auth=(googleusername, googlepasswd))
         c.login()
+    return c
+
+
+def _google_sheet_revision(ss):
+    # the last update time of the spreadsheet, which has had different names
+    # in different versions of gspread.  None if it's not available.
+    for attr in ('lastUpdateTime', 'get_lastUpdateTime', 'updated'):
+        rev = getattr(ss, attr, None)
+        if callable(rev):
+            rev = rev()
+        if rev is not None:
+            return str(rev)
+    return None
+
+
+def parse_saga_host_rows(rows, useobservingsummary=False):
+    """
+    Finds the hosts in the rows of the SAGA host spreadsheet.
+
+    Parameters
+    ----------
+    rows : list of lists of str
+        The cell values of the whole worksheet, one list per row (e.g. from
+        gspread's ``get_all_values``).  Empty cells can be '' or None.
+    useobservingsummary : bool
+        If True, the rows are from the "SAGA Observing Summary" spreadsheet.
+
+    Returns
+    -------
+    nsaids : list of int
+        The NSA ID# of each host
+    names : list
+        The names of each host, as accepted by `NSAHost`
+    """
+    def cell(r, i):
+        val = r[i] if i < len(r) else None
+        return '' if val is None else val
 
-    ss = c.open(ssname)
-    s = ss.get_worksheet(0)  # first worksheet
+    col1 = [cell(r, 0) for r in rows]
 
-    hosts = []
+    nsaids = []
+    names = []
     if useobservingsummary:
-        col1 = s.col_values(1)
         startrow = col1.index('Summary of Observed Systems') + 3
-        endrow = [i for i, v in enumerate(col1) if v is not None and v.startswith('these systems are currently deprecated')][0] + 1
+        endrow = [i for i, v in enumerate(col1) if v.startswith('these systems are currently deprecated')][0] + 1
 
-        rowvals = [s.row_values(row) for row in range(startrow, endrow)]
-        for r in rowvals:
-            sysname = r[0]
-            othernames = [nm.replace(' ', '') for nm in r[1].split(',')]
+        # startrow/endrow are 1-based like spreadsheet rows
+        for r in rows[(startrow-1):(endrow-1)]:
+            sysname = cell(r, 0)
+            othernames = [nm.replace(' ', '') for nm in cell(r, 1).split(',')]
 
             nsanum = nsaidx = None
             for i, nm in enumerate(othernames):
@@ -1208,15 +3692,15 @@ def get_saga_hosts_from_google(googleusername=None, googlepasswd=None,
             if nsanum is None:
                 continue  # skip this one, it's not an NSA object
 
-            del othernames[i]
-            if sysname is not None:
+            del othernames[nsaidx]
+            if sysname:
                 othernames.insert(0, sysname)
             if not othernames:
                 othernames = None
 
-            hosts.append(NSAHost(nsanum, othernames))
+            nsaids.append(nsanum)
+            names.append(othernames)
     else:
-        col1 = s.col_values(1)
         startrow = col1.index('SAGA') + 2
         endrow = startrow
         for v in col1[(startrow-1):]:
@@ -1225,28 +3709,122 @@ def get_saga_hosts_from_google(googleusername=None, googlepasswd=None,
                 #we've hit the end
                 break
 
-        rowvals = [s.row_values(row) for row in range(startrow, endrow)]
-
-        for r in rowvals:
+        for r in rows[(startrow-1):(endrow-1)]:
+            r = [cell(r, i) for i in range(max(len(r), 3))]
             if ''.join(r).strip() == '':
                 #blank line
                 continue
             if not r[2].strip():
                 print('Entry', r, 'does not have an NSA number, cannot use')
+                continue
             nsanum = int(r[2])
 
-            names = [r[0].strip()]
-            if r[1] is not None:
-                names.append('NGC' + r[1])
-            names.append('NSA' + str(nsanum))
+            hostnames = [r[0].strip()]
+            if r[1]:
+                hostnames.append('NGC' + r[1])
+            hostnames.append('NSA' + str(nsanum))
 
-            hosts.append(NSAHost(nsanum, names))
+            nsaids.append(nsanum)
+            names.append(hostnames)
 
-    if cachefile:
-        with open(cachefile, 'wb') as f:
-            pickle.dump(hosts, f)
+    return nsaids, names
 
-    return hosts
+
+# the NSAHost attributes a host list file keeps beyond the NSAID and names
+_HOST_LIST_ATTRIBUTES = ('_environsarcmin', 'fnsdss', 'altfnsdss', 'fnusnob',
+                         'altfnusnob', '_shortname', 'sdssquerymagcut')
+
+
+def write_host_list(hostlst, fn, meta=None):
+    """
+    Writes a list of hosts to a file that `read_host_list` can load.
+
+    Only what can't be re-derived from the NSA is stored (the NSAID, names,
+    environs radius, catalog file names, ...), so the file is small and
+    independent of how `NSAHost` is implemented.
+
+    Parameters
+    ----------
+    hostlst : list of NSAHost
+        The hosts to write
+    fn : str
+        The file name
+    meta : dict or None
+        Anything else (json-able) to store with the hosts, e.g. where they
+        came from.
+    """
+    import json
+
+    entries = []
+    for h in hostlst:
+        entry = {'nsaid': int(h.nsaid),
+                 'names': [h.name] + list(h.altnames) if h.altnames else None}
+        for attr in _HOST_LIST_ATTRIBUTES:
+            val = getattr(h, attr, None)
+            entry[attr] = val.item() if isinstance(val, np.generic) else val
+        entries.append(entry)
+
+    tmpfn = fn + '.tmp'
+    with open(tmpfn, 'w') as f:
+        json.dump({'version': HOST_LIST_VERSION, 'nsaversion': NSA_VERSION,
+                   'meta': meta or {}, 'hosts': entries}, f)
+    if os.path.exists(fn):
+        os.remove(fn)
+    os.rename(tmpfn, fn)
+
+
+def read_host_list(fn, nsastore=None, withmeta=False):
+    """
+    Reads a list of hosts written by `write_host_list`.
+
+    All the hosts are looked up in the NSA at once, and the `NSAHost`
+    objects and their derived quantities (distances, galactic coordinates,
+    ...) are only created when they are used, so this takes milliseconds
+    even for thousands of hosts.
+
+    Parameters
+    ----------
+    fn : str
+        The file name
+    nsastore : NSAStore or None
+        The NSA store to get the host data from, or None to use
+        `get_nsa_store`.
+    withmeta : bool
+        If True, also return the ``meta`` given to `write_host_list`.
+
+    Returns
+    -------
+    hostcat : HostCatalog
+        The hosts - iterating over this or indexing it gives the `NSAHost`
+        objects.
+    meta : dict
+        Only if `withmeta` is True.
+
+    Raises
+    ------
+    ValueError
+        If the file is from a different `HOST_LIST_VERSION` or `NSA_VERSION`
+    """
+    import json
+
+    with open(fn) as f:
+        data = json.load(f)
+    if data.get('version') != HOST_LIST_VERSION:
+        raise ValueError('host list "{0}" is version {1}, but this code needs '
+                         'version {2}'.format(fn, data.get('version'), HOST_LIST_VERSION))
+    if data.get('nsaversion') != NSA_VERSION:
+        raise ValueError('host list "{0}" is for NSA version {1}, but this is '
+                         'NSA version {2}'.format(fn, data.get('nsaversion'), NSA_VERSION))
+
+    entries = data['hosts']
+    cat = HostCatalog([e['nsaid'] for e in entries], [e['names'] for e in entries],
+                      [e['_environsarcmin'] for e in entries]*u.arcmin, nsastore)
+    for i, entry in enumerate(entries):
+        cat._hostattrs[i] = dict([(attr, entry[attr]) for attr in _HOST_LIST_ATTRIBUTES])
+
+    if withmeta:
+        return cat, data.get('meta', {})
+    return cat
 
 def use_base_catalogs(hostlst, pattern='catalogs/base_sql_nsa{}.fits.gz'):
     """
@@ -1254,11 +3832,51 @@ def use_base_catalogs(hostlst, pattern='catalogs/base_sql_nsa{}.fits.gz'):
     catalogs
     """
     for h in hostlst:
+        h._cached_sdss = None  # drops the old catalog from the catalog cache
         h.fnsdss = pattern.format(h.nsaid)
-        h._cached_sdss = None
 
 
-#this adds the hosts from the get_saga_hosts function to the module's namespace
-_HIDE_GET_SAGA_HOSTS_WARN = True
-locals().update(get_saga_hosts())
-_HIDE_GET_SAGA_HOSTS_WARN = False
+class _HostsModule(type(sys)):
+    """
+    The type of this module, which makes the hosts from `get_saga_hosts`
+    available as module attributes (e.g. ``hosts.odyssey``) without loading
+    anything at import time.  Each host is only created the first time it is
+    accessed, and then stored in the module namespace so that later accesses
+    don't come back here.
+    """
+    def __getattr__(self, name):
+        if name in _SAGA_HOST_SPECS:
+            host = globals()[name] = _make_saga_host(name)
+            return host
+        raise AttributeError("module '{0}' has no attribute '{1}'".format(__name__, name))
+
+    def __dir__(self):
+        return sorted(set(globals()).union(_SAGA_HOST_SPECS))
+
+
+class _HostsModuleProxy(_HostsModule):
+    """
+    Stands in for this module on Pythons that can't change the type of a
+    module (python 2, and 3 before 3.5).  Everything is looked up in and
+    stored to the real module, so there is still only one namespace.
+    """
+    def __init__(self, module):
+        _HostsModule.__init__(self, module.__name__, module.__doc__)
+        self.__dict__['_module'] = module
+
+    def __getattr__(self, name):
+        if name in _SAGA_HOST_SPECS and name not in globals():
+            _HostsModule.__getattr__(self, name)
+        return getattr(self._module, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._module, name, value)
+
+    def __delattr__(self, name):
+        delattr(self._module, name)
+
+
+try:
+    sys.modules[__name__].__class__ = _HostsModule
+except TypeError:
+    sys.modules[__name__] = _HostsModuleProxy(sys.modules[__name__])
@@ -51,6 +51,7 @@ def plot_targets_and_imacs_fov(host, camera='short', offset=(0, 0), clf=True, **
     kwargs are passed into `select_targets`
     """
     import targeting
+    from utils import tangent_plane_offsets
 
     if camera == 'short':
         fov = 27.20
@@ -62,8 +63,9 @@ def plot_targets_and_imacs_fov(host, camera='short', offset=(0, 0), clf=True, **
         raise ValueError('unrecognized camera "{0}"'.format(camera))
 
     targets = targeting.select_targets(host, **kwargs)
-    dra = (targets['ra'] - host.ra) * 60 * np.cos(np.radians(targets['dec']))
-    ddec = (targets['dec'] - host.dec) * 60
+    dra, ddec = tangent_plane_offsets(targets['ra'], targets['dec'], host.ra, host.dec)
+    dra *= 60
+    ddec *= 60
 
     if clf:
         plt.clf()
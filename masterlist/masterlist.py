@@ -142,17 +142,28 @@ def load_2mass_xsc(fn):
                       fill_values=[('', '0'), ('null', '0')])
 
 
-def load_nsa(fn='nsa_v0_1_2.fits', verbose=False):
+def load_nsa(fn='nsa_v0_1_2.fits', verbose=False, usestore=True):
     """
     This loads the NSA *and* breaks the FNugriz fields into distinct columns
 
     Not that it drops columns that have more complex dimensionality, like the
     radial profiles or stokes parameters
+
+    `fn` can also be the directory of an NSA store (from
+    `hosts.convert_nsa_to_store`).  If `usestore` is True and `fn` is a FITS
+    file with a store next to it (e.g. "nsa_v0_1_2_store"), the store is used
+    instead, so the columns are memory-mapped rather than read in all at once.
     """
     from astropy.io import fits
     from astropy import table
 
-    tab = table.Table(fits.getdata(fn))
+    storedir = fn[:-5] + '_store' if fn.endswith('.fits') else None
+    if os.path.isdir(fn):
+        tab = _open_nsa_store(fn).to_table()
+    elif usestore and storedir and _is_nsa_store(storedir):
+        tab = _open_nsa_store(storedir).to_table()
+    else:
+        tab = table.Table(fits.getdata(fn))
 
     newcols = []
     for nm in tab.colnames:
@@ -178,6 +189,59 @@ def load_nsa(fn='nsa_v0_1_2.fits', verbose=False):
     return newtab
 
 
+def _import_saga_module(modname):
+    """
+    Imports one of the top-level saga-code modules (like hosts.py or utils.py),
+    which live one directory up from this file.  That directory is put at the
+    front of `sys.path` just for the import, so names as common as "utils"
+    can't be picked up from some other installed package (either here or in
+    the imports those modules do themselves), and is then taken out again.
+    """
+    import importlib
+
+    sagadir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+    mod = sys.modules.get(modname)
+    if mod is not None:
+        modfn = os.path.abspath(getattr(mod, '__file__', None) or '')
+        if os.path.dirname(modfn) != sagadir:
+            raise ImportError('A module named "{0}" that is not the saga-code one '
+                              '(from "{1}") has already been imported'.format(modname, modfn))
+        return mod
+
+    sys.path.insert(0, sagadir)
+    try:
+        return importlib.import_module(modname)
+    finally:
+        if sys.path and sys.path[0] == sagadir:
+            del sys.path[0]
+        elif sagadir in sys.path:
+            sys.path.remove(sagadir)
+
+
+def _is_nsa_store(storedir):
+    """
+    Whether `storedir` has a complete `NSAStore` in it (its metadata file is
+    written last, so a directory without one isn't a usable store)
+    """
+    return os.path.isfile(os.path.join(storedir, 'meta.json'))
+
+
+def _open_nsa_store(storedir):
+    """
+    Opens an `NSAStore` using the implementation in the top-level hosts.py
+    """
+    return _import_saga_module('hosts').NSAStore(storedir)
+
+
+def _luminosity_distance_mpc(z):
+    """
+    WMAP9 luminosity distances in Mpc from the shared interpolation table in
+    the top-level utils.py
+    """
+    return _import_saga_module('utils').luminosity_distance_mpc(np.asarray(z), 'WMAP9')
+
+
 def initial_catalog(leda, twomass, edd, kknearby):
     """
     `matchtolerance` is how close an NSA object needs to be to be counted as
@@ -432,8 +496,7 @@ def manually_tweak_simplified_catalog(simplifiedcat):
 
     simplifiedcat = simplifiedcat.copy()
     simplifiedcat['vhelio'][idx] = vels = np.array(vels)
-    simplifiedcat['distance'][idx] = WMAP9.luminosity_distance(
-        vels / c.to(u.km / u.s).value).to(u.Mpc).value
+    simplifiedcat['distance'][idx] = _luminosity_distance_mpc(vels / c.to(u.km / u.s).value)
 
     return simplifiedcat
 
@@ -540,7 +603,7 @@ def add_6df(simplifiedmastercat, sixdf, tol=1*u.arcmin):
     t.add_column(table.MaskedColumn(name='othername', data=sixdfnomatch['targetname']))
     t.add_column(table.MaskedColumn(name='vhelio', data=sixdfnomatch['z_helio']*ckps))
     #t.add_column(table.MaskedColumn(name='vhelio_err', data=sixdfnomatch['zfinalerr']*ckps))
-    t.add_column(table.MaskedColumn(name='distance', data=WMAP9.luminosity_distance(sixdfnomatch['z_helio']).value))
+    t.add_column(table.MaskedColumn(name='distance', data=_luminosity_distance_mpc(sixdfnomatch['z_helio'])))
 
     #fill in anything else needed with -999 and masked
     for nm in simplifiedmastercat.colnames:
@@ -692,7 +755,6 @@ def cross_id_w_sdss(mastercat, searchrad=30*u.arcsec, limitto=None,
     crossid_result : Table
         The response from the SDSS cross-id service
     """
-    import requests
     from astropy.io import ascii
 
     #take the chunk code here *instead* of the real function, because it returns
@@ -773,11 +835,24 @@ def cross_id_w_sdss(mastercat, searchrad=30*u.arcsec, limitto=None,
                    upload=('', '', 'application/octet-stream', {})
                   )
 
-    req = requests.post(cidurl, files=postdct)
-    result = req.text
+    # identical cross-IDs come from the local query cache (see querycache.py)
+    querycache = _import_saga_module('querycache')
+    cachekey = querycache.query_key(cidurl, 'csv', qry,
+                                    [postdct['radius'][1], upload_list])
+    result = querycache.get_cached(cachekey)
+    if result is None:
+        import requests
+
+        req = requests.post(cidurl, files=postdct)
+        result = req.text
+    else:
+        req = None
+        result = result.decode('utf-8')
 
     try:
         tab = ascii.read(result, guess=False, delimiter=',')
+        if req is not None:
+            querycache.put_cached(cachekey, result.encode('utf-8'))
         tab['name'].name = 'mastercat_idx'
         return tab
     except ascii.InconsistentTableError:
@@ -115,14 +115,10 @@ def colorcut_mask(targets, colorcut):
     Returns a mask for the catalog objects `targets` that are True for objects
     matching the `colorcut` color ranges.
     """
-    color_mask = np.ones(len(targets), dtype=bool)
-    for colornm, (llim, ulim) in targeting.tighter_color_cuts.items():
-        ulim = np.inf if ulim is None else ulim
-        llim = (-np.inf) if llim is None else llim
-        c1, c2 = colornm.split('-')
-        c = targets[c1] - targets[c2]
-        color_mask = color_mask & (llim < c) & (c < ulim)
-    return color_mask
+    from selectexpr import colorcuts_to_cuts, compile_cuts
+
+    cuts = colorcuts_to_cuts(targeting.tighter_color_cuts, deredden=False)
+    return compile_cuts(cuts).mask(targets)
 
 
 def generate_catalog(host, targs, targetranks, fnout=None, fluxfnout=None, fluxrank=1,
@@ -0,0 +1,311 @@
+"""
+A local cache of responses from the SDSS SQL and cross-ID services.
+
+Responses are stored one file per query in `CACHE_DIR`, named by a hash of
+the endpoint URL, the result format and the (whitespace-normalized) query, so
+re-running the same query just reads the file back.  The total size is kept
+under `MAX_BYTES` by evicting the least recently used responses.
+
+`MODE` controls how the cache is used:
+
+* 'readwrite' - use cached responses when present, otherwise query the
+  server and cache the result.
+* 'replay' - only ever use cached responses, and raise a `CacheMissError`
+  for anything that isn't cached, so nothing touches the network.
+* 'refresh' - always query the server, but store the result.
+* 'off' - don't use the cache at all.
+"""
+from __future__ import division, print_function
+
+import os
+import json
+import hashlib
+import threading
+
+try:
+    import six
+except ImportError:
+    from astropy.extern import six
+
+
+CACHE_DIR = os.path.join('catalogs', 'querycache')
+MAX_BYTES = 2**30
+MODE = 'readwrite'
+
+_MODES = ('readwrite', 'replay', 'refresh', 'off')
+_lock = threading.Lock()
+
+
+class CacheMissError(IOError):
+    """
+    Raised in 'replay' mode when a query isn't in the cache.
+    """
+
+
+def normalize_query(query):
+    """
+    Collapses all runs of whitespace in `query` to single spaces, so that
+    queries that differ only in indentation or line breaks share a cache
+    entry.
+    """
+    return ' '.join(query.split())
+
+
+def query_key(endpoint, format, query, extra=None):
+    """
+    The cache key (a hex digest) for a query.
+
+    Parameters
+    ----------
+    endpoint : str
+        The URL the query is sent to
+    format : str
+        The format of the result (e.g. 'csv')
+    query : str
+        The query text
+    extra : json-able or None
+        Anything else that changes the result (e.g. an uploaded list)
+
+    Returns
+    -------
+    key : str
+    """
+    keydata = json.dumps([endpoint, format, normalize_query(query), extra],
+                         sort_keys=True)
+    return hashlib.sha1(keydata.encode('utf-8')).hexdigest()
+
+
+def _check_mode(mode):
+    if mode not in _MODES:
+        raise ValueError('Invalid query cache mode "{0}" - must be one of '
+                         '{1}'.format(mode, _MODES))
+    return mode
+
+
+def _entry_fn(key, cachedir=None):
+    return os.path.join(CACHE_DIR if cachedir is None else cachedir, key + '.dat')
+
+
+def open_cached(key, mode=None, cachedir=None):
+    """
+    Opens the cached response for `key` as a (binary) file, or returns None
+    if it isn't cached (or if the cache is not being read in this `mode`).
+
+    Raises a `CacheMissError` for a missing key in 'replay' mode.
+    """
+    mode = _check_mode(MODE if mode is None else mode)
+    if mode in ('off', 'refresh'):
+        return None
+
+    fn = _entry_fn(key, cachedir)
+    try:
+        f = open(fn, 'rb')
+    except (IOError, OSError):
+        if mode == 'replay':
+            raise CacheMissError('Query with key {0} is not in the cache (in '
+                                 'replay-only mode)'.format(key))
+        return None
+
+    # bump the access time for the LRU eviction
+    try:
+        os.utime(fn, None)
+    except OSError:
+        pass
+    return f
+
+
+def get_cached(key, mode=None, cachedir=None):
+    """
+    Gets the cached response for `key` (as bytes), or None if it isn't cached
+    (or if the cache is not being read in this `mode`).
+
+    Raises a `CacheMissError` for a missing key in 'replay' mode.
+    """
+    f = open_cached(key, mode, cachedir)
+    if f is None:
+        return None
+    with f:
+        return f.read()
+
+
+def put_cached(key, data, mode=None, cachedir=None, maxbytes=None):
+    """
+    Stores `data` (bytes) as the response for `key`, and evicts old entries
+    if that takes the cache over `maxbytes` (default `MAX_BYTES`).
+    """
+    mode = _check_mode(MODE if mode is None else mode)
+    if mode in ('off', 'replay'):
+        return
+
+    tmpfn, f = _open_temp_entry(key, cachedir)
+    with f:
+        f.write(data)
+    _commit_temp_entry(tmpfn, key, cachedir, maxbytes)
+
+
+def _open_temp_entry(key, cachedir=None):
+    # a new file to write the response for `key` to, which only becomes the
+    # cache entry when passed to `_commit_temp_entry`
+    cachedir = CACHE_DIR if cachedir is None else cachedir
+    with _lock:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+    tmpfn = '{0}.tmp{1}-{2}'.format(_entry_fn(key, cachedir), os.getpid(),
+                                    threading.current_thread().ident)
+    return tmpfn, open(tmpfn, 'wb')
+
+
+def _commit_temp_entry(tmpfn, key, cachedir=None, maxbytes=None):
+    cachedir = CACHE_DIR if cachedir is None else cachedir
+    fn = _entry_fn(key, cachedir)
+    with _lock:
+        if os.path.exists(fn):
+            os.remove(fn)
+        os.rename(tmpfn, fn)
+
+        evict(cachedir, MAX_BYTES if maxbytes is None else maxbytes)
+
+
+def evict(cachedir=None, maxbytes=None):
+    """
+    Removes the least recently used responses until the cache is no bigger
+    than `maxbytes`.
+
+    Returns
+    -------
+    nremoved : int
+        The number of responses removed
+    """
+    cachedir = CACHE_DIR if cachedir is None else cachedir
+    maxbytes = MAX_BYTES if maxbytes is None else maxbytes
+
+    entries = []
+    for fn in os.listdir(cachedir):
+        if fn.endswith('.dat'):
+            st = os.stat(os.path.join(cachedir, fn))
+            entries.append((st.st_mtime, st.st_size, fn))
+
+    total = sum([e[1] for e in entries])
+    nremoved = 0
+    for mtime, size, fn in sorted(entries):
+        if total <= maxbytes:
+            break
+        os.remove(os.path.join(cachedir, fn))
+        total -= size
+        nremoved += 1
+    return nremoved
+
+
+def clear(cachedir=None):
+    """
+    Removes all cached responses.
+    """
+    cachedir = CACHE_DIR if cachedir is None else cachedir
+    if os.path.isdir(cachedir):
+        for fn in os.listdir(cachedir):
+            if fn.endswith('.dat'):
+                os.remove(os.path.join(cachedir, fn))
+
+
+class cached_response(object):
+    """
+    A context manager giving a file-like response for `key`, either from the
+    cache or from calling `opener`.
+
+    A cached response is read straight from its file in the cache.  When the
+    response comes from `opener`, everything read from it is also written to
+    a temporary file in the cache directory, which becomes the cache entry
+    when the block exits - but only if the whole response was read and no
+    exception was raised, so errors and partial downloads are never cached.
+    Either way, the response is never held in memory all at once.
+
+    Parameters
+    ----------
+    key : str
+        The cache key (see `query_key`)
+    opener : callable
+        Called with no arguments to get the live response (e.g. the result of
+        `urlopen`) on a cache miss.
+    mode : str or None
+        The cache mode, or None to use `MODE`
+    """
+    def __init__(self, key, opener, mode=None):
+        self.key = key
+        self.opener = opener
+        self.mode = mode
+        self.fromcache = False
+
+    def __enter__(self):
+        mode = _check_mode(MODE if self.mode is None else self.mode)
+        f = open_cached(self.key, mode)
+        if f is not None:
+            self.fromcache = True
+            self._response = _CachedResponse(f)
+        elif mode == 'off':
+            self._response = self.opener()
+        else:
+            response = self.opener()
+            try:
+                tmpfn, recordfile = _open_temp_entry(self.key)
+            except:
+                response.close()
+                raise
+            self._response = _RecordingResponse(response, tmpfn, recordfile)
+        return self._response
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._response.close()
+        if isinstance(self._response, _RecordingResponse):
+            if exc_type is None and self._response.complete:
+                _commit_temp_entry(self._response.tmpfn, self.key)
+            elif os.path.exists(self._response.tmpfn):
+                os.remove(self._response.tmpfn)
+        return False
+
+
+class _CachedResponse(object):
+    complete = True
+
+    def __init__(self, f):
+        self._file = f
+        self.headers = {'content-length': str(os.fstat(f.fileno()).st_size)}
+
+    def read(self, size=-1):
+        return self._file.read(size)
+
+    def readline(self):
+        return self._file.readline()
+
+    def close(self):
+        self._file.close()
+
+
+class _RecordingResponse(object):
+    def __init__(self, response, tmpfn, recordfile):
+        self._response = response
+        self.headers = getattr(response, 'headers', {})
+        self.tmpfn = tmpfn
+        self._recordfile = recordfile
+        self.complete = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self._response.read()
+            self.complete = True
+        else:
+            data = self._response.read(size)
+            if not data:
+                self.complete = True
+        self._recordfile.write(data)
+        return data
+
+    def readline(self):
+        data = self._response.readline()
+        if not data:
+            self.complete = True
+        self._recordfile.write(data)
+        return data
+
+    def close(self):
+        self._recordfile.close()
+        self._response.close()
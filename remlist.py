@@ -0,0 +1,392 @@
+"""
+The target remove list, as used by `targeting.remove_targets_with_remlist`.
+
+A remove list is either the google spreadsheet of by-eye rejected targets
+(exported as csv, with columns host name, NSA number, objID, ra, dec after two
+header lines), or one of the per-host files in ``removed_objects/`` (a
+whitespace-separated table with an "objid ra dec" header line, where every
+entry is for the same host).
+
+Lists are parsed into a `RemoveList` once per session, with the entries
+grouped by host name and NSA number, so looking up a host is a dictionary
+lookup.  Downloaded lists are also stored in `CACHE_DIR`, and only
+re-downloaded if the copy there was last checked more than `MAX_AGE` seconds
+ago *and* the server says the list has changed since then (an HTTP
+conditional request).  If the server can't be reached, the stored copy is
+used.
+"""
+from __future__ import division, print_function
+
+import os
+import csv
+import json
+import time
+import hashlib
+import threading
+
+import numpy as np
+
+try:
+    import six
+except ImportError:
+    from astropy.extern import six
+
+
+CACHE_DIR = os.path.join('catalogs', 'remlistcache')
+MAX_AGE = 600  # seconds before a downloaded list is checked for changes again
+
+_lock = threading.RLock()
+_remlists = {}
+
+
+class RemoveList(object):
+    """
+    A parsed remove list.
+
+    Parameters
+    ----------
+    hostnames : list of str
+        The host name for each entry
+    nsaids : int array
+        The NSA number of the host for each entry (-1 if not given)
+    objids : int array
+        The SDSS objID of each entry (-1 if not given)
+    ra : float array
+        The RA of each entry in degrees (nan if not given)
+    dec : float array
+        The Dec of each entry in degrees (nan if not given)
+    anyhost : bool
+        If True, the entries apply to whichever host is asked for (as for the
+        per-host files), rather than being grouped by host.
+    """
+    def __init__(self, hostnames, nsaids, objids, ra, dec, anyhost=False):
+        self.hostnames = list(hostnames)
+        self.nsaids = np.asarray(nsaids, dtype=np.int64)
+        self.objids = np.asarray(objids, dtype=np.int64)
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.anyhost = anyhost
+
+        byname = {}
+        bynsa = {}
+        for i, (nm, nsaid) in enumerate(zip(self.hostnames, self.nsaids)):
+            byname.setdefault(nm, []).append(i)
+            if nsaid >= 0:
+                bynsa.setdefault(int(nsaid), []).append(i)
+        self._byname = dict([(k, np.array(v)) for k, v in byname.items()])
+        self._bynsa = dict([(k, np.array(v)) for k, v in bynsa.items()])
+
+    def __len__(self):
+        return len(self.objids)
+
+    @classmethod
+    def from_text(cls, text):
+        """
+        Parses the contents of a remove list file (either format).  Lines
+        that are missing the objid or the position are kept (and only matched
+        using what they have), and lines with neither are skipped.
+        """
+        if not isinstance(text, str):
+            text = text.decode('utf-8')  # bytes on py3
+        lines = text.splitlines()
+
+        if lines and lines[0].split() == ['objid', 'ra', 'dec']:
+            fieldses = [(l, [''] * 2 + l.split()) for l in lines[1:]]
+            anyhost = True
+        else:
+            # [2:] is to skip header lines
+            fieldses = [(l, f) for l, f in zip(lines[2:], csv.reader(lines[2:]))]
+            anyhost = False
+
+        hostnames = []
+        nsaids = []
+        entries = []
+        for l, fields in fieldses:
+            if ''.join(fields).strip() == '':
+                continue  # empty line
+            fields = list(fields) + [''] * (5 - len(fields))
+            entry = _parse_entry(fields)
+            if entry is None:
+                print('Skipping remove list line "{0}" because it has neither '
+                      'an objid nor a position'.format(l))
+                continue
+            hostnames.append(fields[0])
+            nsaids.append(_to_number(fields[1], int, -1))
+            entries.append(entry)
+
+        objids = np.array([e[0] for e in entries], dtype=np.int64)
+        ra = np.array([e[1] for e in entries], dtype=float)
+        dec = np.array([e[2] for e in entries], dtype=float)
+        return cls(hostnames, nsaids, objids, ra, dec, anyhost)
+
+    def rows_for(self, hostname, nsanum=None):
+        """
+        The entries for a host, in the order they are in the list.
+
+        Parameters
+        ----------
+        hostname : str
+            The name of the host
+        nsanum : int or None
+            The NSA number of the host.  Entries with either this number or
+            `hostname` are included.
+
+        Returns
+        -------
+        rows : int array
+        """
+        if self.anyhost:
+            return np.arange(len(self))
+
+        rows = self._byname.get(hostname, np.array([], dtype=int))
+        if nsanum is not None and int(nsanum) in self._bynsa:
+            rows = np.union1d(rows, self._bynsa[int(nsanum)])
+        return rows
+
+    def match(self, cat, hostname, nsanum=None, matchtol=0.1/3600):
+        """
+        Finds the objects in `cat` that are on this list for a host.
+
+        Entries are found first by objID, and those that aren't (e.g. because
+        the catalog came from a different SDSS data release) are matched by
+        position to the closest object in `cat`.  Both are done for all the
+        entries at once.
+
+        Parameters
+        ----------
+        cat : astropy.table.Table
+            The catalog, with 'objID', 'ra', and 'dec' columns
+        hostname : str
+            The name of the host
+        nsanum : int or None
+            The NSA number of the host
+        matchtol : float
+            How close (in degrees) a positional match has to be
+
+        Returns
+        -------
+        remove : bool array
+            True for the objects in `cat` that are on the list
+        nmatched : int
+            The number of list entries that were found
+        unmatched : list of (objid, sep) tuples
+            The entries that were not found, with the distance (in degrees)
+            to the closest object in `cat` (nan for entries with no position)
+        """
+        rows = self.rows_for(hostname, nsanum)
+        catids = np.asarray(cat['objID']).astype(np.int64)
+        remove = np.zeros(len(catids), dtype=bool)
+        if len(rows) == 0:
+            return remove, 0, []
+
+        objids = self.objids[rows]
+        byid = np.isin(objids, catids)
+        remove |= np.isin(catids, objids[byid])
+
+        # entries without a position can only be matched by objid
+        rest = np.flatnonzero(~byid)
+        sep = np.full(len(rest), np.nan)
+        haspos = np.isfinite(self.ra[rows[rest]]) & np.isfinite(self.dec[rows[rest]])
+        if np.any(haspos):
+            idx, sep[haspos] = _closest(self.ra[rows[rest[haspos]]],
+                                        self.dec[rows[rest[haspos]]],
+                                        np.asarray(cat['ra'], dtype=float),
+                                        np.asarray(cat['dec'], dtype=float))
+            bypos = sep[haspos] < matchtol
+            remove[idx[bypos]] = True
+        nomatch = ~(sep < matchtol)
+        unmatched = list(zip(objids[rest[nomatch]], sep[nomatch]))
+        return remove, len(rows) - len(unmatched), unmatched
+
+
+def _to_number(s, typ, default):
+    try:
+        return typ(s)
+    except (TypeError, ValueError):
+        return default
+
+
+def _parse_entry(fields):
+    # (objid, ra, dec) from the objid, ra, dec fields of a line, with -1 for
+    # a missing objid and nan for a missing position, or None if it has neither
+    objid = _to_number(fields[2].strip(), int, -1)
+    ra = _to_number(fields[3].strip(), float, np.nan)
+    dec = _to_number(fields[4].strip(), float, np.nan)
+    if not (np.isfinite(ra) and np.isfinite(dec)):
+        ra = dec = np.nan
+    if objid < 0 and np.isnan(ra):
+        return None
+    return objid, ra, dec
+
+
+def _unit_vectors(ra, dec):
+    ra = np.radians(ra)
+    dec = np.radians(dec)
+    return np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)]).T.reshape(-1, 3)
+
+
+def _closest(ra, dec, catra, catdec):
+    # the closest object in the catalog to each position, and the distance in degrees
+    from scipy import spatial
+
+    if len(catra) == 0:
+        return np.zeros(len(ra), dtype=int), np.full(len(ra), np.inf)
+
+    chord, idx = spatial.cKDTree(_unit_vectors(catra, catdec)).query(_unit_vectors(ra, dec))
+    return idx, np.degrees(2 * np.arcsin(np.minimum(chord / 2, 1)))
+
+
+def _entry_fns(url, cachedir=None):
+    cachedir = CACHE_DIR if cachedir is None else cachedir
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+    return os.path.join(cachedir, key + '.csv'), os.path.join(cachedir, key + '.json')
+
+
+def fetch_remove_list(url, refresh='auto', cachedir=None):
+    """
+    Gets the contents of the remove list at `url`, using the copy in
+    `CACHE_DIR` if it is still current.
+
+    Parameters
+    ----------
+    url : str
+        The URL of the list
+    refresh : 'auto' or bool
+        'auto' uses the stored copy if it was checked in the last `MAX_AGE`
+        seconds, and otherwise asks the server if the list has changed.  True
+        always asks the server, and False always uses the stored copy if
+        there is one.
+    cachedir : str or None
+        The cache directory or None for `CACHE_DIR`
+
+    Returns
+    -------
+    content : bytes
+        The contents of the list
+    """
+    Request = six.moves.urllib.request.Request
+    urlopen = six.moves.urllib.request.urlopen
+    HTTPError = six.moves.urllib.error.HTTPError
+
+    datafn, metafn = _entry_fns(url, cachedir)
+    meta = None
+    if os.path.isfile(datafn) and os.path.isfile(metafn):
+        try:
+            with open(metafn) as f:
+                meta = json.load(f)
+        except ValueError:
+            meta = None
+
+    def read_stored():
+        with open(datafn, 'rb') as f:
+            return f.read()
+
+    if meta is not None and refresh is not True:
+        if refresh is False or time.time() - meta.get('checked', 0) < MAX_AGE:
+            return read_stored()
+
+    headers = {}
+    if meta is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last-modified'):
+            headers['If-Modified-Since'] = meta['last-modified']
+
+    try:
+        uo = urlopen(Request(url, headers=headers))
+        try:
+            content = uo.read()
+            respheaders = uo.info()
+        finally:
+            uo.close()
+    except HTTPError as e:
+        if e.code == 304 and meta is not None:
+            content = None
+        elif meta is not None:
+            print('Could not check remove list ({0}), so using stored copy '
+                  '"{1}"'.format(e, datafn))
+            return read_stored()
+        else:
+            raise
+    except (IOError, OSError) as e:
+        if meta is None:
+            raise
+        print('Could not check remove list ({0}), so using stored copy '
+              '"{1}"'.format(e, datafn))
+        return read_stored()
+
+    with _lock:
+        if not os.path.isdir(os.path.dirname(datafn)):
+            os.makedirs(os.path.dirname(datafn))
+        if content is None:
+            content = read_stored()
+        else:
+            tmpfn = datafn + '.tmp{0}'.format(os.getpid())
+            with open(tmpfn, 'wb') as f:
+                f.write(content)
+            if os.path.exists(datafn):
+                os.remove(datafn)
+            os.rename(tmpfn, datafn)
+            meta = {'url': url, 'etag': respheaders.get('ETag'),
+                    'last-modified': respheaders.get('Last-Modified')}
+        meta['checked'] = time.time()
+        with open(metafn, 'w') as f:
+            json.dump(meta, f)
+    return content
+
+
+def get_remove_list(listfnorurl, refresh='auto'):
+    """
+    Gets the `RemoveList` for a local file or URL.  The parsed list is kept
+    for the rest of the session, and only re-parsed if the file (or the
+    downloaded list) changes.
+
+    Parameters
+    ----------
+    listfnorurl : str
+        A local path to a remove list file or a URL to the google spreadsheet
+    refresh : 'auto' or bool
+        How to check for changes in a downloaded list (see
+        `fetch_remove_list`).
+
+    Returns
+    -------
+    remlist : RemoveList
+    """
+    isurl = listfnorurl.startswith('http://') or listfnorurl.startswith('https://')
+
+    with _lock:
+        cached = _remlists.get(listfnorurl)
+        if isurl:
+            if (cached is not None and refresh is not True and
+                    (refresh is False or time.time() - cached[2] < MAX_AGE)):
+                return cached[0]
+            content = fetch_remove_list(listfnorurl, refresh)
+            version = hashlib.sha1(content).hexdigest()
+        else:
+            st = os.stat(listfnorurl)
+            version = (st.st_mtime, st.st_size)
+            content = None
+
+        if cached is not None and cached[1] == version:
+            remlist = cached[0]
+        else:
+            if content is None:
+                with open(listfnorurl, 'rb') as f:
+                    content = f.read()
+            remlist = RemoveList.from_text(content)
+        _remlists[listfnorurl] = (remlist, version, time.time())
+    return remlist
+
+
+def clear():
+    """
+    Forgets all the remove lists parsed in this session and removes the
+    stored copies of downloaded lists.
+    """
+    with _lock:
+        _remlists.clear()
+        if os.path.isdir(CACHE_DIR):
+            for fn in os.listdir(CACHE_DIR):
+                if fn.endswith('.csv') or fn.endswith('.json'):
+                    os.remove(os.path.join(CACHE_DIR, fn))
@@ -0,0 +1,539 @@
+"""
+Selection expressions for catalogs, like ``'(g-Ag)-(r-Ar) < 1.3 +- 2sigma'``.
+
+A cut is a (possibly chained) comparison of an arithmetic expression of
+column names with numbers, optionally followed by ``+- <n>sigma`` (or with
+the unicode plus-minus and sigma signs), which widens the limits by `n` times
+the uncertainty of the expression.  The uncertainty comes from the ``<col>_err`` (or
+``<col>err``) columns of the columns in the expression that have them, added
+in quadrature - so for colors it's the photometric errors, while the
+extinction columns don't contribute.
+
+`compile_cuts` turns a list of cuts into a `SelectionPlan`, which evaluates
+every distinct sub-expression (e.g. a dereddened magnitude used by two
+colors) only once, and works through the catalog in chunks of `CHUNK_SIZE`
+rows re-using the same few buffers, so big catalogs don't need lots of
+full-length temporaries.  The chunks can also be spread over `NTHREADS`
+threads.  An `ExpressionCache` keeps the full values of expressions for one
+catalog, for when the same colors are needed over and over.
+
+`colorcuts_to_cuts` converts the ``colorcuts`` dictionaries used by
+`targeting.select_targets` to cuts.
+"""
+from __future__ import division, print_function
+
+import re
+import ast
+
+import numpy as np
+
+try:
+    import six
+except ImportError:
+    from astropy.extern import six
+
+
+CHUNK_SIZE = 2**16  # rows to evaluate at a time
+NTHREADS = 1  # threads to evaluate the chunks with
+
+_SIGMA_RE = re.compile(u'(?:\u00b1|\\+/?-)\\s*([0-9.]+(?:[eE][+-]?[0-9]+)?)\\s*(?:\u03c3|sigma)\\s*$')
+
+_BINOPS = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/'}
+_UFUNCS = {'+': np.add, '-': np.subtract, '*': np.multiply, '/': np.true_divide}
+
+
+def parse_expression(text):
+    """
+    Parses an arithmetic expression of column names and numbers (with ``+``,
+    ``-``, ``*``, ``/`` and parentheses).
+
+    Returns
+    -------
+    node : tuple
+        The expression as nested tuples: ``('col', name)``, ``('num',
+        value)``, ``('neg', node)``, or ``(op, node1, node2)``.  Equal
+        expressions give equal tuples, which is what lets a `SelectionPlan`
+        share them.
+    """
+    try:
+        tree = ast.parse(text.strip(), mode='eval').body
+    except SyntaxError:
+        raise ValueError('Could not parse expression "{0}"'.format(text))
+    return _node_from_ast(tree, text)
+
+
+def _node_from_ast(node, text):
+    if isinstance(node, ast.Name):
+        return ('col', node.id)
+    elif isinstance(node, getattr(ast, 'Constant', ())) and isinstance(node.value, (int, float)):
+        return ('num', float(node.value))
+    elif isinstance(node, getattr(ast, 'Num', ())):
+        return ('num', float(node.n))
+    elif isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.USub, ast.UAdd)):
+        operand = _node_from_ast(node.operand, text)
+        if isinstance(node.op, ast.UAdd):
+            return operand
+        if operand[0] == 'num':
+            return ('num', -operand[1])
+        return ('neg', operand)
+    elif isinstance(node, ast.BinOp) and type(node.op) in _BINOPS:
+        return (_BINOPS[type(node.op)], _node_from_ast(node.left, text),
+                _node_from_ast(node.right, text))
+    raise ValueError('Unsupported syntax in expression "{0}"'.format(text))
+
+
+def _node_columns(node, cols=None):
+    # the column names in `node`, in order of first appearance
+    cols = [] if cols is None else cols
+    if node[0] == 'col':
+        if node[1] not in cols:
+            cols.append(node[1])
+    elif node[0] != 'num':
+        for child in node[1:]:
+            _node_columns(child, cols)
+    return cols
+
+
+class Cut(object):
+    """
+    A single cut, ``lo < expr < hi``.
+
+    Parameters
+    ----------
+    expr : str or tuple
+        The expression (see `parse_expression`)
+    lo, hi : float or None
+        The limits, or None for no limit on that side
+    nsigma : float
+        The limits are widened by this many times the uncertainty of `expr`
+    loinclusive, hiinclusive : bool
+        Whether the limits are ``<=`` rather than ``<``
+    text : str or None
+        The text the cut was parsed from, if any (used when printing)
+    """
+    def __init__(self, expr, lo=None, hi=None, nsigma=0, loinclusive=False,
+                 hiinclusive=False, text=None):
+        if isinstance(expr, six.string_types):
+            expr = parse_expression(expr)
+        if lo is not None and hi is not None and not lo < hi:
+            raise ValueError('lower limit of cut not below upper limit: ' + str((lo, hi)))
+        self.expr = expr
+        self.lo = lo
+        self.hi = hi
+        self.nsigma = nsigma
+        self.loinclusive = loinclusive
+        self.hiinclusive = hiinclusive
+        self.text = text
+
+    def __repr__(self):
+        return '<Cut {0}>'.format(self.text if self.text else (self.lo, self.expr, self.hi, self.nsigma))
+
+
+def parse_cut(text):
+    """
+    Parses a cut like ``'g-r < 1.3'``, ``'-0.5 < r-i <= 0.5'`` or
+    ``'(g-Ag)-(r-Ar) < 1.3 +- 2sigma'``.
+
+    Returns
+    -------
+    cut : Cut
+    """
+    m = _SIGMA_RE.search(text)
+    if m:
+        nsigma = float(m.group(1))
+        body = text[:m.start()]
+    else:
+        nsigma = 0
+        body = text
+
+    try:
+        tree = ast.parse(body.strip(), mode='eval').body
+    except SyntaxError:
+        raise ValueError('Could not parse cut "{0}"'.format(text))
+    if not isinstance(tree, ast.Compare):
+        raise ValueError('Cut "{0}" is not a comparison'.format(text))
+
+    operands = [_node_from_ast(nd, text) for nd in [tree.left] + tree.comparators]
+    ops = []
+    for op in tree.ops:
+        if isinstance(op, (ast.Lt, ast.LtE)):
+            ops.append(('<', isinstance(op, ast.LtE)))
+        elif isinstance(op, (ast.Gt, ast.GtE)):
+            ops.append(('>', isinstance(op, ast.GtE)))
+        else:
+            raise ValueError('Cut "{0}" can only use <, <=, >, or >='.format(text))
+    if len(set([direction for direction, _ in ops])) > 1:
+        raise ValueError('Cut "{0}" mixes < and >'.format(text))
+    if ops[0][0] == '>':
+        # flip "hi > expr > lo" around to "lo < expr < hi"
+        operands = operands[::-1]
+        ops = [('<', incl) for _, incl in ops[::-1]]
+
+    if len(ops) == 2:
+        if operands[0][0] != 'num' or operands[2][0] != 'num':
+            raise ValueError('Cut "{0}" should look like "lo < expr < hi"'.format(text))
+        return Cut(operands[1], operands[0][1], operands[2][1], nsigma,
+                   ops[0][1], ops[1][1], text)
+    elif len(ops) == 1:
+        if operands[1][0] == 'num':
+            return Cut(operands[0], None, operands[1][1], nsigma,
+                       hiinclusive=ops[0][1], text=text)
+        elif operands[0][0] == 'num':
+            return Cut(operands[1], operands[0][1], None, nsigma,
+                       loinclusive=ops[0][1], text=text)
+    raise ValueError('Cut "{0}" should compare an expression to numbers'.format(text))
+
+
+def colorcuts_to_cuts(colorcuts, deredden=True):
+    """
+    Converts a ``colorcuts`` dictionary (see `targeting.colorcut_mask`) to a
+    list of `Cut` objects.
+
+    Returns
+    -------
+    cuts : list
+        The cuts, in the order of `colorcuts`.  Any ``'funcs'`` entry's
+        functions are included as they are (`SelectionPlan` calls them with
+        the catalog).
+    """
+    cuts = []
+    for k, v in colorcuts.items():
+        if k == 'funcs':
+            cuts.extend(v)
+            continue
+
+        c1, c2 = k.split('-')
+        if deredden:
+            expr = ('-', ('-', ('col', c1), ('col', 'A' + c1)),
+                         ('-', ('col', c2), ('col', 'A' + c2)))
+        else:
+            expr = ('-', ('col', c1), ('col', c2))
+
+        if len(v) == 3:
+            bluec, redc, nsigma = v
+        else:
+            bluec, redc = v
+            nsigma = 0
+        # the limits are always used, so NaN colors never pass
+        bluec = -float('inf') if bluec is None else bluec
+        redc = float('inf') if redc is None else redc
+        cuts.append(Cut(expr, bluec, redc, nsigma, text=k))
+    return cuts
+
+
+def compile_cuts(cuts):
+    """
+    Compiles a list of cuts (`Cut` objects, strings for `parse_cut`, or
+    functions that take the catalog and return a mask) into a
+    `SelectionPlan`.
+    """
+    return SelectionPlan(cuts)
+
+
+class SelectionPlan(object):
+    """
+    A compiled list of cuts, for evaluating on catalogs.
+
+    Use `compile_cuts` to make one.  The distinct sub-expressions of all the
+    cuts are worked out up front, so each is computed just once per chunk of
+    the catalog, however many cuts use it.
+
+    Parameters
+    ----------
+    cuts : list
+        `Cut` objects, strings for `parse_cut`, or functions that take the
+        catalog and return a mask.
+    """
+    def __init__(self, cuts):
+        self.cuts = [parse_cut(c) if isinstance(c, six.string_types) else c for c in cuts]
+
+        self._nodes = []
+        self._nodeidx = {}
+        self._cutnodes = []
+        for cut in self.cuts:
+            self._cutnodes.append(None if callable(cut) else self._add_node(cut.expr))
+
+        # how many times each node is used, so buffers can be re-used once
+        # nothing else needs them
+        self._nuses = [0] * len(self._nodes)
+        for node in self._nodes:
+            for child in self._children(node):
+                self._nuses[child] += 1
+        for i in self._cutnodes:
+            if i is not None:
+                self._nuses[i] += 1
+
+    def _add_node(self, node):
+        if node not in self._nodeidx:
+            if node[0] == 'neg':
+                node = ('neg', self._add_node(node[1]))
+            elif node[0] in _UFUNCS:
+                node = (node[0], self._add_node(node[1]), self._add_node(node[2]))
+            if node not in self._nodeidx:
+                self._nodeidx[node] = len(self._nodes)
+                self._nodes.append(node)
+            return self._nodeidx[node]
+        return self._nodeidx[node]
+
+    @staticmethod
+    def _children(node):
+        if node[0] == 'neg':
+            return node[1:]
+        elif node[0] in _UFUNCS:
+            return node[1:]
+        return ()
+
+    def mask(self, cat, chunksize=None, nthreads=None, expressions=None,
+             withcounts=False):
+        """
+        Evaluates the cuts on a catalog.
+
+        Parameters
+        ----------
+        cat : astropy.table.Table
+            The catalog
+        chunksize : int or None
+            Rows to evaluate at a time, or None for `CHUNK_SIZE`
+        nthreads : int or None
+            Threads to evaluate the chunks with, or None for `NTHREADS`
+        expressions : ExpressionCache or None
+            If given, the full values of the cut expressions come from (and
+            are kept in) this cache, so only the comparisons are done here.
+        withcounts : bool
+            If True, also return how many entries each cut removes.
+
+        Returns
+        -------
+        msk : bool array
+            True for catalog entries that pass all the cuts.  Entries where
+            any column used by a cut is masked fail that cut.
+        nremoved : int array
+            The number of entries that fail each cut (on its own).  Only
+            returned if `withcounts` is True.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        chunksize = CHUNK_SIZE if chunksize is None else chunksize
+        nthreads = NTHREADS if nthreads is None else nthreads
+        n = len(cat)
+
+        colvals = {}
+        colmasks = {}
+        for node in self._nodes:
+            if node[0] == 'col' and node[1] not in colvals:
+                colvals[node[1]], colmasks[node[1]] = _column_data(cat, node[1])
+
+        cutinfo = []
+        for cut, i in zip(self.cuts, self._cutnodes):
+            if i is None:
+                fmsk = np.asarray(cut(cat), dtype=bool)
+                cutinfo.append((fmsk, None, None))
+                continue
+
+            cols = _node_columns(cut.expr)
+            invalid = None
+            for nm in cols:
+                if colmasks[nm] is not None:
+                    invalid = colmasks[nm] if invalid is None else invalid | colmasks[nm]
+            errs = []
+            if cut.nsigma:
+                for nm in cols:
+                    errnm = _error_column_name(cat, nm)
+                    if errnm is not None:
+                        errs.append(errnm)
+                        if errnm not in colvals:
+                            colvals[errnm], colmasks[errnm] = _column_data(cat, errnm)
+                        if colmasks[errnm] is not None:
+                            invalid = colmasks[errnm] if invalid is None else invalid | colmasks[errnm]
+                if not errs:
+                    raise ValueError('No uncertainty columns for the columns in cut {0}'.format(cut))
+            full = None
+            if expressions is not None:
+                full = expressions.values(self._nodes_to_tuple(i), masked=False)
+            cutinfo.append((full, errs, invalid))
+
+        msk = np.ones(n, dtype=bool)
+        chunks = [slice(i, min(i + chunksize, n)) for i in range(0, n, chunksize)]
+
+        def do_chunk(s):
+            return self._evaluate_chunk(s, colvals, cutinfo, msk)
+
+        if nthreads > 1 and len(chunks) > 1:
+            pool = ThreadPool(nthreads)
+            try:
+                nfails = pool.map(do_chunk, chunks)
+            finally:
+                pool.close()
+        else:
+            nfails = [do_chunk(s) for s in chunks]
+
+        if withcounts:
+            nremoved = np.sum(nfails, axis=0) if nfails else np.zeros(len(self.cuts), dtype=int)
+            return msk, nremoved
+        return msk
+
+    def _nodes_to_tuple(self, i):
+        node = self._nodes[i]
+        if node[0] == 'neg':
+            return ('neg', self._nodes_to_tuple(node[1]))
+        elif node[0] in _UFUNCS:
+            return (node[0], self._nodes_to_tuple(node[1]), self._nodes_to_tuple(node[2]))
+        return node
+
+    def _evaluate_chunk(self, s, colvals, cutinfo, msk):
+        length = s.stop - s.start
+        free = []  # buffers that can be re-used
+
+        def buffer():
+            return free.pop() if free else np.empty(length)
+
+        nuses = list(self._nuses)
+        vals = [None] * len(self._nodes)
+        temp = [False] * len(self._nodes)
+
+        def release(i):
+            nuses[i] -= 1
+            if nuses[i] == 0 and temp[i]:
+                free.append(vals[i])
+                vals[i] = None
+
+        needed = set()
+        for (full, errs, invalid), i in zip(cutinfo, self._cutnodes):
+            if i is not None and full is None:
+                needed.add(i)
+        needed = self._with_descendants(needed)
+
+        for i, node in enumerate(self._nodes):
+            if i not in needed:
+                continue
+            kind = node[0]
+            if kind == 'col':
+                vals[i] = colvals[node[1]][s]
+            elif kind == 'num':
+                vals[i] = node[1]
+            elif kind == 'neg':
+                out = buffer()
+                np.negative(vals[node[1]], out=out)
+                vals[i], temp[i] = out, True
+                release(node[1])
+            else:
+                out = buffer()
+                _UFUNCS[kind](vals[node[1]], vals[node[2]], out=out)
+                vals[i], temp[i] = out, True
+                release(node[1])
+                release(node[2])
+
+        nfail = np.zeros(len(self.cuts), dtype=int)
+        chunkmsk = msk[s]
+        cmsk = np.empty(length, dtype=bool)
+        tmpmsk = np.empty(length, dtype=bool)
+        for j, (cut, (full, errs, invalid), i) in enumerate(zip(self.cuts, cutinfo, self._cutnodes)):
+            if i is None:
+                cmsk[:] = full[s]
+            else:
+                val = vals[i] if full is None else full[s]
+                unc = None
+                if errs:
+                    unc = buffer()
+                    e = colvals[errs[0]][s]
+                    np.multiply(e, e, out=unc)
+                    for errnm in errs[1:]:
+                        e = colvals[errnm][s]
+                        unc += e * e
+                    np.sqrt(unc, out=unc)
+                    unc *= cut.nsigma
+                cmsk[:] = True
+                if cut.lo is not None:
+                    lim = cut.lo if unc is None else cut.lo - unc
+                    (np.less_equal if cut.loinclusive else np.less)(lim, val, out=tmpmsk)
+                    cmsk &= tmpmsk
+                if cut.hi is not None:
+                    lim = cut.hi if unc is None else cut.hi + unc
+                    (np.less_equal if cut.hiinclusive else np.less)(val, lim, out=tmpmsk)
+                    cmsk &= tmpmsk
+                if unc is not None:
+                    free.append(unc)
+                if invalid is not None:
+                    cmsk &= ~invalid[s]
+                if full is None:
+                    release(i)
+            nfail[j] = length - np.count_nonzero(cmsk)
+            chunkmsk &= cmsk
+        return nfail
+
+    def _with_descendants(self, idxs):
+        out = set()
+        stack = list(idxs)
+        while stack:
+            i = stack.pop()
+            if i not in out:
+                out.add(i)
+                stack.extend(self._children(self._nodes[i]))
+        return out
+
+
+class ExpressionCache(object):
+    """
+    The values of expressions for one catalog, each computed the first time
+    it's asked for.
+
+    Parameters
+    ----------
+    cat : astropy.table.Table
+        The catalog.  If its columns change, make a new cache.
+    """
+    def __init__(self, cat):
+        self.catalog = cat
+        self._values = {}
+
+    def values(self, expr, masked=True):
+        """
+        The values of `expr` (a string for `parse_expression` or a parsed
+        expression) for the whole catalog.
+
+        If `masked` is True, the result is a masked array if any of the
+        columns it uses has masked values.  Otherwise the masked values are
+        just ignored.
+        """
+        if isinstance(expr, six.string_types):
+            expr = parse_expression(expr)
+        if expr not in self._values:
+            self._values[expr] = self._evaluate(expr)
+        vals, invalid = self._values[expr]
+        if masked and invalid is not None:
+            return np.ma.array(vals, mask=invalid)
+        return vals
+
+    __getitem__ = values
+
+    def _evaluate(self, node):
+        kind = node[0]
+        if kind == 'col':
+            return _column_data(self.catalog, node[1])
+        elif kind == 'num':
+            return np.full(len(self.catalog), node[1]), None
+        elif kind == 'neg':
+            vals, invalid = self.values(node[1], masked=False), self._values[node[1]][1]
+            return -vals, invalid
+        else:
+            v1, v2 = self.values(node[1], masked=False), self.values(node[2], masked=False)
+            i1, i2 = self._values[node[1]][1], self._values[node[2]][1]
+            invalid = i1 if i2 is None else (i2 if i1 is None else i1 | i2)
+            return _UFUNCS[kind](v1, v2), invalid
+
+
+def _column_data(cat, colname):
+    # the data as a plain array, and the mask (or None if nothing's masked)
+    col = cat[colname]
+    mask = getattr(col, 'mask', None)
+    if mask is not None and np.any(mask):
+        return np.asarray(col.data if hasattr(col, 'data') else col), np.asarray(mask)
+    return np.asarray(col), None
+
+
+def _error_column_name(cat, colname):
+    colnames = getattr(cat, 'lazycolnames', cat.colnames)
+    for errnm in (colname + '_err', colname + 'err'):
+        if errnm in colnames:
+            return errnm
+    return None
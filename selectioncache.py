@@ -0,0 +1,254 @@
+"""
+An on-disk cache of target selections from `targeting.select_targets`.
+
+Each selection is stored in `CACHE_DIR` as the (un-randomized) row indices of
+the selected targets along with their objIDs, in a file named by a hash of
+everything the selection depends on: the catalog contents (see
+`catalog_fingerprint`), the host, all the selection parameters, and the
+version of any external catalogs used (e.g. GAMA).  The total size is kept
+under `MAX_BYTES` by evicting the least recently used selections.
+
+This is only used if `targeting.USE_SELECTION_CACHE` is True.
+"""
+from __future__ import division, print_function
+
+import os
+import json
+import hashlib
+import threading
+
+import numpy as np
+
+
+CACHE_DIR = os.path.join('catalogs', 'selectioncache')
+MAX_BYTES = 2**28
+SELECTION_CACHE_VERSION = 2  # bump this whenever `select_targets` results change
+
+_lock = threading.Lock()
+_fingerprints = {}
+
+
+def catalog_fingerprint(cat):
+    """
+    A hash (hex digest) of the contents of the catalog `cat`.
+
+    Columns that are derived from the others (the lazy columns of an
+    `hosts.SDSSCatalog`, and the ``rhost`` columns `select_targets` adds) are
+    left out, so computing them doesn't change the fingerprint.
+
+    The hash is remembered for as long as `cat` exists and has the same
+    column objects (and data buffers), so adding, replacing or resizing
+    columns gives a new fingerprint without re-reading unchanged catalogs.
+    Writing into an existing column (e.g. ``cat['r'][:] = 30``) can't be seen
+    that way, so call `catalog_changed` after doing that.
+
+    Parameters
+    ----------
+    cat : astropy.table.Table
+        The catalog
+
+    Returns
+    -------
+    fingerprint : str
+    """
+    derived = set(getattr(cat, '_lazycolumns', {})) | set(['rhost', 'rhost_kpc'])
+    colnames = tuple([nm for nm in cat.colnames if nm not in derived])
+
+    signature = [len(cat), colnames]
+    for nm in colnames:
+        col = cat[nm]
+        mask = getattr(col, 'mask', None)
+        signature.append((id(col), _buffer_signature(col),
+                          None if mask is None else (id(mask), _buffer_signature(mask))))
+    signature = tuple(signature)
+
+    # [weakref to cat, signature, fingerprint, writes hashed, writes so far]
+    memo = _fingerprints.get(id(cat))
+    if memo is None or memo[0]() is not cat:
+        memo = _fingerprints[id(cat)] = [_weakref_to(cat), None, None, 0, 0]
+    elif memo[1] == signature and memo[3] == memo[4]:
+        return memo[2]
+
+    h = hashlib.sha1()
+    h.update(json.dumps([len(cat), colnames]).encode('utf-8'))
+    for nm in colnames:
+        col = cat[nm]
+        if col.dtype.kind == 'O':
+            h.update(repr(list(col)).encode('utf-8'))
+        else:
+            _hash_array(h, col)
+        mask = getattr(col, 'mask', None)
+        if mask is not None and np.any(mask):
+            _hash_array(h, mask)
+    fingerprint = h.hexdigest()
+
+    memo[1:4] = [signature, fingerprint, memo[4]]
+    return fingerprint
+
+
+def catalog_changed(cat):
+    """
+    Tells `catalog_fingerprint` that the contents of `cat` have been changed
+    in place, so its fingerprint is recomputed the next time it's needed.
+    """
+    memo = _fingerprints.get(id(cat))
+    if memo is not None and memo[0]() is cat:
+        memo[4] += 1
+
+
+def _buffer_signature(arr):
+    """
+    Where the data of `arr` is, and its size and layout, without reading it.
+    """
+    arr = np.asarray(arr)
+    return (arr.__array_interface__['data'][0], arr.shape, arr.strides, arr.dtype.str)
+
+
+def _hash_array(h, arr, chunkbytes=2**24):
+    """
+    Updates the hash `h` with the bytes of `arr` in C order, without copying
+    the whole array if it isn't contiguous.
+    """
+    arr = np.asarray(arr)
+    if arr.flags.c_contiguous:
+        h.update(arr.reshape(-1).view(np.uint8))
+    else:
+        step = max(1, chunkbytes // max(1, arr[:1].nbytes))
+        for i in range(0, len(arr), step):
+            h.update(np.ascontiguousarray(arr[i:i + step]).reshape(-1).view(np.uint8))
+
+
+def _weakref_to(obj):
+    import weakref
+
+    key = id(obj)
+    return weakref.ref(obj, lambda ref: _fingerprints.pop(key, None))
+
+
+def selection_key(catfingerprint, hostinfo, kwargs, versions=None):
+    """
+    The cache key (a hex digest) for a selection.
+
+    Parameters
+    ----------
+    catfingerprint : str
+        The `catalog_fingerprint` of the catalog
+    hostinfo : json-able
+        The host properties the selection uses
+    kwargs : dict
+        The selection parameters (all json-able)
+    versions : json-able or None
+        The versions of any external catalogs used in the selection
+
+    Returns
+    -------
+    key : str
+    """
+    keydata = json.dumps([SELECTION_CACHE_VERSION, catfingerprint, hostinfo,
+                          kwargs, versions], sort_keys=True)
+    return hashlib.sha1(keydata.encode('utf-8')).hexdigest()
+
+
+def _entry_fn(key, cachedir=None):
+    return os.path.join(CACHE_DIR if cachedir is None else cachedir, key + '.npz')
+
+
+def get_cached(key, objids=None, cachedir=None):
+    """
+    Gets the cached selection for `key`, or None if it isn't cached.
+
+    Parameters
+    ----------
+    key : str
+        The key from `selection_key`
+    objids : array or None
+        The objIDs of the catalog the selection is for.  If given, the
+        selection is only used if the objIDs it selects match these.
+    cachedir : str or None
+        The cache directory or None for `CACHE_DIR`
+
+    Returns
+    -------
+    idx : int array or None
+        The indices of the selected rows
+    """
+    fn = _entry_fn(key, cachedir)
+    try:
+        with np.load(fn) as f:
+            idx = f['idx']
+            cachedids = f['objID']
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+    if objids is not None:
+        if (len(idx) and idx.max() >= len(objids)) or not np.array_equal(np.asarray(objids)[idx], cachedids):
+            return None
+
+    # bump the access time for the LRU eviction
+    try:
+        os.utime(fn, None)
+    except OSError:
+        pass
+    return idx
+
+
+def put_cached(key, idx, objids, cachedir=None, maxbytes=None):
+    """
+    Stores the selection `idx` (with the selected `objids`) for `key`, and
+    evicts old entries if that takes the cache over `maxbytes` (default
+    `MAX_BYTES`).
+    """
+    cachedir = CACHE_DIR if cachedir is None else cachedir
+    fn = _entry_fn(key, cachedir)
+    with _lock:
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        # np.savez adds ".npz" to names that don't have it
+        tmpfn = fn[:-4] + '.tmp{0}.npz'.format(os.getpid())
+        np.savez(tmpfn, idx=np.asarray(idx), objID=np.asarray(objids))
+        if os.path.exists(fn):
+            os.remove(fn)
+        os.rename(tmpfn, fn)
+
+        evict(cachedir, MAX_BYTES if maxbytes is None else maxbytes)
+
+
+def evict(cachedir=None, maxbytes=None):
+    """
+    Removes the least recently used selections until the cache is no bigger
+    than `maxbytes`.
+
+    Returns
+    -------
+    nremoved : int
+        The number of selections removed
+    """
+    cachedir = CACHE_DIR if cachedir is None else cachedir
+    maxbytes = MAX_BYTES if maxbytes is None else maxbytes
+
+    entries = []
+    for fn in os.listdir(cachedir):
+        if fn.endswith('.npz') and '.tmp' not in fn:
+            st = os.stat(os.path.join(cachedir, fn))
+            entries.append((st.st_mtime, st.st_size, fn))
+
+    total = sum([e[1] for e in entries])
+    nremoved = 0
+    for mtime, size, fn in sorted(entries):
+        if total <= maxbytes:
+            break
+        os.remove(os.path.join(cachedir, fn))
+        total -= size
+        nremoved += 1
+    return nremoved
+
+
+def clear(cachedir=None):
+    """
+    Removes all cached selections.
+    """
+    cachedir = CACHE_DIR if cachedir is None else cachedir
+    if os.path.isdir(cachedir):
+        for fn in os.listdir(cachedir):
+            if fn.endswith('.npz'):
+                os.remove(os.path.join(cachedir, fn))
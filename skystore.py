@@ -0,0 +1,549 @@
+"""
+A shared on-disk store of SDSS objects, partitioned on the sky.
+
+Hosts that are close together on the sky download overlapping environs, so
+the same objects end up in several ``catalogs/<name>_sdss.dat`` files.  An
+`SDSSSkyStore` ingests those files into one HEALPix-partitioned store
+(`SKY_STORE_DIR`), keeping each ``objID`` only once.  Each partition is a
+directory with one ``.npy`` file per column, so cone queries just
+memory-map the partitions that overlap the cone and read the rows inside it.
+
+The store also remembers the cone (and magnitude cut) of every file it
+ingested, so `SDSSSkyStore.covers` can tell whether a given cone - e.g. the
+environs of a host that never had its own download, or of a host whose
+environs radius was enlarged - is completely covered by local data.  If
+`hosts.USE_SKY_STORE` is True, `NSAHost.get_sdss_catalog` uses the store for
+any host it covers.
+"""
+from __future__ import division, print_function
+
+import os
+import json
+import shutil
+import threading
+
+import numpy as np
+
+
+SKY_STORE_DIR = os.path.join('catalogs', 'sdss_skystore')
+SKY_STORE_VERSION = 1  # bump this if the layout of the store changes
+SKY_STORE_ORDER = 6  # HEALPix order of the partitions - 6 is ~0.84 sq. deg. per partition
+COVERAGE_RESOLUTION = 1 / 60.  # deg - how finely `SDSSSkyStore.covers` checks a cone
+
+_lock = threading.RLock()
+
+
+def healpix_nest_index(ra, dec, order):
+    """
+    The HEALPix pixel(s) in the "nested" scheme that contain the given
+    position(s).
+
+    This is a plain-numpy version of the standard HEALPix ``ang2pix`` (so
+    `healpy` isn't needed just to partition the store).
+
+    Parameters
+    ----------
+    ra : float or array
+        RA in degrees
+    dec : float or array
+        Dec in degrees
+    order : int
+        The HEALPix order (i.e., ``nside = 2**order``)
+
+    Returns
+    -------
+    pix : int or array of ints
+        The pixel index for each position
+    """
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    ra, dec = np.broadcast_arrays(ra, dec)
+    nside = 2**order
+
+    z = np.sin(np.radians(dec))
+    za = np.abs(z)
+    tt = np.asarray(np.mod(ra / 90., 4.))
+    tt[tt >= 4] = 0  # rounding can put ra just below 360 at exactly 4
+
+    ix = np.empty(z.shape, dtype=np.int64)
+    iy = np.empty(z.shape, dtype=np.int64)
+    face = np.empty(z.shape, dtype=np.int64)
+
+    # the equatorial region
+    eq = za <= 2 / 3
+    temp1 = nside * (0.5 + tt[eq])
+    temp2 = nside * 0.75 * z[eq]
+    jp = (temp1 - temp2).astype(np.int64)  # index of the ascending edge line
+    jm = (temp1 + temp2).astype(np.int64)  # index of the descending edge line
+    ifp = jp >> order
+    ifm = jm >> order
+    face[eq] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[eq] = jm & (nside - 1)
+    iy[eq] = nside - (jp & (nside - 1)) - 1
+
+    # the polar caps
+    pol = ~eq
+    ntt = np.minimum(3, tt[pol].astype(np.int64))
+    tp = tt[pol] - ntt
+    tmp = nside * np.sqrt(3 * (1 - za[pol]))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z[pol] >= 0
+    face[pol] = np.where(north, ntt, ntt + 8)
+    ix[pol] = np.where(north, nside - jm - 1, jp)
+    iy[pol] = np.where(north, nside - jp - 1, jm)
+
+    pix = (face << (2 * order)) + _spread_bits(ix, order) + (_spread_bits(iy, order) << 1)
+    return pix if pix.ndim else int(pix)
+
+
+def _spread_bits(x, nbits):
+    # puts bit i of `x` at bit 2i of the result
+    out = np.zeros_like(x)
+    for i in range(nbits):
+        out |= ((x >> i) & 1) << (2 * i)
+    return out
+
+
+class SDSSSkyStore(object):
+    """
+    A HEALPix-partitioned, memory-mappable store of SDSS objects.
+
+    Use `ingest` or `ingest_hosts` to add downloaded environs catalogs,
+    `cone` to get the objects in a cone, and `covers` to check if a cone was
+    completely downloaded.  Most of the time `get_sky_store` is the way to
+    get a store.
+
+    Only the columns that came from the SDSS are stored - host-specific
+    columns (like ``rhost``) are dropped, and get re-derived by
+    `NSAHost.get_sdss_catalog` for whatever host a cone is for.
+
+    Parameters
+    ----------
+    storedir : str or None
+        The directory of the store, or None for `SKY_STORE_DIR`.  It is
+        created on the first `ingest` if it doesn't exist yet.
+    order : int or None
+        The HEALPix order of the partitions for a new store, or None for
+        `SKY_STORE_ORDER`.  Ignored for a store that already exists.
+
+    Attributes
+    ----------
+    storedir : str
+        The directory of the store
+    order : int
+        The HEALPix order of the partitions
+    colnames : list of str
+        The names of the columns in the store
+    sources : list of dict
+        The files that have been ingested, with the cone and magnitude cut
+        each covers.
+    """
+    _metafn = 'meta.json'
+
+    def __init__(self, storedir=None, order=None):
+        self.storedir = SKY_STORE_DIR if storedir is None else storedir
+
+        metafn = os.path.join(self.storedir, self._metafn)
+        if os.path.isfile(metafn):
+            with open(metafn) as f:
+                meta = json.load(f)
+            if meta['version'] != SKY_STORE_VERSION:
+                raise ValueError('Sky store in "{0}" is version {1}, but this '
+                                 'code needs version {2}.  Delete it and '
+                                 're-ingest.'.format(self.storedir, meta['version'], SKY_STORE_VERSION))
+            self.order = meta['order']
+            self.colnames = [nm for nm, dt in meta['columns']]
+            self._dtypes = dict([(nm, np.dtype(dt)) for nm, dt in meta['columns']])
+            self._partitions = dict([(int(pix), p) for pix, p in meta['partitions'].items()])
+            self.sources = meta['sources']
+        else:
+            self.order = SKY_STORE_ORDER if order is None else order
+            self.colnames = []
+            self._dtypes = {}
+            self._partitions = {}
+            self.sources = []
+        self._update_partition_arrays()
+
+    def __len__(self):
+        return sum([p['nrows'] for p in self._partitions.values()])
+
+    def __repr__(self):
+        return "<SDSSSkyStore of {0} objects in {1} partitions in '{2}'>".format(len(self), len(self._partitions), self.storedir)
+
+    def _update_partition_arrays(self):
+        # the partition caps as arrays, to find the ones near a cone quickly
+        pixs = sorted(self._partitions)
+        self._pixs = np.array(pixs, dtype=np.int64)
+        self._capra = np.array([self._partitions[pix]['center'][0] for pix in pixs])
+        self._capdec = np.array([self._partitions[pix]['center'][1] for pix in pixs])
+        self._caprad = np.array([self._partitions[pix]['radius'] for pix in pixs])
+
+    def _write_meta(self):
+        columns = [(nm, self._dtypes[nm].str) for nm in self.colnames]
+        partitions = dict([(str(pix), p) for pix, p in self._partitions.items()])
+        meta = {'version': SKY_STORE_VERSION, 'order': self.order,
+                'columns': columns, 'partitions': partitions,
+                'sources': self.sources}
+
+        metafn = os.path.join(self.storedir, self._metafn)
+        tmpfn = metafn + '.tmp{0}'.format(os.getpid())
+        with open(tmpfn, 'w') as f:
+            json.dump(meta, f)
+        if os.path.exists(metafn):
+            os.remove(metafn)
+        os.rename(tmpfn, metafn)
+
+    def _partition_dir(self, pix):
+        return os.path.join(self.storedir, 'hpx{0}_{1}'.format(self.order, pix))
+
+    def _column_fn(self, pix, colname, mask=False):
+        i = self.colnames.index(colname)
+        return os.path.join(self._partition_dir(pix), 'col{0}{1}.npy'.format(i, '.mask' if mask else ''))
+
+    def _read_partition_column(self, pix, colname):
+        """
+        Returns the (memory-mapped) data and mask of `colname` in partition
+        `pix`.  The mask is None if nothing is masked, and the data are None
+        if the partition doesn't have that column at all.
+        """
+        if colname not in self._partitions[pix]['colnames']:
+            return None, None
+        data = np.load(self._column_fn(pix, colname), mmap_mode='r')
+        maskfn = self._column_fn(pix, colname, mask=True)
+        mask = np.load(maskfn, mmap_mode='r') if os.path.exists(maskfn) else None
+        return data, mask
+
+    def _partition_table(self, pix):
+        from astropy.table import Table, MaskedColumn
+
+        cols = []
+        for nm in self._partitions[pix]['colnames']:
+            data, mask = self._read_partition_column(pix, nm)
+            if mask is None:
+                mask = np.zeros(len(data), dtype=bool)
+            cols.append(MaskedColumn(np.array(data), name=nm, mask=np.array(mask)))
+        return Table(cols)
+
+    def _write_partition(self, pix, tab):
+        from utils import angular_separation_deg
+
+        pdir = self._partition_dir(pix)
+        tmpdir = pdir + '.tmp{0}'.format(os.getpid())
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+        os.makedirs(tmpdir)
+
+        for nm in tab.colnames:
+            col = tab[nm]
+            i = self.colnames.index(nm)
+            mask = getattr(col, 'mask', None)
+            if mask is not None and np.any(mask):
+                np.save(os.path.join(tmpdir, 'col{0}.mask.npy'.format(i)), np.asarray(mask))
+            np.save(os.path.join(tmpdir, 'col{0}.npy'.format(i)),
+                    np.asarray(col).astype(self._dtypes[nm], copy=False))
+
+        if os.path.isdir(pdir):
+            shutil.rmtree(pdir)
+        os.rename(tmpdir, pdir)
+
+        # a cap around everything in the partition, to find the partitions near a cone
+        ra = np.radians(np.asarray(tab['ra'], dtype=float))
+        dec = np.radians(np.asarray(tab['dec'], dtype=float))
+        x, y, z = [np.mean(v) for v in (np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec))]
+        cra = np.degrees(np.arctan2(y, x)) % 360
+        cdec = np.degrees(np.arctan2(z, np.hypot(x, y)))
+        crad = np.max(angular_separation_deg(cra, cdec, np.degrees(ra), np.degrees(dec)))
+
+        self._partitions[pix] = {'nrows': len(tab), 'colnames': list(tab.colnames),
+                                 'center': [float(cra), float(cdec)],
+                                 'radius': float(crad) + 1e-9}
+
+    def ingest(self, fn, ra, dec, radius, magcut=None, force=False):
+        """
+        Adds the objects in an SDSS environs catalog to the store.  Objects
+        that are already in the store (by ``objID``) are not added again.
+
+        Parameters
+        ----------
+        fn : str
+            The catalog file (as written by `NSAHost.sdss_environs_query`)
+        ra : float
+            The RA of the center of the cone the catalog covers, in degrees
+        dec : float
+            The Dec of the center of the cone the catalog covers, in degrees
+        radius : float
+            The radius of the cone the catalog covers, in degrees
+        magcut : 2-tuple or None
+            The magnitude cut the catalog was downloaded with (see
+            `construct_sdss_query`), or None if it has everything.
+        force : bool
+            If True, the file is ingested even if this version of it already
+            has been.
+
+        Returns
+        -------
+        nnew : int
+            The number of objects that were not already in the store
+        """
+        from hosts import NSAHost, read_sdss_file
+
+        st = os.stat(fn)
+        source = {'fn': os.path.abspath(fn), 'size': st.st_size,
+                  'mtime': st.st_mtime, 'ra': float(ra), 'dec': float(dec),
+                  'radius': float(radius),
+                  'magcut': None if magcut is None else list(magcut)}
+        if not force and source in self.sources:
+            return 0
+
+        tab = read_sdss_file(fn)
+        for real, alias in NSAHost.catalog_aliases.items():
+            if real in tab.colnames and alias not in tab.colnames:
+                tab.rename_column(real, alias)
+        # host-specific columns don't belong in a store shared by all hosts
+        for nm in list(tab.colnames):
+            if nm.lower().startswith('host') or nm.lower().startswith('rhost'):
+                tab.remove_column(nm)
+        for nm in ('objID', 'ra', 'dec'):
+            if nm not in tab.colnames:
+                raise ValueError('Catalog "{0}" has no {1} column, so it cannot '
+                                 'go in the sky store'.format(fn, nm))
+
+        with _lock:
+            for nm in tab.colnames:
+                dt = tab[nm].dtype
+                if dt.kind == 'O':
+                    tab[nm] = tab[nm].astype(str)
+                    dt = tab[nm].dtype
+                if nm in self._dtypes:
+                    try:
+                        self._dtypes[nm] = np.promote_types(self._dtypes[nm], dt)
+                    except TypeError:
+                        raise ValueError('Column {0} in "{1}" is {2}, which does not '
+                                         'match the {3} in the sky store'.format(nm, fn, dt, self._dtypes[nm]))
+                else:
+                    self.colnames.append(nm)
+                    self._dtypes[nm] = dt
+
+            nnew = self._add_rows(tab)
+
+            self.sources = [s for s in self.sources if s['fn'] != source['fn']]
+            self.sources.append(source)
+            self._update_partition_arrays()
+            self._write_meta()
+
+        return nnew
+
+    def _add_rows(self, tab):
+        from astropy.table import vstack
+
+        if not os.path.isdir(self.storedir):
+            os.makedirs(self.storedir)
+
+        pix = healpix_nest_index(tab['ra'], tab['dec'], self.order)
+        order = np.argsort(pix, kind='mergesort')
+        bounds = np.flatnonzero(np.diff(pix[order])) + 1
+
+        nnew = 0
+        for idx in np.split(order, bounds):
+            if len(idx) == 0:
+                continue
+            p = int(pix[idx[0]])
+            newrows = tab[idx]
+            if p in self._partitions:
+                oldrows = self._partition_table(p)
+                nold = len(oldrows)
+                # rows already in the store win, unless the new ones have more columns
+                if set(newrows.colnames) > set(oldrows.colnames):
+                    rows = vstack([newrows, oldrows], join_type='outer', metadata_conflicts='silent')
+                else:
+                    rows = vstack([oldrows, newrows], join_type='outer', metadata_conflicts='silent')
+            else:
+                nold = 0
+                rows = newrows
+            _, first = np.unique(np.asarray(rows['objID']), return_index=True)
+            rows = rows[np.sort(first)]
+            nnew += len(rows) - nold
+            self._write_partition(p, rows)
+        return nnew
+
+    def ingest_hosts(self, hostlst, force=False):
+        """
+        Ingests the SDSS environs catalogs of all the hosts in `hostlst` that
+        have been downloaded.
+
+        Parameters
+        ----------
+        hostlst : list of NSAHost
+            The hosts
+        force : bool
+            Passed into `ingest`
+
+        Returns
+        -------
+        nnew : int
+            The number of objects that were not already in the store
+        """
+        nnew = 0
+        for host in hostlst:
+            for fn in [host.fnsdss] + list(host.altfnsdss):
+                if os.path.exists(fn):
+                    nnew += self.ingest(fn, host.ra, host.dec,
+                                        host.environsarcmin / 60.,
+                                        host.sdssquerymagcut, force)
+                    break
+        return nnew
+
+    def covers(self, ra, dec, radius, magcut=None):
+        """
+        Determines if a cone is completely covered by the ingested catalogs.
+
+        Parameters
+        ----------
+        ra : float
+            The RA of the center of the cone in degrees
+        dec : float
+            The Dec of the center of the cone in degrees
+        radius : float
+            The radius of the cone in degrees
+        magcut : 2-tuple or None
+            The magnitude cut (see `construct_sdss_query`) that's acceptable,
+            or None if all the objects are needed.
+
+        Returns
+        -------
+        covered : bool
+            True if every point in the cone (checked on a grid spaced by
+            `COVERAGE_RESOLUTION`) is inside one of the ingested catalogs.
+        """
+        from utils import angular_separation_deg
+
+        sources = [s for s in self.sources if _magcut_ok(s['magcut'], magcut)]
+        if not sources:
+            return False
+        sra, sdec, srad = [np.array([s[k] for s in sources]) for k in ('ra', 'dec', 'radius')]
+        near = angular_separation_deg(ra, dec, sra, sdec) < radius + srad
+        if not np.any(near):
+            return False
+        sra, sdec, srad = sra[near], sdec[near], srad[near]
+
+        pra, pdec = _cone_sample_points(ra, dec, radius, COVERAGE_RESOLUTION)
+        inside = np.zeros(len(pra), dtype=bool)
+        for i in range(len(sra)):
+            # with a little slack, so points right on the edge of a cone count
+            inside |= angular_separation_deg(sra[i], sdec[i], pra, pdec) <= srad[i] + 1e-7
+        return bool(np.all(inside))
+
+    def cone(self, ra, dec, radius, colnames=None):
+        """
+        Gets the objects within a cone.
+
+        Only the partitions that overlap the cone are read, and of those only
+        the pages with the ``ra``/``dec`` columns and the rows in the cone.
+
+        Parameters
+        ----------
+        ra : float
+            The RA of the center of the cone in degrees
+        dec : float
+            The Dec of the center of the cone in degrees
+        radius : float
+            The radius of the cone in degrees
+        colnames : list of str or None
+            The columns to get, or None for all of them.
+
+        Returns
+        -------
+        tab : astropy.table.Table
+            The objects in the cone.  Columns that some of the objects don't
+            have (because they came from a catalog downloaded with fewer
+            columns) are masked for those objects.
+        """
+        from astropy.table import Table, Column, MaskedColumn
+        from utils import angular_separation_deg
+
+        colnames = self.colnames if colnames is None else list(colnames)
+        for nm in colnames:
+            if nm not in self._dtypes:
+                raise ValueError('Column {0} is not in the sky store'.format(nm))
+
+        near = angular_separation_deg(ra, dec, self._capra, self._capdec) <= radius + self._caprad
+        datas = dict([(nm, []) for nm in colnames])
+        masks = dict([(nm, []) for nm in colnames])
+        for pix in self._pixs[np.atleast_1d(near)]:
+            pix = int(pix)
+            pra, _ = self._read_partition_column(pix, 'ra')
+            pdec, _ = self._read_partition_column(pix, 'dec')
+            idx = np.flatnonzero(angular_separation_deg(ra, dec, pra, pdec) <= radius)
+            if len(idx) == 0:
+                continue
+            for nm in colnames:
+                data, mask = self._read_partition_column(pix, nm)
+                if data is None:
+                    datas[nm].append(np.zeros(len(idx), dtype=self._dtypes[nm]))
+                    masks[nm].append(np.ones(len(idx), dtype=bool))
+                else:
+                    datas[nm].append(np.asarray(data[idx]).astype(self._dtypes[nm], copy=False))
+                    masks[nm].append(np.zeros(len(idx), dtype=bool) if mask is None else np.asarray(mask[idx]))
+
+        cols = []
+        for nm in colnames:
+            if datas[nm]:
+                data = np.concatenate(datas[nm])
+                mask = np.concatenate(masks[nm])
+            else:
+                data = np.zeros(0, dtype=self._dtypes[nm])
+                mask = np.zeros(0, dtype=bool)
+            if np.any(mask):
+                cols.append(MaskedColumn(data, name=nm, mask=mask))
+            else:
+                cols.append(Column(data, name=nm))
+        return Table(cols, copy=False)
+
+
+def _magcut_ok(sourcecut, wantedcut):
+    # a catalog with no cut is always fine, one with a cut only if it's at
+    # least as faint as what is wanted
+    if sourcecut is None:
+        return True
+    if wantedcut is None:
+        return False
+    return sourcecut[0] == wantedcut[0] and sourcecut[1] >= wantedcut[1]
+
+
+def _cone_sample_points(ra, dec, radius, spacing):
+    """
+    Points filling a cone on rings spaced by (at most) `spacing` degrees,
+    including the center and the edge.
+    """
+    nrings = max(1, int(np.ceil(radius / spacing)))
+    ras = [np.array([ra], dtype=float)]
+    decs = [np.array([dec], dtype=float)]
+
+    d2r = np.pi / 180
+    sindec0, cosdec0 = np.sin(dec * d2r), np.cos(dec * d2r)
+    for r in np.linspace(0, radius, nrings + 1)[1:]:
+        npts = max(6, int(np.ceil(2 * np.pi * np.sin(r * d2r) / (spacing * d2r))))
+        pa = np.linspace(0, 2 * np.pi, npts, endpoint=False)
+        sinr, cosr = np.sin(r * d2r), np.cos(r * d2r)
+        sindec = np.clip(sindec0 * cosr + cosdec0 * sinr * np.cos(pa), -1, 1)
+        dra = np.arctan2(np.sin(pa) * sinr * cosdec0, cosr - sindec0 * sindec)
+        ras.append((ra + dra / d2r) % 360)
+        decs.append(np.arcsin(sindec) / d2r)
+    return np.concatenate(ras), np.concatenate(decs)
+
+
+_skystores = {}
+def get_sky_store(storedir=None):
+    """
+    Gets the `SDSSSkyStore` in `storedir` (or `SKY_STORE_DIR` if None),
+    re-using the same object for every call in this process.
+    """
+    storedir = SKY_STORE_DIR if storedir is None else storedir
+    store = _skystores.get(storedir)
+    if store is None:
+        with _lock:
+            if storedir not in _skystores:
+                _skystores[storedir] = SDSSSkyStore(storedir)
+            store = _skystores[storedir]
+    return store
@@ -5,6 +5,8 @@ These functions are for the "Distant local groups" project target selection.
 """
 #important note: SDSS 'type' field: 3=galaxy, 6=star
 
+import threading
+
 import numpy as np
 from matplotlib import pyplot as plt
 
@@ -24,6 +26,9 @@ bossanova_color_cuts = {'g-r': (None, 1.3), 'r-i': (None, 0.7)}
 # more stringent color cuts useful for prioritizing targeting
 tighter_color_cuts = {'g-r': (None, 1.0), 'r-i': (None, 0.5)}
 
+GAMA_PARSE_VERSION = 1  # bump this whenever what `get_gama` reads from a GAMA CSV file changes
+USE_SELECTION_CACHE = False  # If True, `select_targets` results are cached on disk (see `selectioncache`)
+
 
 def select_targets(host, band='r', faintlimit=21, brightlimit=15,
     galvsallcutoff=20, inclspecqsos=False, removespecstars=True,
@@ -90,97 +95,156 @@ def select_targets(host, band='r', faintlimit=21, brightlimit=15,
     -------
         cat : astropy.table.Table
             The SDSS catalog with the selection applied
-    """
-    from astropy.constants import c
-    from astropy.table import Column, MaskedColumn
-    from math import cos, radians
 
+    Notes
+    -----
+    If `USE_SELECTION_CACHE` is True, the selection is cached on disk (see
+    `selectioncache`), so running the same selection on the same catalog
+    again just reads it back.  The randomization happens after that, so it
+    still gives the same order for the same `numpy.random` state.
+    """
     if catalog is None:
         cat = host.get_sdss_catalog()
     else:
         cat = catalog
 
-    mag = cat[band]
-
-    #raw magnitude cuts
-    magcuts = (brightlimit < mag) & (mag < faintlimit)
-
-    #color cuts if any are present
-    colorcuts = colorcuts.copy()
-    colorcutmsk = colorcut_mask(cat, colorcuts, verbose)
+    kwargs = dict(band=band, faintlimit=faintlimit, brightlimit=brightlimit,
+        galvsallcutoff=galvsallcutoff, inclspecqsos=inclspecqsos,
+        removespecstars=removespecstars, removegalsathighz=removegalsathighz,
+        removegama=removegama, photflags=photflags, outercutrad=outercutrad,
+        innercutrad=innercutrad, colorcuts=colorcuts,
+        removeallsdss=removeallsdss, fibermagcut=fibermagcut, verbose=verbose)
+    selector = TargetSelector(host, cat)
 
+    idx = None
+    key = _selection_cache_key(host, cat, kwargs) if USE_SELECTION_CACHE else None
+    if key is not None:
+        from selectioncache import get_cached
 
-    #type==3 is an imaging-classified galaxy - but only do it if you're brighter than galvsallcutoff
-    nonphotgal = (cat['type'] == 3) | (mag > galvsallcutoff)
+        idx = get_cached(key, cat['objID'])
+        if idx is not None:
+            selector._rhost()  # so the result has the rhost columns either way
+    if idx is None:
+        idx = selector.indices(randomize=False, **kwargs)
+        if key is not None:
+            from selectioncache import put_cached
 
-    #base selection is based on the above
-    msk = magcuts & colorcutmsk & nonphotgal
+            put_cached(key, idx, np.asarray(cat['objID'])[idx])
 
-    cdec = cos(radians(host.dec))
+    # randomized after the cache so the order still follows `numpy.random`
+    if randomize:
+        idx = idx[np.random.permutation(len(idx))]
+    return cat[idx]
 
 
-    if 'rhost' not in cat.colnames:
-        dra = cat['ra'] - host.ra
-        ddec = cat['dec'] - host.dec
-        rhost = ((dra * cdec) ** 2 + ddec ** 2) ** 0.5
-        colcls = MaskedColumn if hasattr(rhost, 'mask') else Column
-        cat.add_column(colcls(name='rhost', data=rhost))
-        cat.add_column(colcls(name='rhost_kpc', data=np.radians(rhost)*host.distmpc*1000))
+def _selection_cache_key(host, cat, kwargs):
+    """
+    The `selectioncache` key for a `select_targets` call, or None if it
+    can't be cached (i.e., it uses color cut functions).
+    """
+    from selectioncache import catalog_fingerprint, selection_key
 
-    #negative for arcmin
-    if outercutrad is not None:
-        if hasattr(outercutrad, 'unit') and outercutrad.unit.is_equivalent(u.Mpc):
-            outercutraddeg = np.degrees(outercutrad.to(u.Mpc).value / host.distmpc)
-        elif hasattr(outercutrad, 'unit') and outercutrad.unit.is_equivalent(u.degree):
-            outercutraddeg = outercutrad.to(u.degree).value
-        elif isinstance(outercutrad, float) or isinstance(outercutrad, int):  # pre-Quantity
-            if outercutrad < 0:  # arcmin
-                outercutraddeg = -outercutrad / 60.
-            else:  # kpc
-                outercutraddeg = np.degrees(outercutrad / (1000 * host.distmpc))
-        else:
-            raise ValueError('Invalid outercutrad')
-    else:
-        outercutraddeg = cat['rhost'].max()
+    if 'funcs' in kwargs['colorcuts']:
+        return None
 
-    outercutrad = cat['rhost'] < outercutraddeg
+    kwargs = dict([(k, _hashable(v)) for k, v in kwargs.items() if k != 'verbose'])
+    hostinfo = [getattr(host, 'name', None)]
+    hostinfo.extend([float(x) for x in (host.ra, host.dec, host.distmpc, host.zspec, host.zdisterr)])
+    versions = get_gama().sourceversion if kwargs['removegama'] else None
+    return selection_key(catalog_fingerprint(cat), hostinfo, kwargs, versions)
 
-    msk = msk & outercutrad
 
-    if innercutrad is not None:
-        if innercutrad < 0:  # arcmin
-            innercutraddeg = -innercutrad / 60.
-        else:  # kpc
-            innercutraddeg = np.degrees(innercutrad / (1000 * host.distmpc))
+class TargetSelector(object):
+    """
+    Does the `select_targets` selection for one host's catalog, keeping the
+    parts that don't depend on the selection parameters.
 
-        innercutrad = cat['rhost'] > innercutraddeg
+    Each of the masks that make up the selection (the photometric flags, the
+    spectroscopic classes, the GAMA matches, a given set of color cuts, ...)
+    is computed the first time it's needed and then re-used, so running the
+    selection for many different `faintlimit`, `outercutrad`, `colorcuts`,
+    or `fibermagcut` values costs little more than running it once.  See
+    `sweep_select_targets` for the usual way to use this.
 
-        msk = msk & innercutrad
+    Parameters
+    ----------
+    host : NSAHost
+        The host object to select targets for
+    catalog : `astropy.table.Table` or None
+        If None, use the `get_sdss_catalog` from the host.  Otherwise, should
+        be something that looks like that.
+    """
+    def __init__(self, host, catalog=None):
+        from selectexpr import ExpressionCache
+
+        self.host = host
+        self.catalog = host.get_sdss_catalog() if catalog is None else catalog
+        self._cache = {}
+        # so colors shared by different colorcuts are only computed once
+        self._expressions = ExpressionCache(self.catalog)
+
+    def _cached(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    def _values(self, colname):
+        return self._cached(('values', colname), lambda: _column_values(self.catalog, colname))
+
+    def _rhost(self):
+        from astropy.table import Column
+        from utils import angular_separation_deg
+
+        cat = self.catalog
+        host = self.host
+        if 'rhost' not in self._cache:
+            if 'rhost' not in getattr(cat, 'lazycolnames', cat.colnames):
+                rhost = angular_separation_deg(host.ra, host.dec, cat['ra'], cat['dec'])
+                cat.add_column(Column(name='rhost', data=rhost))
+                cat.add_column(Column(name='rhost_kpc', data=np.radians(rhost)*host.distmpc*1000))
+            self._cache['rhost'] = np.asarray(cat['rhost'])
+        return self._cache['rhost']
+
+    def _outercutraddeg(self, outercutrad):
+        host = self.host
+
+        #negative for arcmin
+        if outercutrad is not None:
+            if hasattr(outercutrad, 'unit') and outercutrad.unit.is_equivalent(u.Mpc):
+                return np.degrees(outercutrad.to(u.Mpc).value / host.distmpc)
+            elif hasattr(outercutrad, 'unit') and outercutrad.unit.is_equivalent(u.degree):
+                return outercutrad.to(u.degree).value
+            elif isinstance(outercutrad, float) or isinstance(outercutrad, int):  # pre-Quantity
+                if outercutrad < 0:  # arcmin
+                    return -outercutrad / 60.
+                else:  # kpc
+                    return np.degrees(outercutrad / (1000 * host.distmpc))
+            else:
+                raise ValueError('Invalid outercutrad')
+        else:
+            return self._rhost().max()
 
-    if photflags:
-        flags = cat['flags']
-        binned1 = (flags & 0x10000000) != 0  # BINNED1 detection
-        nsaturated = (0x0000000000040000 & flags) == 0  # not saturated
-        nbce = (0x0000010000000000 & flags) == 0  # not BAD_COUNTS_ERROR
+    def _photflag_mask(self):
+        flags = _flag_values(self.catalog)
+        binned1 = (flags & np.uint64(0x10000000)) != 0  # BINNED1 detection
+        nsaturated = (np.uint64(0x0000000000040000) & flags) == 0  # not saturated
+        nbce = (np.uint64(0x0000010000000000) & flags) == 0  # not BAD_COUNTS_ERROR
         #photqual = (flags & 0x8100000c00a0) == 0  # not NOPROFILE, PEAKCENTER,
             # NOTCHECKED, PSF_FLUX_INTERP, SATURATED, or BAD_COUNTS_ERROR
         #deblendnopeak = ((flags & 0x400000000000) == 0)  # | (psfmagerr_g <= 0.2)  # DEBLEND_NOPEAK
-        msk = msk & binned1 & nsaturated & nbce
+        return binned1 & nsaturated & nbce
 
-    #below are "overrides" rather than selection categories:
-
-    #include SDSS spectroscopy QSOs
-    if inclspecqsos:
-        specqsos = cat['spec_class'] == 'QSO'
-        msk[specqsos] = inclspecqsos
+    def _specqso_mask(self):
+        specqsos = category_mask(self.catalog, 'spec_class', 'QSO')
         print('Found', sum(specqsos), 'QSO candidates')
+        return specqsos
 
-    if removespecstars:
-        specstars = cat['spec_class'] == 'STAR'
-        msk[specstars] = False
+    def _highzgal_mask(self, removegalsathighz):
+        from astropy.constants import c
 
-    if removegalsathighz:
-        gals = cat['spec_class'] == 'GALAXY'
+        cat = self.catalog
+        host = self.host
+        gals = category_mask(cat, 'spec_class', 'GALAXY')
         if (u.km/u.s).is_equivalent(removegalsathighz):
             # take this to just mean it has to be within the given cutoff of the host
             zthresh = (host.zspec + removegalsathighz/c).decompose().value
@@ -191,20 +255,21 @@ def select_targets(host, band='r', faintlimit=21, brightlimit=15,
         lowzgals = gals & ((cat['spec_z']) <= zthresh)
         validspec = cat['spec_z_warn'] == 0
         print('Removing {0} objects at high z w/ good spectra, keeping {1} (total of {2} objects)'.format(highzgals.sum(), lowzgals.sum(), len(lowzgals)))
-        msk[highzgals&validspec] = False
+        return highzgals&validspec
 
-    if removeallsdss:
-        sdssspecs = ~cat['spec_class'].mask
+    def _allsdss_mask(self):
+        sdssspecs = ~category_mask(self.catalog, 'spec_class', None)
         print('Removing ALL objects with SDSS spec: {0} of {1} objects'.format(sdssspecs.sum(), len(sdssspecs)))
-        msk[sdssspecs] = False
+        return sdssspecs
 
-    if removegama:
+    def _gama_mask(self, removegama, outercutraddeg):
+        host = self.host
         g = get_gama()
         if (host.dec + outercutraddeg > g.decmax or
             host.dec - outercutraddeg < g.decmin or
             host.ra + outercutraddeg > g.ramax or
             host.ra - outercutraddeg < g.ramin):
-            pass#print('Host not in GAMA area - not looking at GAMA')
+            return None  #print('Host not in GAMA area - not looking at GAMA')
         else:
             print('Found host', host.name, 'in GAMA!')
             if removegama == 'all':
@@ -214,25 +279,209 @@ def select_targets(host, band='r', faintlimit=21, brightlimit=15,
             else:
                 raise ValueError('invalid removegama')
 
-            gamamatchmsk = find_gama(cat, host, outercutraddeg, tol=1 / 3600.,
+            gamamatchmsk = find_gama(self.catalog, host, outercutraddeg, tol=1 / 3600.,
                 matchfuture=future)[0]
-
-            msk = msk & ~gamamatchmsk
             print('Removing', np.sum(gamamatchmsk),'GAMA objects')
+            return gamamatchmsk
+
+    def mask(self, band='r', faintlimit=21, brightlimit=15,
+             galvsallcutoff=20, inclspecqsos=False, removespecstars=True,
+             removegalsathighz=True, removegama='now', photflags=True,
+             outercutrad=250, innercutrad=20, colorcuts={},
+             removeallsdss=False, fibermagcut=('r', 23), verbose=False):
+        """
+        The selection as a mask on the catalog.  The parameters are the same
+        as for `select_targets`.
+
+        Returns
+        -------
+        msk : bool array
+            True for the catalog entries that are selected
+        """
+        cat = self.catalog
+        host = self.host
+
+        mag = self._values(band)
+
+        #raw magnitude cuts
+        magcuts = (brightlimit < mag) & (mag < faintlimit)
+
+        #color cuts if any are present
+        colorcutmsk = self._cached(('colorcuts', _hashable(colorcuts), verbose),
+            lambda: colorcut_mask(cat, colorcuts.copy(), verbose,
+                                  expressions=self._expressions))
+
+        #type==3 is an imaging-classified galaxy - but only do it if you're brighter than galvsallcutoff
+        nonphotgal = self._cached(('nonphotgal', band, galvsallcutoff),
+            lambda: (self._values('type') == 3) | (mag > galvsallcutoff))
+
+        #base selection is based on the above
+        msk = magcuts & colorcutmsk & nonphotgal
+
+        rhost = self._rhost()
+        outercutraddeg = self._outercutraddeg(outercutrad)
+
+        msk = msk & (rhost < outercutraddeg)
+
+        if innercutrad is not None:
+            if innercutrad < 0:  # arcmin
+                innercutraddeg = -innercutrad / 60.
+            else:  # kpc
+                innercutraddeg = np.degrees(innercutrad / (1000 * host.distmpc))
 
-    if fibermagcut:
-        fmagname = 'fibermag_' + fibermagcut[0]
-        msk = msk & (cat[fmagname] < fibermagcut[1])
+            msk = msk & (rhost > innercutraddeg)
 
-    res = cat[msk]
-    if randomize:
-        res = res[np.random.permutation(len(res))]
+        if photflags:
+            msk = msk & self._cached(('photflags',), self._photflag_mask)
 
-    finalmsk = np.ones(len(res), dtype=bool)
-    return res[finalmsk]
+        #below are "overrides" rather than selection categories:
+
+        #include SDSS spectroscopy QSOs
+        if inclspecqsos:
+            specqsos = self._cached(('specqsos',), self._specqso_mask)
+            msk[specqsos] = inclspecqsos
+
+        if removespecstars:
+            specstars = self._cached(('specstars',),
+                lambda: category_mask(cat, 'spec_class', 'STAR'))
+            msk[specstars] = False
+
+        if removegalsathighz:
+            if hasattr(removegalsathighz, 'unit'):
+                zkey = removegalsathighz.to(u.km/u.s).value
+            else:
+                zkey = removegalsathighz
+            highzgals = self._cached(('highzgals', zkey),
+                lambda: self._highzgal_mask(removegalsathighz))
+            msk[highzgals] = False
 
+        if removeallsdss:
+            msk[self._cached(('allsdss',), self._allsdss_mask)] = False
 
-def colorcut_mask(cat, colorcuts, deredden=True, verbose=False):
+        if removegama:
+            gamamatchmsk = self._cached(('gama', removegama, float(outercutraddeg)),
+                lambda: self._gama_mask(removegama, outercutraddeg))
+            if gamamatchmsk is not None:
+                msk = msk & ~gamamatchmsk
+
+        if fibermagcut:
+            fmagname = 'fibermag_' + fibermagcut[0]
+            msk = msk & (self._values(fmagname) < fibermagcut[1])
+
+        return msk
+
+    def indices(self, randomize=True, **kwargs):
+        """
+        The selection as row indices into the catalog, in the order
+        `select_targets` returns them.
+
+        Parameters
+        ----------
+        randomize : bool
+            Randomize the order (using `numpy.random`, exactly as
+            `select_targets` does)
+        kwargs
+            The other `select_targets` parameters
+
+        Returns
+        -------
+        idx : int array
+            The indices of the selected rows
+        """
+        idx = np.flatnonzero(np.asarray(self.mask(**kwargs)))
+        if randomize:
+            idx = idx[np.random.permutation(len(idx))]
+        return idx
+
+    def count(self, **kwargs):
+        """
+        The number of targets `select_targets` would select with the given
+        parameters.
+        """
+        return int(np.count_nonzero(np.asarray(self.mask(**kwargs))))
+
+
+def _hashable(obj):
+    # a hashable version of (possibly nested) dicts/lists, for cache keys
+    if isinstance(obj, dict):
+        return tuple(sorted([(k, _hashable(v)) for k, v in obj.items()]))
+    elif isinstance(obj, (list, tuple)):
+        return tuple([_hashable(v) for v in obj])
+    elif hasattr(obj, 'unit'):
+        return (float(obj.value), str(obj.unit))
+    return obj
+
+
+def selection_grid(**paramvalues):
+    """
+    All the combinations of the given `select_targets` parameter values.
+
+    E.g., ``selection_grid(faintlimit=[20, 20.5, 21], outercutrad=[-60, 300])``
+    gives 6 dicts that can be passed to `sweep_select_targets`.
+
+    Parameters
+    ----------
+    paramvalues
+        Each keyword is a `select_targets` parameter, and its value is a list
+        of the values to use for it.
+
+    Returns
+    -------
+    configs : list of dicts
+        One dict for each combination, in the order of `itertools.product`
+        over the parameters sorted by name.
+    """
+    from itertools import product
+
+    names = sorted(paramvalues)
+    return [dict(zip(names, vals)) for vals in product(*[paramvalues[nm] for nm in names])]
+
+
+def sweep_select_targets(host, configs, counts=False, catalog=None, **kwargs):
+    """
+    Runs `select_targets` for many sets of parameters on one host.
+
+    This uses a `TargetSelector`, so the parts of the selection that don't
+    change between the `configs` are only done once.
+
+    Parameters
+    ----------
+    host : NSAHost
+        The host object to select targets for
+    configs : list of dicts
+        The `select_targets` parameters for each selection (e.g. from
+        `selection_grid`).
+    counts : bool
+        If True, just count the targets for each of `configs`.
+    catalog : `astropy.table.Table` or None
+        If None, use the `get_sdss_catalog` from the host.  Otherwise, should
+        be something that looks like that.
+    kwargs
+        Any other `select_targets` parameters, which apply to all the
+        `configs` (unless a config overrides them).
+
+    Returns
+    -------
+    results : list
+        For each of `configs`, the number of targets if `counts` is True,
+        otherwise the indices into the catalog of the targets (i.e.,
+        ``catalog[idx]`` is what `select_targets` returns).
+    """
+    selector = TargetSelector(host, catalog)
+
+    results = []
+    for config in configs:
+        kws = kwargs.copy()
+        kws.update(config)
+        if counts:
+            kws.pop('randomize', None)
+            results.append(selector.count(**kws))
+        else:
+            results.append(selector.indices(**kws))
+    return results
+
+
+def colorcut_mask(cat, colorcuts, deredden=True, verbose=False, expressions=None):
     """
     Apply color cuts to a photometry catalog
 
@@ -252,71 +501,111 @@ def colorcut_mask(cat, colorcuts, deredden=True, verbose=False):
         Use dereddened/extinction-corrected colors instead of raw colors
     verbose : bool
         If True, prints out what each cut does
+    expressions : `selectexpr.ExpressionCache` or None
+        If given, the colors are taken from (and kept in) this cache, so
+        they're only computed once for the catalog.
 
     Returns
     -------
     colorcutmsk : bool array
         True for catalog entries that pass the color cuts, False for those that
         do not.
+
+    The cuts are evaluated with a compiled `selectexpr.SelectionPlan`.
+    Entries with masked magnitudes (or uncertainties) fail the cuts.
     """
-    colorcutmsk = np.ones(len(cat), dtype=bool)  # start by accepting everything
-    if colorcuts:
-        for k, v in colorcuts.items():
-            if k == 'funcs':
-                for i, f in enumerate(v):
-                    fmsk = f(cat)
-                    if verbose:
-                        print('Function', i, 'removed', np.sum(~fmsk), 'objects')
-                    colorcutmsk = colorcutmsk & fmsk
+    from selectexpr import colorcuts_to_cuts, compile_cuts
+
+    if not colorcuts:
+        return np.ones(len(cat), dtype=bool)  # accept everything
+
+    cuts = colorcuts_to_cuts(colorcuts, deredden)
+    colorcutmsk, nremoved = compile_cuts(cuts).mask(cat, expressions=expressions,
+                                                    withcounts=True)
+    if verbose:
+        nfuncs = 0
+        for cut, nrem in zip(cuts, nremoved):
+            if callable(cut):
+                print('Function', nfuncs, 'removed', nrem, 'objects')
+                nfuncs += 1
             else:
-                c1, c2 = k.split('-')
-                if deredden:
-                    color = (cat[c1] - cat['A'+c1]) - (cat[c2] - cat['A'+c2])
-                else:
-                    color = cat[c1] - cat[c2]
-
-                if len(v) == 3:
-                    bluec, redc, uncfactor = v
-
-                    c1e = c1+'_err'
-                    if c1e not in cat.colnames:
-                        c1e = c1+'err'
-                    c2e = c2+'_err'
-                    if c2e not in cat.colnames:
-                        c2e = c2+'err'
-
-                    uncfactor = uncfactor * (cat[c1e]**2 + cat[c2e]**2)**0.5
-
-                else:
-                    uncfactor = 0
-                    bluec, redc = v
-                if bluec is None:
-                    bluec = -float('inf')
-                if redc is None:
-                    redc = float('inf')
-
-                assert bluec < redc, 'blue cut larger than red cut!: ' + str(v)
-
-                #this now adds the cuts to the mask for this color
-                cmsk = ((bluec-uncfactor) < color) & (color < (redc+uncfactor))
-                if verbose:
-                    print('Colorcut for', k, 'removed', np.sum(~cmsk), 'objects')
-                colorcutmsk = colorcutmsk & cmsk
+                print('Colorcut for', cut.text, 'removed', nrem, 'objects')
     return colorcutmsk
 
 
+def category_mask(cat, colname, value):
+    """
+    Finds the rows of `cat` where the string column `colname` is `value`.
+
+    This works for both regular catalogs and compact ones (see
+    `hosts.compact_sdss_catalog`), where it compares the integer codes
+    instead of the strings.
+
+    Parameters
+    ----------
+    cat : astropy.table.Table
+        The catalog
+    colname : str
+        The name of the column (e.g. 'spec_class')
+    value : str or None
+        The value to look for, or None to find the rows where the column is
+        missing (masked).
+
+    Returns
+    -------
+    msk : bool array
+    """
+    codename = colname + '_code'
+    if codename in cat.colnames and 'categories' in cat[codename].meta:
+        codes = np.asarray(cat[codename])
+        if value is None:
+            return codes < 0
+        categories = list(cat[codename].meta['categories'])
+        if value not in categories:
+            return np.zeros(len(cat), dtype=bool)
+        return codes == categories.index(value)
+
+    col = cat[colname]
+    if value is None:
+        return np.ma.getmaskarray(col)
+    return np.ma.filled(col == value, False)
+
+
+def _column_values(cat, colname):
+    # the column data as a plain array (unless it has masked values), which
+    # makes the mask arithmetic a lot faster than going through `Column`
+    col = cat[colname]
+    if hasattr(col, 'mask') and np.any(col.mask):
+        return col
+    return np.asarray(col)
+
+
+def _flag_values(cat):
+    # the SDSS flags as uint64 whether or not the catalog is compact, so the
+    # high bits can be tested the same way
+    flags = np.asarray(cat['flags'])
+    if flags.dtype.kind == 'i' and flags.dtype.itemsize == 8:
+        flags = flags.view(np.uint64)
+    return flags.astype(np.uint64, copy=False)
+
+
 def find_gama(cat, host, raddeg, tol, matchfuture=True, whichgama='DR1'):
     """
     Find GAMA objects that match the given ra/decs within a tolerance
 
+    This uses the `GamaIndex` for the GAMA catalog, so the GAMA side is only
+    set up once per session (and the unit vectors are cached on disk), and
+    the tolerance is a true angular distance everywhere on the sky.
+
     Parameters
     ----------
-    catra : record array
+    cat : astropy.table.Table
         The catalog of objects to match
     host : NSAHost
         The host
-    raddeg : array
-        The radius of the field in degrees
+    raddeg : float
+        The radius of the field in degrees - only catalog objects within this
+        distance of the host are matched.
     tol : float
         The distance (in degrees) of a "close enough" match.
     matchfuture : bool
@@ -332,21 +621,174 @@ def find_gama(cat, host, raddeg, tol, matchfuture=True, whichgama='DR1'):
     gamacat : Table
         The corresponding GAMA entries
     ds : float array
-        On sky-distances (w/o cos(dec)) between GAMA and SDSS
+        On-sky distances in degrees between GAMA and SDSS
     """
-    from scipy import spatial
-
-    catra = cat['ra']
-    catdec = cat['dec']
-    ra0 = host.ra
-    dec0 = host.dec
+    from utils import angular_separation_deg
 
     if isinstance(whichgama, six.string_types):
         g = get_gama(url=whichgama)
     else:
         g = whichgama
 
-    #first try to figure out the relevant GAMA column names
+    catra = np.asarray(cat['ra'], dtype=float)
+    catdec = np.asarray(cat['dec'], dtype=float)
+    infield = np.flatnonzero(angular_separation_deg(host.ra, host.dec, catra, catdec) <= raddeg)
+
+    gidx, ds = get_gama_index(g).match(catra[infield], catdec[infield], tol, matchfuture)
+    matched = gidx >= 0
+
+    msk = np.zeros(len(catra), dtype=bool)
+    msk[infield[matched]] = True
+    return msk, g[gidx[matched]], ds[matched]
+
+
+GAMA_INDEX_VERSION = 2  # bump this whenever what `GamaIndex` caches changes
+GAMA_INDEX_SUFFIX = '.index'
+
+
+class GamaIndex(object):
+    """
+    A spatial index for a GAMA catalog, for matching other catalogs to it.
+
+    The positions are stored as 3D unit vectors, which are cached on disk
+    next to the GAMA file (in ``<gamafile>.index``, see `catalogcache`) and
+    memory-mapped in later sessions.  KD-trees on those vectors (one for each
+    redshift quality selection) are built the first time they are needed,
+    and distances between unit vectors are converted to true angles, so
+    matches don't depend on where the objects are on the sky.  Use
+    `get_gama_index` to get the (shared) index for a catalog.
+
+    Parameters
+    ----------
+    gama : table
+        The GAMA catalog (as from `get_gama`)
+    """
+    def __init__(self, gama):
+        self.gama = gama
+        self.colnames = _gama_colnames(gama)
+        self._xyz = None
+        self._trees = {}
+
+    @property
+    def xyz(self):
+        """
+        The unit vectors of the GAMA objects as an (N, 3) array
+        """
+        if self._xyz is None:
+            self._xyz = self._load_xyz()
+        return self._xyz
+
+    def _load_xyz(self):
+        from astropy.table import Table
+        from hosts import USE_CATALOG_CACHE
+        from catalogcache import cache_is_valid, read_table_cache, write_table_cache
+
+        fn = getattr(self.gama, 'sourcefn', None)
+        usecache = USE_CATALOG_CACHE and fn is not None
+        if usecache:
+            cachedir = fn + GAMA_INDEX_SUFFIX
+            extra = [self.colnames['granm'], self.colnames['gdecnm']]
+            if cache_is_valid(fn, cachedir, GAMA_INDEX_VERSION, extra):
+                # one (N, 3) column, so this is a view of the memory-mapped file
+                return np.asarray(read_table_cache(cachedir)['xyz'])
+
+        ra = np.radians(np.asarray(self.gama[self.colnames['granm']], dtype=float))
+        dec = np.radians(np.asarray(self.gama[self.colnames['gdecnm']], dtype=float))
+        xyz = np.empty((len(ra), 3))
+        xyz[:, 0] = np.cos(dec) * np.cos(ra)
+        xyz[:, 1] = np.cos(dec) * np.sin(ra)
+        xyz[:, 2] = np.sin(dec)
+
+        if usecache:
+            try:
+                write_table_cache(Table([xyz], names=['xyz']), fn,
+                                  GAMA_INDEX_VERSION, extra, cachedir)
+            except (IOError, OSError) as e:
+                print('Could not write GAMA index for "{0}": {1}'.format(fn, e))
+        return xyz
+
+    def tree(self, matchfuture=True):
+        """
+        The KD-tree of the GAMA objects with spectra.
+
+        Parameters
+        ----------
+        matchfuture : bool
+            If True, include things that are planned for future GAMA
+            releases.  Otherwise, only things that are currently in GAMA.
+
+        Returns
+        -------
+        tree : `scipy.spatial.cKDTree`
+            The tree of the unit vectors
+        rows : int array
+            The row in the GAMA catalog for each point in the tree
+        """
+        from scipy import spatial
+
+        matchfuture = bool(matchfuture)
+        if matchfuture not in self._trees:
+            with _gamalock:
+                if matchfuture not in self._trees:
+                    g = self.gama
+                    gznm = self.colnames['gznm']
+                    gzqnm = self.colnames['gzqnm']
+                    if matchfuture:
+                        gamaspec = g[gzqnm] > 2
+                    else:
+                        gamaspec = (g[gznm] > -2) & (g[gzqnm] > 2)
+                    rows = np.flatnonzero(np.asarray(gamaspec))
+                    # all rows can use the (memory-mapped) vectors as they are
+                    xyz = self.xyz if len(rows) == len(self.xyz) else self.xyz[rows]
+                    self._trees[matchfuture] = (spatial.cKDTree(xyz), rows)
+        return self._trees[matchfuture]
+
+    def match(self, ra, dec, tol, matchfuture=True):
+        """
+        Finds the closest GAMA object to each position within `tol`.
+
+        Parameters
+        ----------
+        ra : array
+            RAs in degrees
+        dec : array
+            Decs in degrees
+        tol : float
+            The maximum distance for a match in degrees
+        matchfuture : bool
+            See `tree`
+
+        Returns
+        -------
+        idx : int array
+            The row of the matching GAMA object for each position, or -1 for
+            no match
+        ds : float array
+            The distance to the match in degrees (inf for no match)
+        """
+        ra = np.radians(np.asarray(ra, dtype=float))
+        dec = np.radians(np.asarray(dec, dtype=float))
+        xyz = np.array([np.cos(dec) * np.cos(ra), np.cos(dec) * np.sin(ra), np.sin(dec)]).T.reshape(-1, 3)
+
+        tree, rows = self.tree(matchfuture)
+        idx = np.full(len(xyz), -1, dtype=np.int64)
+        ds = np.full(len(xyz), np.inf)
+        if len(rows) == 0 or len(xyz) == 0:
+            return idx, ds
+
+        # the chord length for `tol` (padded a bit so the angle check decides the edge)
+        maxchord = 2 * np.sin(np.radians(tol) / 2) * (1 + 1e-9)
+        chord, treeidx = tree.query(xyz, distance_upper_bound=maxchord)
+        found = np.flatnonzero(np.isfinite(chord))
+        sep = np.degrees(2 * np.arcsin(np.minimum(chord[found] / 2, 1)))
+        found, sep = found[sep < tol], sep[sep < tol]
+        idx[found] = rows[treeidx[found]]
+        ds[found] = sep
+        return idx, ds
+
+
+def _gama_colnames(g):
+    # the relevant GAMA column names, which differ between releases
     gamacols = dict(granm=('RA_J2000', 'RA'),
                     gdecnm=('DEC_J2000', 'DEC'),
                     gznm=('Z_HELIO', 'Z'),
@@ -359,28 +801,37 @@ def find_gama(cat, host, raddeg, tol, matchfuture=True, whichgama='DR1'):
         else:
             msg = 'Could not find any of {0} while looking for {1}'
             raise ValueError(msg.format(colnms, varnm))
-    granm = gamacols['granm']
-    gdecnm = gamacols['gdecnm']
-    gznm = gamacols['gznm']
-    gzqnm = gamacols['gzqnm']
-
-    gamacoverage = ((g[granm] < (ra0 + raddeg)) &
-                    (g[granm] > (ra0 - raddeg)) &
-                    (g[gdecnm] < (dec0 + raddeg)) &
-                    (g[gdecnm] > (dec0 - raddeg)))
-
-    if matchfuture:
-        gamaspec = g[gzqnm] > 2
-    else:
-        gamaspec = (g[gznm] > -2) & (g[gzqnm] > 2)
+    return gamacols
+
+
+_gamaindexes = {}
+def get_gama_index(gama=None):
+    """
+    Gets the `GamaIndex` for a GAMA catalog, re-using the same index for
+    every call in this session.
 
-    gm = g[gamacoverage & gamaspec]
-    kdt = spatial.cKDTree(np.array([gm[granm], gm[gdecnm]]).T)
+    Parameters
+    ----------
+    gama : table, str or None
+        The GAMA catalog (as from `get_gama`), or a ``url`` for `get_gama`,
+        or None for the default DR1.
 
-    ds, idx = kdt.query(np.array([catra, catdec]).T)
+    Returns
+    -------
+    index : GamaIndex
+    """
+    if gama is None:
+        gama = get_gama()
+    elif isinstance(gama, six.string_types):
+        gama = get_gama(url=gama)
 
-    msk = ds < tol
-    return msk, gm[idx[msk]], ds[msk]
+    entry = _gamaindexes.get(id(gama))
+    if entry is None or entry.gama is not gama:
+        with _gamalock:
+            entry = _gamaindexes.get(id(gama))
+            if entry is None or entry.gama is not gama:
+                entry = _gamaindexes[id(gama)] = GamaIndex(gama)
+    return entry
 
 
 def usno_vs_sdss_offset(sdsscat, usnocat, plots=False, raiseerror=0.5):
@@ -632,11 +1083,15 @@ def sdss_IAU_id_to_ra_dec(sdssids, matchtocatalog=None):
 _DEFAULT_TREM_URL = 'http://docs.google.com/spreadsheets/d/1Y3nO7VyU4jDiBPawCs8wJQt2s_PIAKRj-HSrmcWeQZo/export?format=csv&gid=1379081675'
 def remove_targets_with_remlist(cat, hostorhostname,
                                 listfnorurl=_DEFAULT_TREM_URL,
-                                matchtol=0.1*u.arcsec, maskonly=False, verbose=True):
+                                matchtol=0.1*u.arcsec, maskonly=False, verbose=True,
+                                refresh='auto'):
     """
     Use either a local csv copy, or a URL to the google spreadsheet of the
     target remove list to remove manually/by-eye filtered targets.
 
+    The list is parsed once per session and downloaded lists are stored
+    locally (see `remlist`), so calling this for many hosts is cheap.
+
     Parameters
     ----------
     cat : astropy.table.Table
@@ -647,7 +1102,8 @@ def remove_targets_with_remlist(cat, hostorhostname,
         name will come from the object.
     listfnorurl : str
         A local path to a csv file or a URL to the google spreadsheet that has
-        the target remove list.
+        the target remove list.  Can also be one of the per-host files in
+        ``removed_objects/``, in which case all of its entries are used.
     matchtol : astropy Quantity
         How close the match has to be if the objid search fails
     maskonly : bool
@@ -656,9 +1112,11 @@ def remove_targets_with_remlist(cat, hostorhostname,
     verbose : bool or 'warning'
         Print informational messages.  If 'warning', only prints if no host
         matched.
+    refresh : 'auto' or bool
+        When to check a downloaded list for changes (see
+        `remlist.fetch_remove_list`).
     """
-    from astropy.coordinates import SkyCoord
-
+    from remlist import get_remove_list
 
     hostname = getattr(hostorhostname, 'name', hostorhostname)
     if hasattr(hostorhostname, 'nsaid'):
@@ -668,50 +1126,23 @@ def remove_targets_with_remlist(cat, hostorhostname,
     else:
         nsanum = None
 
-
-    objids = cat['objID']
-    catcoords = SkyCoord(cat['ra']*u.deg, cat['dec']*u.deg)
-
-    objidstoremove = []
-
-    if listfnorurl.startswith('http://'):
-        uo = urlopen(listfnorurl)
-        try:
-            remlist_content = uo.read()
-        finally:
-            uo.close()
-    else:
-        with open(listfnorurl) as f:
-            remlist_content = f.read()
-
-    nmatched = 0
-    for i, l in enumerate(remlist_content.split('\n')[2:]):  # [2:] is to skip header lines
-        if l.replace(',', '').strip() == '':
-            continue  # empty line
-
-        ls = l.split(',')
-        if ls[0] == hostname or (nsanum is not None and ls[1]!='' and int(ls[1]) == nsanum):
-            #try to find it in the catalog, first by objid, and if not, by ra/dec
-            objid = six.integer_types[-1](ls[2]) #integer_types[-1] is long on py2
-            if objid in objids:
-                objidstoremove.append(objid)
-                nmatched += 1
-            else:
-                objcoord = SkyCoord(float(ls[3])*u.deg, float(ls[4])*u.deg)
-                idx, sep, sep3d = objcoord.match_to_catalog_sky(catcoords)
-                if sep < matchtol:
-                    objidstoremove.append(objid)
-                    nmatched += 1
-                else:
-                    msg = 'Could not find a match for objid {0} of {1}, closest is {2}'
-                    print(msg.format(objid, hostname, sep.to(u.arcsec)))
+    remlist = get_remove_list(listfnorurl, refresh)
+    toremove, nmatched, unmatched = remlist.match(cat, hostname, nsanum,
+                                                  matchtol.to(u.deg).value)
+    for objid, sep in unmatched:
+        if np.isnan(sep):
+            msg = 'Could not find a match for objid {0} of {1}, and it has no position'
+            print(msg.format(objid, hostname))
+        else:
+            msg = 'Could not find a match for objid {0} of {1}, closest is {2}'
+            print(msg.format(objid, hostname, (sep*u.deg).to(u.arcsec)))
 
     if verbose and nmatched == 0:
         print('No matches found for host "{0}" in remove list. Maybe you mis-typed something?'.format(hostname))
     elif verbose and verbose != 'warning':
         print('Removed', nmatched, 'objects for', hostname)
 
-    msk = ~np.in1d(objids, objidstoremove)
+    msk = ~toremove
     if maskonly:
         return msk
     else:
@@ -719,10 +1150,17 @@ def remove_targets_with_remlist(cat, hostorhostname,
 
 
 _cachedgama = {}
+_gamalock = threading.RLock()
 def get_gama(fn=None, url='DR1'):
     """
     Download or load the GAMA survey data
 
+    The loaded catalog is kept for the rest of the session, and this is safe
+    to call from several threads at once (the catalog is only loaded once).
+    CSV versions are parsed into a binary cache next to the file (see
+    `catalogcache`) which is memory-mapped, so worker processes that load the
+    same file share one copy (see `hosts.share_catalogs`).
+
     Parameters
     ----------
     fn : str or None
@@ -739,9 +1177,6 @@ def get_gama(fn=None, url='DR1'):
     """
     import os
 
-    from astropy.io import ascii, fits
-    from hosts import download_with_progress_updates
-
     URLMAP = {
     'DR1': 'http://www.gama-survey.org/dr1/data/GamaCoreDR1_v1.csv.gz',
     'DR2': 'http://www.gama-survey.org/dr2/data/cat/SpecCat/v08/SpecObj.fits'}
@@ -755,22 +1190,34 @@ def get_gama(fn=None, url='DR1'):
         fn = os.path.join('catalogs', fn)
 
 
-    if fn in _cachedgama:
+    tab = _cachedgama.get(fn)
+    if tab is not None:
+        return tab
+
+    with _gamalock:
+        # another thread may have loaded it while we waited for the lock
+        if fn not in _cachedgama:
+            _cachedgama[fn] = _load_gama(fn, url)
         return _cachedgama[fn]
 
+
+def _load_gama(fn, url):
+    import os
+
+    from astropy.io import fits
+    from hosts import download_large_file, USE_CATALOG_CACHE
+    from catalogcache import load_with_cache
+
     if not os.path.exists(fn):
-        with open(fn, 'w') as fw:
-            msg = 'Downloading GAMA from ' + url + ' to ' + fn
-            u = urlopen(url)
-            try:
-                download_with_progress_updates(u, fw, msg=msg)
-            finally:
-                u.close()
+        msg = 'Downloading GAMA from ' + url + ' to ' + fn
+        download_large_file(url, fn, msg=msg)
 
     if '.fits' in fn:
-        tab = _cachedgama[fn] = fits.getdata(fn, 1)
+        # this is already memory-mapped by astropy
+        tab = fits.getdata(fn, 1)
     elif '.csv' in fn:
-        tab = _cachedgama[fn] = ascii.read(fn, delimiter=',', guess=False)
+        tab = load_with_cache(fn, _parse_gama_csv, GAMA_PARSE_VERSION,
+                              usecache=USE_CATALOG_CACHE)
     else:
         raise ValueError('Unrecognized file type for GAMA file:' + str(fn))
 
@@ -781,6 +1228,11 @@ def get_gama(fn=None, url='DR1'):
         rastr = 'RA'
         decstr = 'DEC'
 
+    # identifies this version of the catalog (e.g. for `selectioncache`)
+    st = os.stat(fn)
+    tab.sourcefn = fn
+    tab.sourceversion = [os.path.basename(fn), st.st_size, st.st_mtime, GAMA_PARSE_VERSION]
+
     tab.ramax = np.max(tab[rastr])
     tab.ramin = np.min(tab[rastr])
     tab.decmax = np.max(tab[decstr])
@@ -788,6 +1240,12 @@ def get_gama(fn=None, url='DR1'):
 
     return tab
 
+
+def _parse_gama_csv(fn):
+    from astropy.io import ascii
+
+    return ascii.read(fn, delimiter=',', guess=False)
+
 def add_forced_targets(rawcat, targcat, pris, toforce, pritoforceto, matchtol=1*u.arcsec):
     """
     This takes an input catalog
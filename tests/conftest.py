@@ -0,0 +1,36 @@
+"""
+Makes the top-level saga-code modules importable from the tests, however
+pytest is run, and has the fixtures shared between test files.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+
+
+@pytest.fixture
+def fake_nsa_store(tmpdir, monkeypatch):
+    """
+    A tiny NSA (NSAIDs 147100, 150238 and 155005) that `hosts.get_nsa_store`
+    returns instead of the real one.
+    """
+    from astropy.table import Table
+    import hosts
+
+    fn = str(tmpdir.join('nsa_fake.fits'))
+    nsa = Table()
+    nsa['NSAID'] = np.array([147100, 150238, 155005], dtype=np.int32)
+    nsa['RA'] = np.array([248.1, 341.3, 35.2])
+    nsa['DEC'] = np.array([19.8, -5.2, 35.1])
+    nsa['Z'] = nsa['ZDIST'] = np.array([0.0079, 0.0063, 0.0076])
+    nsa['ZDIST_ERR'] = np.full(3, 1e-5)
+    nsa['MASS'] = np.full(3, 3e10)
+    nsa['ABSMAG'] = -20 + np.zeros((3, 7), dtype=np.float32)
+    nsa.write(fn)
+
+    store = hosts.convert_nsa_to_store(fn, str(tmpdir.join('nsa_fake_store')))
+    monkeypatch.setattr(hosts, 'get_nsa_store', lambda *args, **kwargs: store)
+    return store
@@ -0,0 +1,76 @@
+from __future__ import division, print_function
+
+import os
+import time
+
+import pytest
+
+import hosts
+import querycache
+
+
+class FakeHost(object):
+    """
+    Just enough of an `hosts.NSAHost` for `bulk_environs_download`.
+    """
+    def __init__(self, dirnm, environsarcmin=30.):
+        self.name = 'fakehost'
+        self.nsaid = 12345
+        self.ra = 180.
+        self.dec = 0.
+        self.environsarcmin = environsarcmin
+        self.sdssquerymagcut = ('r', 21)
+        self.fnsdss = os.path.join(dirnm, 'fakehost_sdss.dat')
+        self.altfnsdss = []
+
+    def sdss_environs_query(self, dl=False, **kwargs):
+        return hosts.construct_sdss_query(self.ra, self.dec, self.environsarcmin / 60.,
+                                          magcut=self.sdssquerymagcut)
+
+
+def test_replay_cache_miss_not_retried(tmpdir, monkeypatch):
+    def no_network(*args, **kwargs):
+        raise AssertionError('replay mode should not touch the network')
+
+    monkeypatch.setattr(hosts, 'urlopen', no_network)
+    monkeypatch.setattr(querycache, 'CACHE_DIR', str(tmpdir.join('querycache')))
+    monkeypatch.setattr(querycache, 'MODE', 'replay')
+
+    h = FakeHost(str(tmpdir))
+    st = time.time()
+    res = hosts.bulk_environs_download([h], usnob=False, nretries=3,
+                                       backoff=100., verbose=False)
+    assert time.time() - st < 50
+
+    assert res['sdss_status'][0] == 'failed'
+    assert res['sdss_attempts'][0] == 1
+    assert not os.path.exists(h.fnsdss)
+
+
+def test_large_environs_are_tiled(tmpdir, monkeypatch):
+    calls = []
+
+    def fake_tiled(ra, dec, radius, ntiles, fn=None, **kwargs):
+        calls.append((radius, ntiles, kwargs))
+        with open(fn, 'w') as f:
+            f.write('#Table1\nobjID\n1\n')
+
+    def fake_single(*args, **kwargs):
+        raise AssertionError('large environs should be tiled')
+
+    monkeypatch.setattr(hosts, 'download_tiled_sdss_query', fake_tiled)
+    monkeypatch.setattr(hosts, '_download_environs_file', fake_single)
+
+    big = FakeHost(str(tmpdir), environsarcmin=120.)
+    res = hosts.bulk_environs_download([big], usnob=False, timeout=10,
+                                       verbose=False)
+
+    assert res['sdss_status'][0] == 'downloaded'
+    assert res['sdss_bytes'][0] == os.path.getsize(big.fnsdss)
+    assert len(calls) == 1
+    radius, ntiles, kwargs = calls[0]
+    assert radius == 2.
+    assert ntiles == hosts.sdss_tiles_needed(2.) > 1
+    assert kwargs['magcut'] == big.sdssquerymagcut
+    assert kwargs['timeout'] == 10
+    assert kwargs['maxconnections'] == 1
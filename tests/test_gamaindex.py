@@ -0,0 +1,46 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+import hosts
+import targeting
+
+
+@pytest.fixture
+def gama(tmpdir, monkeypatch):
+    from astropy.table import Table
+
+    monkeypatch.setattr(hosts, 'USE_CATALOG_CACHE', True)
+
+    rng = np.random.RandomState(1)
+    fn = str(tmpdir.join('gama_test.fits'))
+    g = Table()
+    g['RA'] = 130 + 10 * rng.rand(500)
+    g['DEC'] = 2 * rng.rand(500) - 1
+    g['Z'] = rng.rand(500)
+    g['NQ'] = np.full(500, 4)
+    g.write(fn)
+
+    g = Table.read(fn)
+    g.sourcefn = fn
+    return g
+
+
+def test_index_is_memory_mapped(gama):
+    xyz = targeting.GamaIndex(gama).xyz  # builds the on-disk index
+
+    index = targeting.GamaIndex(gama)
+    assert np.allclose(index.xyz, xyz)
+    assert index.xyz.shape == (len(gama), 3)
+
+    base = index.xyz
+    while getattr(base, 'base', None) is not None:
+        base = base.base
+    assert not isinstance(base, np.ndarray)  # the mmap itself, not a copy
+
+    tree, rows = index.tree()
+    assert np.shares_memory(tree.data, index.xyz)
+
+    idx, ds = index.match(gama['RA'][:5], gama['DEC'][:5], 1 / 3600.)
+    assert list(idx) == list(range(5))
@@ -0,0 +1,101 @@
+from __future__ import division, print_function
+
+import csv
+
+import pytest
+
+import hosts
+
+SHEET_CSV = """\
+SAGA Hosts and Satellites,,,
+,,,
+SAGA,NGC,NSAID,Notes
+Odyssey,6181,147100,
+Iliad,7393,150238,
+NoNSA,1234,,not in the NSA
+,,,
+Other stuff,,,
+"""
+
+
+class CSVSheetClient(object):
+    """
+    Stands in for a gspread client by "opening" a CSV export of the
+    spreadsheet from disk, and counts how often the worksheet is read.
+    """
+    def __init__(self, csvfn, revision):
+        self.csvfn = csvfn
+        self.revision = revision
+        self.opened = []
+        self.reads = 0
+
+    def open(self, name):
+        self.opened.append(name)
+        return self
+
+    def lastUpdateTime(self):
+        return self.revision
+
+    def get_worksheet(self, i):
+        return self
+
+    def get_all_values(self):
+        self.reads += 1
+        with open(self.csvfn) as f:
+            return list(csv.reader(f))
+
+
+@pytest.fixture
+def sheet(tmpdir):
+    csvfn = str(tmpdir.join('SAGA_Hosts.csv'))
+    with open(csvfn, 'w') as f:
+        f.write(SHEET_CSV)
+    return CSVSheetClient(csvfn, '2015-01-01T00:00:00')
+
+
+def test_parse_saga_host_rows(sheet):
+    nsaids, names = hosts.parse_saga_host_rows(sheet.get_all_values())
+    assert nsaids == [147100, 150238]
+    assert names == [['Odyssey', 'NGC6181', 'NSA147100'],
+                     ['Iliad', 'NGC7393', 'NSA150238']]
+
+
+def test_google_hosts_conditional_refresh(sheet, tmpdir, fake_nsa_store):
+    cachefn = str(tmpdir.join('hosts_dl.json'))
+
+    hostlst = hosts.get_saga_hosts_from_google(cachefile=cachefn, sheetclient=sheet)
+    assert [h.nsaid for h in hostlst] == [147100, 150238]
+    assert hostlst[0].name == 'Odyssey'
+    assert sheet.opened == ['SAGA_Hosts+Satellites']
+    assert sheet.reads == 1
+
+    # unchanged revision: only the revision is checked, the cache is used
+    hostlst = hosts.get_saga_hosts_from_google(cachefile=cachefn, sheetclient=sheet)
+    assert [h.nsaid for h in hostlst] == [147100, 150238]
+    assert sheet.reads == 1
+
+    # never goes to the sheet at all
+    hosts.get_saga_hosts_from_google(cachefile=cachefn, sheetclient=None, refresh=False)
+    assert len(sheet.opened) == 2
+
+    # the sheet changed, so it's re-read and the cache updated
+    with open(sheet.csvfn) as f:
+        lines = f.read().split('\n')
+    lines.insert(5, 'LordoftheRings,895,155005,')
+    with open(sheet.csvfn, 'w') as f:
+        f.write('\n'.join(lines))
+    sheet.revision = '2015-02-01T00:00:00'
+
+    hostlst = hosts.get_saga_hosts_from_google(cachefile=cachefn, sheetclient=sheet)
+    assert [h.nsaid for h in hostlst] == [147100, 150238, 155005]
+    assert sheet.reads == 2
+    cached, meta = hosts.read_host_list(cachefn, withmeta=True)
+    assert meta['revision'] == '2015-02-01T00:00:00'
+    assert [h.nsaid for h in cached] == [147100, 150238, 155005]
+
+    # falls back on the cache if google can't be reached
+    class Offline(object):
+        def open(self, name):
+            raise IOError('no network')
+    hostlst = hosts.get_saga_hosts_from_google(cachefile=cachefn, sheetclient=Offline())
+    assert [h.nsaid for h in hostlst] == [147100, 150238, 155005]
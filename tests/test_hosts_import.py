@@ -0,0 +1,62 @@
+from __future__ import division, print_function
+
+import os
+import sys
+import subprocess
+
+import hosts
+
+# run in a fresh interpreter so nothing is already imported or cached
+IMPORT_SCRIPT = """
+import io
+import socket
+import sys
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+attempts = []
+
+def no_network(*args, **kwargs):
+    attempts.append(('network', args))
+    raise IOError('no network in this test')
+
+socket.socket.connect = no_network
+socket.create_connection = no_network
+
+realopen = io.open
+def recording_open(fn, *args, **kwargs):
+    if 'nsa' in str(fn).lower():
+        attempts.append(('open', fn))
+    return realopen(fn, *args, **kwargs)
+builtins.open = io.open = recording_open
+
+sys.path.insert(0, sys.argv[1])
+import hosts
+
+assert not attempts, attempts
+assert not hosts._cachednsa and not hosts._cachednsastore
+assert 'odyssey' in dir(hosts) and 'odyssey' not in vars(hosts)
+print('ok')
+"""
+
+
+def test_import_does_no_io(tmpdir):
+    env = dict(os.environ, MPLBACKEND='Agg')
+    repodir = os.path.dirname(os.path.abspath(hosts.__file__))
+    out = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT, repodir],
+                                  cwd=str(tmpdir), env=env, stderr=subprocess.STDOUT)
+    assert out.decode().strip().endswith('ok')
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_saga_hosts_created_on_access(fake_nsa_store, monkeypatch):
+    monkeypatch.delitem(vars(hosts), 'odyssey', raising=False)
+
+    host = hosts.odyssey
+    assert host.nsaid == 147100
+    assert host.name == 'Odyssey'
+    assert hosts.odyssey is host  # stored in the module after the first access
+    monkeypatch.delitem(vars(hosts), 'odyssey')
@@ -0,0 +1,69 @@
+from __future__ import division, print_function
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+import hosts
+
+sys.path.insert(0, os.path.join(os.path.dirname(hosts.__file__), 'masterlist'))
+import masterlist
+
+
+@pytest.fixture
+def nsafn(tmpdir):
+    from astropy.table import Table
+
+    fn = str(tmpdir.join('nsa_test.fits'))
+    tab = Table()
+    tab['NSAID'] = np.array([5, 3, 9], dtype=np.int32)
+    tab['RA'] = np.array([10., 20., 30.])
+    tab['ABSMAG'] = np.arange(21, dtype=np.float32).reshape(3, 7)
+    tab.write(fn)
+    return fn
+
+
+def test_failed_download_leaves_no_store(tmpdir, monkeypatch):
+    def fail(fn):
+        raise IOError('no network')
+    monkeypatch.setattr(hosts, '_download_nsa_if_missing', fail)
+
+    storedir = str(tmpdir.join('nsa_store'))
+    with pytest.raises(IOError):
+        hosts.convert_nsa_to_store(str(tmpdir.join('nsa.fits')), storedir)
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_convert_replaces_empty_dir(nsafn):
+    storedir = nsafn[:-5] + '_store'
+    os.mkdir(storedir)
+    store = hosts.convert_nsa_to_store(nsafn, storedir)
+    assert len(store) == 3
+    assert sorted(os.listdir(os.path.dirname(nsafn))) == ['nsa_test.fits', 'nsa_test_store']
+
+    with pytest.raises(IOError):
+        hosts.convert_nsa_to_store(nsafn, storedir)
+    hosts.convert_nsa_to_store(nsafn, storedir, overwrite=True)
+
+
+def test_load_nsa_ignores_incomplete_store(nsafn):
+    storedir = nsafn[:-5] + '_store'
+    os.mkdir(storedir)
+    tab = masterlist.load_nsa(nsafn)
+    assert list(tab['NSAID']) == [5, 3, 9]
+    assert list(tab['ABSMAG_r']) == [4, 11, 18]
+
+    os.rmdir(storedir)
+    hosts.convert_nsa_to_store(nsafn, storedir)
+    tab = masterlist.load_nsa(nsafn)
+    assert list(tab['NSAID']) == [5, 3, 9]
+    assert list(tab['ABSMAG_r']) == [4, 11, 18]
+
+
+def test_import_saga_module_leaves_sys_path_alone():
+    before = list(sys.path)
+    mod = masterlist._import_saga_module('querycache')
+    assert os.path.dirname(os.path.abspath(mod.__file__)) == os.path.dirname(os.path.abspath(hosts.__file__))
+    assert sys.path == before
@@ -0,0 +1,93 @@
+from __future__ import division, print_function
+
+import os
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import hosts
+import querycache
+
+
+def _write_sdss_csv(fn, nrows):
+    rng = np.random.RandomState(0)
+    with open(fn, 'w') as f:
+        f.write('#Table1\n')
+        f.write('objID,ra,dec,r,g,type\n')
+        for i in range(nrows):
+            f.write('{0},{1:.12f},{2:.12f},{3:.9f},{4:.9f},{5}\n'.format(
+                1237650000000000000 + i, rng.rand() * 360, rng.rand() * 2 - 1,
+                15 + rng.rand() * 7, 15 + rng.rand() * 7, 3 + 3 * (i % 2)))
+
+
+@pytest.fixture
+def sdss_server(tmpdir, monkeypatch):
+    """
+    Stands in for the SkyServer by "downloading" a CSV file from disk, so the
+    response is never in memory unless the code under test puts it there.
+    """
+    csvfn = str(tmpdir.join('response.csv'))
+    _write_sdss_csv(csvfn, 200000)
+    requests = []
+
+    def fake_urlopen(url, *args, **kwargs):
+        requests.append(url)
+        return open(csvfn, 'rb')
+
+    monkeypatch.setattr(hosts, 'urlopen', fake_urlopen)
+    monkeypatch.setattr(querycache, 'CACHE_DIR', str(tmpdir.join('querycache')))
+    return csvfn, requests
+
+
+def _stream_with_peak_memory():
+    tracemalloc.start()
+    try:
+        tab = hosts.stream_sdss_query('select * from PhotoTag', blocksize=2**18)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return tab, peak
+
+
+@pytest.mark.parametrize('mode', ['off', 'readwrite'])
+def test_stream_memory_bounded_with_cache(sdss_server, monkeypatch, mode):
+    csvfn, requests = sdss_server
+    monkeypatch.setattr(querycache, 'MODE', mode)
+
+    # first from the "server" (and recorded in readwrite mode), then from the cache
+    for nrequests in (1, 1 if mode == 'readwrite' else 2):
+        tab, peak = _stream_with_peak_memory()
+        assert len(requests) == nrequests
+        assert len(tab) == 200000
+
+        colbytes = sum([np.asarray(tab[nm]).nbytes for nm in tab.colnames])
+        # the response text is about twice the size of the columns, so holding
+        # it would break the bound
+        assert os.path.getsize(csvfn) > 1.5 * colbytes
+        assert peak < 1.5 * colbytes
+
+    entries = os.listdir(querycache.CACHE_DIR) if os.path.isdir(querycache.CACHE_DIR) else []
+    if mode == 'readwrite':
+        assert len(entries) == 1
+        with open(os.path.join(querycache.CACHE_DIR, entries[0]), 'rb') as f1:
+            with open(csvfn, 'rb') as f2:
+                assert f1.read() == f2.read()
+    else:
+        assert entries == []
+
+
+def test_incomplete_response_not_cached(sdss_server, monkeypatch):
+    monkeypatch.setattr(querycache, 'MODE', 'readwrite')
+
+    key = querycache.query_key('http://example', 'csv', 'select 1')
+    with pytest.raises(RuntimeError):
+        with querycache.cached_response(key, lambda: open(sdss_server[0], 'rb')) as r:
+            r.readline()
+            raise RuntimeError
+    assert os.listdir(querycache.CACHE_DIR) == []
+    assert querycache.get_cached(key) is None
+
+    monkeypatch.setattr(querycache, 'MODE', 'replay')
+    with pytest.raises(querycache.CacheMissError):
+        querycache.get_cached(key)
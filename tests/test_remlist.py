@@ -0,0 +1,142 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+import remlist
+
+HOST_FILE = """\
+objid ra dec
+1237600000000000001 10.0 1.0
+1237699999999999999 10.00001 1.00001
+1237600000000000777
+1237600000000000003 nan nan
+"""
+
+SHEET_CSV = """\
+Remove list,,,,
+Host,NSA,objID,ra,dec
+Odyssey,147100,1237600000000000001,10.0,1.0
+Iliad,150238,1237600000000000002,10.1,1.1
+,147100,1237699999999999999,10.1,1.1
+Odyssey,147100,,,
+"""
+
+
+@pytest.fixture
+def cat():
+    # the second object has a new objID, like in a different data release
+    tab = Table()
+    tab['objID'] = np.array([1237600000000000001, 1237600000000000999,
+                             1237600000000000002, 1237600000000000004], dtype=np.int64)
+    tab['ra'] = np.array([10.0, 10.00001, 10.1, 20.0])
+    tab['dec'] = np.array([1.0, 1.00001, 1.1, -1.0])
+    return tab
+
+
+def test_match_host_file(cat):
+    rl = remlist.RemoveList.from_text(HOST_FILE)
+    assert len(rl) == 4
+    assert rl.anyhost
+
+    remove, nmatched, unmatched = rl.match(cat, 'anything')
+    # by objID, and by position for the stale objID
+    assert list(remove) == [True, True, False, False]
+    assert nmatched == 2
+    # neither entry without a position can be found
+    assert sorted([objid for objid, sep in unmatched]) == [1237600000000000003, 1237600000000000777]
+    assert all([np.isnan(sep) for objid, sep in unmatched])
+
+
+def test_match_sheet_csv(cat):
+    rl = remlist.RemoveList.from_text(SHEET_CSV.encode('utf-8'))
+    assert len(rl) == 3  # the line with neither an objID nor a position is skipped
+    assert not rl.anyhost
+
+    # the unnamed entry is found by its NSA number, and by position
+    remove, nmatched, unmatched = rl.match(cat, 'Odyssey', 147100)
+    assert list(remove) == [True, False, True, False]
+    assert nmatched == 2 and unmatched == []
+
+    remove, nmatched, unmatched = rl.match(cat, 'Odyssey')
+    assert list(remove) == [True, False, False, False]
+
+    remove, nmatched, unmatched = rl.match(cat, 'Nobody', 1)
+    assert not np.any(remove) and nmatched == 0
+
+
+class FakeResponse(object):
+    def __init__(self, content, etag):
+        self.content = content
+        self.etag = etag
+
+    def read(self):
+        return self.content
+
+    def info(self):
+        return {'ETag': self.etag, 'Last-Modified': None}
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """
+    Stands in for the spreadsheet's csv export, supporting ETags.
+    """
+    HTTPError = remlist.six.moves.urllib.error.HTTPError
+    URLError = remlist.six.moves.urllib.error.URLError
+
+    state = {'content': SHEET_CSV.encode('utf-8'), 'etag': '"v1"', 'down': False,
+             'requests': []}
+
+    def fake_urlopen(req, *args, **kwargs):
+        state['requests'].append(req)
+        if state['down']:
+            raise URLError('no network')
+        if req.get_header('If-none-match') == state['etag']:
+            raise HTTPError(req.get_full_url(), 304, 'Not Modified', {}, None)
+        return FakeResponse(state['content'], state['etag'])
+
+    monkeypatch.setattr(remlist.six.moves.urllib.request, 'urlopen', fake_urlopen)
+    return state
+
+
+def test_fetch_remove_list(server, tmpdir):
+    url = 'https://example.com/remlist.csv'
+    cachedir = str(tmpdir.join('remlistcache'))
+
+    assert remlist.fetch_remove_list(url, cachedir=cachedir) == server['content']
+    assert len(server['requests']) == 1
+
+    # checked recently, so the server isn't asked
+    assert remlist.fetch_remove_list(url, cachedir=cachedir) == server['content']
+    assert len(server['requests']) == 1
+
+    # unchanged on the server: 304, and the stored copy is used
+    assert remlist.fetch_remove_list(url, refresh=True, cachedir=cachedir) == server['content']
+    assert len(server['requests']) == 2
+    assert server['requests'][-1].get_header('If-none-match') == '"v1"'
+
+    # the server can't be reached, so the stored copy is used
+    server['down'] = True
+    assert remlist.fetch_remove_list(url, refresh=True, cachedir=cachedir) == server['content']
+    assert len(server['requests']) == 3
+
+    # changed on the server
+    server['down'] = False
+    oldcontent = server['content']
+    server['content'] = oldcontent + b'Iliad,150238,1237600000000000004,,\n'
+    server['etag'] = '"v2"'
+    assert remlist.fetch_remove_list(url, refresh=True, cachedir=cachedir) == server['content']
+    assert remlist.fetch_remove_list(url, refresh=False, cachedir=cachedir) == server['content']
+    assert len(server['requests']) == 4
+
+
+def test_fetch_remove_list_no_stored_copy(server, tmpdir):
+    server['down'] = True
+    with pytest.raises(remlist.six.moves.urllib.error.URLError):
+        remlist.fetch_remove_list('https://example.com/remlist.csv',
+                                  cachedir=str(tmpdir.join('remlistcache')))
@@ -0,0 +1,58 @@
+from __future__ import division, print_function
+
+import numpy as np
+from astropy.table import Table, MaskedColumn
+
+import selectioncache
+
+
+def _catalog(n=1000):
+    cat = Table()
+    cat['objID'] = np.arange(n, dtype=np.int64)
+    cat['r'] = np.linspace(15, 22, n)
+    cat['flag'] = MaskedColumn(np.zeros(n), mask=np.arange(n) % 3 == 0)
+    return cat
+
+
+def test_fingerprint_not_rehashed(monkeypatch):
+    cat = _catalog()
+    fp = selectioncache.catalog_fingerprint(cat)
+
+    def no_hashing(*args, **kwargs):
+        raise AssertionError('unchanged catalog was hashed again')
+
+    monkeypatch.setattr(selectioncache, '_hash_array', no_hashing)
+    assert selectioncache.catalog_fingerprint(cat) == fp
+
+
+def test_fingerprint_follows_changes():
+    cat = _catalog()
+    fp = selectioncache.catalog_fingerprint(cat)
+    assert selectioncache.catalog_fingerprint(_catalog()) == fp
+    assert selectioncache.catalog_fingerprint(cat[::2]) == selectioncache.catalog_fingerprint(Table(cat[::2], copy=True))
+
+    # edited in place
+    cat['r'][:10] = 30
+    selectioncache.catalog_changed(cat)
+    fpedited = selectioncache.catalog_fingerprint(cat)
+    assert fpedited != fp
+
+    # column replaced
+    cat['r'] = np.linspace(15, 22, len(cat))
+    assert selectioncache.catalog_fingerprint(cat) == fp
+
+    # derived columns are left out
+    cat['rhost'] = np.ones(len(cat))
+    assert selectioncache.catalog_fingerprint(cat) == fp
+
+
+def test_fingerprint_memo_dropped_with_catalog():
+    import gc
+
+    cat = _catalog()
+    selectioncache.catalog_fingerprint(cat)
+    key = id(cat)
+    assert key in selectioncache._fingerprints
+    del cat
+    gc.collect()
+    assert key not in selectioncache._fingerprints
@@ -0,0 +1,46 @@
+from __future__ import division, print_function
+
+import numpy as np
+import pytest
+
+import utils
+
+
+def test_luminosity_distance_scalar_types():
+    table = utils.get_luminosity_distance_table('WMAP9')
+
+    for z in (0.01, np.float32(0.01), np.float64(0.01), 0):
+        d = table.mpc(z)
+        assert isinstance(d, float) and not isinstance(d, np.float32)
+        # the same as the array path, which works in float64
+        assert d == pytest.approx(table.mpc(np.array([z], dtype=float))[0], rel=1e-12)
+
+
+def test_angular_separation_matches_skycoord():
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+
+    rng = np.random.RandomState(2)
+    ra1, ra2 = 360 * rng.rand(2, 1000)
+    dec1, dec2 = np.degrees(np.arcsin(2 * rng.rand(2, 1000) - 1))
+    # tiny and nearly antipodal separations, and across RA=0
+    ra2[:100] = ra1[:100] + 1e-6
+    dec2[:100] = dec1[:100]
+    ra2[100:200] = ra1[100:200] + 180 - 1e-5
+    dec2[100:200] = -dec1[100:200]
+    ra1[200:300] = 359.9999
+    ra2[200:300] = 0.0001
+
+    expected = SkyCoord(ra1*u.deg, dec1*u.deg).separation(SkyCoord(ra2*u.deg, dec2*u.deg)).deg
+    sep = utils.angular_separation_deg(ra1, dec1, ra2, dec2)
+    antipodal = np.zeros(len(sep), dtype=bool)
+    antipodal[100:200] = True
+    assert np.allclose(sep[~antipodal], expected[~antipodal], rtol=1e-12, atol=1e-15)
+    # haversine loses some precision near 180 deg, but still well under a mas
+    assert np.all(np.abs(sep[antipodal] - expected[antipodal]) < 1e-6)
+
+    # scalars, and broadcasting one position against many
+    assert isinstance(utils.angular_separation_deg(ra1[0], dec1[0], ra2[0], dec2[0]), float)
+    assert utils.angular_separation_deg(ra1[0], dec1[0], ra2[0], dec2[0]) == pytest.approx(expected[0])
+    onetomany = SkyCoord(ra1[0]*u.deg, dec1[0]*u.deg).separation(SkyCoord(ra2*u.deg, dec2*u.deg)).deg
+    assert np.allclose(utils.angular_separation_deg(ra1[0], dec1[0], ra2, dec2), onetomany, rtol=1e-12, atol=1e-15)
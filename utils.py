@@ -417,3 +417,337 @@ def skycoord_to_regions(scs, shape='point', otherparams='', ds9=None):
         for ra, dec, otherparam in zip(scs.ra.deg, scs.dec.deg, otherparams):
             reglines.append('icrs; {shape} {ra}d {dec}d '.format(**locals()) + otherparam)
     ds9.set('regions', '\n'.join(reglines))
+
+
+
+class LuminosityDistanceTable(object):
+    """
+    A fast, interpolated redshift -> luminosity distance lookup for a given
+    cosmology.
+
+    This tabulates ``D_L(z)/z`` (which is very smooth and goes to the Hubble
+    distance at z=0) on a uniform grid and linearly interpolates it.  The grid
+    is refined until the interpolation is within `rtol` (relative) of the
+    exact astropy calculation at the worst of a set of check points between
+    grid points, so the stated accuracy is verified rather than assumed.
+    Redshifts outside ``0 <= z <= zmax`` fall back to the exact calculation.
+
+    Parameters
+    ----------
+    cosmo : astropy cosmology
+        The cosmology to use
+    zmax : float
+        The largest redshift to tabulate
+    rtol : float
+        The required relative accuracy of the interpolation
+
+    Attributes
+    ----------
+    maxrelerr : float
+        The largest relative error found when the table was checked.
+    """
+    def __init__(self, cosmo, zmax=0.5, rtol=1e-7):
+        from astropy import units as u
+
+        self.cosmo = cosmo
+        self.zmax = zmax
+        self.rtol = rtol
+        self._dh = cosmo.hubble_distance.to(u.Mpc).value
+
+        npts = 128
+        while True:
+            self._zgrid = np.linspace(0, zmax, npts)
+            self._fgrid = self._exact_over_z(self._zgrid)
+
+            # check halfway and a quarter of the way between grid points
+            dz = self._zgrid[1] - self._zgrid[0]
+            zcheck = np.concatenate([self._zgrid[:-1] + dz/2, self._zgrid[:-1] + dz/4])
+            exact = self._exact_over_z(zcheck)
+            self.maxrelerr = np.max(np.abs(np.interp(zcheck, self._zgrid, self._fgrid) / exact - 1))
+            if self.maxrelerr < rtol:
+                break
+            npts *= 2
+
+    def _exact_over_z(self, z):
+        from astropy import units as u
+
+        res = np.empty_like(z)
+        nonzero = z != 0
+        res[nonzero] = self.cosmo.luminosity_distance(z[nonzero]).to(u.Mpc).value / z[nonzero]
+        res[~nonzero] = self._dh
+        return res
+
+    def mpc(self, z):
+        """
+        The luminosity distance in Mpc for redshift(s) `z`, as a float or
+        array.
+        """
+        from astropy import units as u
+
+        if isinstance(z, (float, int, np.floating, np.integer)) and 0 <= z <= self.zmax:
+            # fast path for the common single-host case
+            z = float(z)
+            return z * float(np.interp(z, self._zgrid, self._fgrid))
+
+        zarr = np.array(z, dtype=float, copy=True)
+        scalar = zarr.ndim == 0
+        zarr = np.atleast_1d(zarr)
+
+        res = zarr * np.interp(zarr, self._zgrid, self._fgrid)
+        outside = (zarr < 0) | (zarr > self.zmax)
+        if np.any(outside):
+            res[outside] = self.cosmo.luminosity_distance(zarr[outside]).to(u.Mpc).value
+
+        return res[0] if scalar else res
+
+    def __call__(self, z):
+        """
+        The luminosity distance for redshift(s) `z` as a Quantity.
+        """
+        from astropy import units as u
+
+        return self.mpc(z) * u.Mpc
+
+    def __repr__(self):
+        return '<LuminosityDistanceTable for {0} up to z={1}, max rel. error {2:.1e}>'.format(self.cosmo.name, self.zmax, self.maxrelerr)
+
+
+_cacheddisttables = {}
+def get_luminosity_distance_table(cosmo='WMAP7'):
+    """
+    Returns the shared `LuminosityDistanceTable` for a cosmology, creating it
+    the first time it is requested.
+
+    Parameters
+    ----------
+    cosmo : str or astropy cosmology
+        The cosmology or the name of one of the cosmologies in
+        `astropy.cosmology` (e.g. 'WMAP7' or 'WMAP9')
+    """
+    if isinstance(cosmo, six.string_types):
+        key = cosmo
+    else:
+        # cosmology objects aren't hashable, but their repr has all the parameters
+        key = repr(cosmo)
+
+    if key not in _cacheddisttables:
+        if isinstance(cosmo, six.string_types):
+            from astropy import cosmology
+
+            cosmo = getattr(cosmology, cosmo)
+        _cacheddisttables[key] = LuminosityDistanceTable(cosmo)
+    return _cacheddisttables[key]
+
+
+def luminosity_distance(z, cosmo='WMAP7'):
+    """
+    Luminosity distance for the redshift(s) `z` from the shared interpolation
+    table for `cosmo` (accurate to a relative 1e-7 - see
+    `LuminosityDistanceTable`).  Returns a Quantity.
+    """
+    return get_luminosity_distance_table(cosmo)(z)
+
+
+def luminosity_distance_mpc(z, cosmo='WMAP7'):
+    """
+    Same as `luminosity_distance`, but returns a plain float or array in Mpc.
+    """
+    return get_luminosity_distance_table(cosmo).mpc(z)
+
+def angular_separation_deg(ra1, dec1, ra2, dec2):
+    """
+    The angular separation between sky positions, all in degrees.
+
+    This works on plain floats or arrays (which broadcast against each other
+    like any numpy operation), so it avoids the overhead of `SkyCoord` and
+    `Quantity` for things like the distance of every object in a catalog
+    from a host.  It uses the haversine formula, which is accurate for both
+    small and large separations.
+
+    Parameters
+    ----------
+    ra1, dec1 : float or array
+        The first position(s) in degrees
+    ra2, dec2 : float or array
+        The second position(s) in degrees
+
+    Returns
+    -------
+    sep : float or array
+        The separation(s) in degrees
+    """
+    ra1, dec1, ra2, dec2 = [np.asarray(x, dtype=float) for x in (ra1, dec1, ra2, dec2)]
+    d2r = np.pi / 180
+
+    # done in place as much as possible, because for big catalogs this is
+    # limited by memory bandwidth rather than the arithmetic
+    sinra = np.sin((ra2 - ra1) * (d2r / 2))
+    sindec = np.sin((dec2 - dec1) * (d2r / 2))
+    a = np.empty(np.broadcast(ra1, dec1, ra2, dec2).shape)
+    np.multiply(np.cos(dec1 * d2r), np.cos(dec2 * d2r), out=a)
+    a *= sinra
+    a *= sinra
+    sindec *= sindec
+    a += sindec
+    np.clip(a, 0, 1, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2 / d2r
+    return a if a.ndim else float(a)
+
+
+def tangent_plane_offsets(ra, dec, ra0, dec0):
+    """
+    Projects sky positions onto the plane tangent to the sky at
+    (`ra0`, `dec0`) - i.e., the gnomonic projection, which is what a
+    telescope focal plane sees.
+
+    Parameters
+    ----------
+    ra, dec : float or array
+        The position(s) to project in degrees
+    ra0, dec0 : float
+        The center of the projection in degrees
+
+    Returns
+    -------
+    xi, eta : float or array
+        The offsets in degrees, with `xi` increasing to the East and `eta`
+        to the North.  Points more than 90 degrees from the center give nan.
+    """
+    ra, dec = np.radians(ra), np.radians(dec)
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+
+    cosdec = np.cos(dec)
+    cosdra = np.cos(ra - ra0)
+    cosc = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * cosdec * cosdra
+    cosc = np.where(cosc > 0, cosc, np.nan)
+
+    xi = cosdec * np.sin(ra - ra0) / cosc
+    eta = (np.cos(dec0) * np.sin(dec) - np.sin(dec0) * cosdec * cosdra) / cosc
+    return np.degrees(xi), np.degrees(eta)
+
+
+def benchmark_separation(nrows=10**6, nrepeats=3, seed=0):
+    """
+    Times `angular_separation_deg` against `SkyCoord.separation` for the
+    separation of `nrows` random positions from one center, and checks that
+    they agree.
+
+    Parameters
+    ----------
+    nrows : int
+        The number of positions
+    nrepeats : int
+        The number of times to time each (the fastest is reported)
+    seed : int
+        The random number seed for the positions
+
+    Returns
+    -------
+    times : dict
+        The time in seconds for 'kernel' and 'skycoord', and the biggest
+        difference between them (in arcsec) as 'maxdiffarcsec'.
+    """
+    import time
+    from astropy import units as u
+    from astropy.coordinates import SkyCoord
+
+    rng = np.random.RandomState(seed)
+    ra0, dec0 = 150., 2.
+    ras = ra0 + rng.uniform(-2, 2, nrows)
+    decs = dec0 + rng.uniform(-2, 2, nrows)
+
+    def time_kernel():
+        return angular_separation_deg(ra0, dec0, ras, decs)
+
+    def time_skycoord():
+        center = SkyCoord(ra0*u.deg, dec0*u.deg)
+        return center.separation(SkyCoord(ras*u.deg, decs*u.deg)).degree
+
+    times = {}
+    results = {}
+    for name, func in (('kernel', time_kernel), ('skycoord', time_skycoord)):
+        ts = []
+        for i in range(nrepeats):
+            st = time.time()
+            results[name] = func()
+            ts.append(time.time() - st)
+        times[name] = min(ts)
+        print('{0}: {1:.4f} sec for {2} rows'.format(name, times[name], nrows))
+
+    times['maxdiffarcsec'] = float(np.max(np.abs(results['kernel'] - results['skycoord']))) * 3600
+    return times
+
+
+_IMPORT_BENCHMARK_CODE = """
+import sys, time, json
+sys.path.insert(0, {path!r})
+st = time.time()
+import {modname}
+et = time.time()
+import hosts
+print(json.dumps({{'time': et - st,
+                  'nsaloaded': bool(hosts._cachednsa or hosts._cachednsastore)}}))
+"""
+def benchmark_import_time(modnames=('hosts', 'targeting', 'aat', 'wiyn'),
+                          nrepeats=5, path=None, maxtime=None):
+    """
+    Times how long it takes to import the SAGA modules in a fresh interpreter,
+    and checks that importing them did not load any NSA data.
+
+    Each import is done in its own subprocess so that nothing is already
+    cached from an earlier import.
+
+    Parameters
+    ----------
+    modnames : sequence of str
+        The names of the modules to time.
+    nrepeats : int
+        The number of fresh imports to do for each module.  The median time is
+        reported.
+    path : str or None
+        The directory the modules live in, or None to use the directory this
+        file is in.
+    maxtime : float or None
+        If not None, raise an error if any module takes longer than this many
+        seconds (median) to import.
+
+    Returns
+    -------
+    times : dict
+        Maps module name to median import time in seconds
+
+    Raises
+    ------
+    ValueError
+        If any import triggered NSA catalog I/O, or if `maxtime` is exceeded.
+    """
+    import os
+    import sys
+    import json
+    import subprocess
+
+    if path is None:
+        path = os.path.dirname(os.path.abspath(__file__))
+
+    times = {}
+    for modname in modnames:
+        modtimes = []
+        for i in range(nrepeats):
+            code = _IMPORT_BENCHMARK_CODE.format(path=path, modname=modname)
+            output = subprocess.check_output([sys.executable, '-c', code])
+            res = json.loads(output.decode().strip().split('\n')[-1])
+            if res['nsaloaded']:
+                raise ValueError('Importing {0} loaded the NSA'.format(modname))
+            modtimes.append(res['time'])
+        times[modname] = float(np.median(modtimes))
+        print('import {0}: {1:.3f} sec (median of {2})'.format(modname, times[modname], nrepeats))
+
+    if maxtime is not None:
+        slow = [nm for nm in times if times[nm] > maxtime]
+        if slow:
+            raise ValueError('Modules {0} took longer than {1} sec to '
+                             'import'.format(slow, maxtime))
+
+    return times